@@ -1,15 +1,13 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """
-CGI entry point for the respec to EPUB conversion Web service.
+CGI entry point for the respec to EPUB conversion Web service; a thin shim around the WSGI application of the
+rp2epub package (see the rp2epub.service module).
 
 """
 import os
 import os.path
 import sys
-import urllib
-import datetime
-import traceback
 
 # To ensure the right format for the dates
 import locale
@@ -71,147 +69,14 @@ except:
 	logger = None
 
 ##########################################
-# Various utility functions
-
-
-def now():
-	"""
-	Return the current date and time in the format required by HTTP headers
-	:return: string of current date and time
-	"""
-	return datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
-
-
-def respond(wrapper, modified):
-	"""
-	Generate the full HTTP response
-	:param wrapper: Wrapper around the document conversion; a :py:class:`rp2epub.DocWrapper` instance
-	:param modified: time stamp to be added to the response, through the 'Last-Modified' header response field
-	:return:
-	"""
-	if cgi:
-		print "Content-type: application/epub+zip"
-		print "Last-Modified: %s" % modified
-		print "Expires: %s" % now()
-		print "Content-Length: %s" % os.stat(wrapper.book_file_name).st_size
-		print "Content-Disposition: attachment; filename=%s" % wrapper.document.short_name + ".epub"
-		print "Access-Control-Allow-Origin: *"
-		print "Access-Control-Allow-Methods: GET,HEAD"
-		print "Access-Control-Allow-Headers: Range, Content-Type, Origin, X-Requested-With, Accept, Accept-Language, Content-Language"
-		print "Access-Control-Expose-Headers: Accept-Ranges, Content-Encoding, Content-Type, Content-Length, Content-Range, Content-Language, Cache-Control, Expires, Last-Modified, Pragma"
-		print
-		with open(wrapper.book_file_name) as book:
-			print book.read()
-		if cgi and logger is not None:
-			logger.info("**** The '%s' EPUB 3 file has been generated and has been returned to caller ****" % (wrapper.document.short_name + ".epub"))
-	else:
-		print wrapper.book_file_name
-
-
-class Generator:
-	"""
-	The real work horse to control the conversion.
-	"""
-	# noinspection PyPep8
-	def __init__(self):
-		"""
-		Extract the query string value of interest. Note that the usual Python FieldStorage class cannot be used,
-		because the url argument may be a query string by itself (this is due to the peculiarities of respec, ie,
-		the fact that one can use URLs with query string to override the respec config data).
-		"""
-		self.args = {
-			'url'   : "",
-			'respec': False
-		}
-		if 'QUERY_STRING' in os.environ:
-			call_args = {}
-			for arg in os.environ['QUERY_STRING'].split('&'):
-				current = arg.split('=', 1)
-				if len(current) > 1:
-					call_args[current[0]] = current[1]
-
-			if 'type' in call_args:
-				self.args['respec'] = True if call_args['type'].lower() == 'respec' else False
-
-			if 'url' in call_args:
-				self.args['url'] = urllib.unquote(call_args['url'])
-			elif 'uri' in call_args:
-				self.args['url'] = urllib.unquote(call_args['uri'])
-
-		if cgi and logger is not None:
-			logger.info("**** Handling '%s' via the generator service ****" % self.args['url'])
-			logger.info("File is %s source" % "a respec" if self.args['respec'] else "an html")
-
-	# noinspection PyUnresolvedReferences
-	def generate_ebook(self):
-		"""
-		Interface to the real ebook generation; test setup for now
-
-		:return: file name for the final book
-		"""
-		# Generate the EPUB in the external library
-		# noinspection PyPep8
-		# Looks unnecessary, but sets the right locale...
-		import rp2epub
-		from rp2epub.doc2epub import DocWrapper
-		# noinspection PyPep8,PyArgumentEqualDefault
-		return DocWrapper(self.args['url'],
-						  is_respec=self.args['respec'],
-						  package=True,
-						  folder=False,
-						  temporary=True,
-						  logger=logger
-		).process()
-
-	def process(self):
-		"""
-		Full process of EPUB generation
-		"""
-
-		# Start of EPUB generation, this will set the 'last modified' header field in the response
-		modified = now()
-
-		# The real 'meat': EPUB generation
-		wrapper = self.generate_ebook()
-
-		# Return the HTTP result
-		respond(wrapper, modified)
-
-		# The file must be removed...
-		if cgi and os.path.exists(wrapper.book_file_name):
-			os.remove(wrapper.book_file_name)
-
-
-########################
-# noinspection PyBroadException
-try:
-	# GO!
-	Generator().process()
-except:
-	exc_type, exc_value, exc_traceback = sys.exc_info()
-	if cgi:
-		if logger is not None:
-			# The error should be logged...
-			from StringIO import StringIO
-			err = StringIO()
-			traceback.print_exception(exc_type, exc_value, exc_traceback, file=err)
-			logger.critical("Exception has been raised:\n" + err.getvalue())
-			err.close()
-
-		# ...and returned
-		print 'Status: 500'
-		print 'Content-Type: text/html; charset=utf-8'
-		print
-		print "<html>"
-		print "<head>"
-		print "<title>Epub Generator Exception</title>"
-		print "</head><body>"
-		print "<h1>Epub Generator Exception</h1>"
-		print "<pre>"
-		traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stdout)
-		print "</pre>"
-		print "</body></html>"
-	else:
-		traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stdout)
-
-
+# The service itself is the WSGI application of the rp2epub package, run through the CGI protocol. (The same application
+# can be run as a long-running server, see the rp2epub-service script, which avoids the start-up cost of a CGI
+# process on each request.)
+if not cgi:
+	# The artificial environment must look like a real request...
+	from wsgiref.util import setup_testing_defaults
+	setup_testing_defaults(os.environ)
+
+from wsgiref.handlers import CGIHandler
+from rp2epub.service import EPUBService
+CGIHandler().run(EPUBService(workers=1, logger=logger))
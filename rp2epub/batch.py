@@ -0,0 +1,186 @@
+"""
+Generation of the books for a list of sources in one run (see the ``--batch`` option of the ``rp2epub`` script). The
+books are generated by a pool of processes, each generating one book at a time; the imports, the persistent HTTP
+connections (see :py:mod:`.connections`) and the in-memory caches are kept by each process from one book to the next.
+All processes use the same persistent HTTP cache and CSS parsing cache (see :py:mod:`.httpcache` and :py:mod:`.cssurls`),
+i.e., the W3C logos, style sheets, etc., are retrieved and parsed once for the whole batch. If no cache directory is
+set, a temporary one is used for the batch.
+
+The list of sources has one source per line: the URL, possibly preceded by ``respec`` or ``html`` to set the type of
+the source (the default type is set by the ``-r`` option of the script). Empty lines, and lines starting with ``#``,
+are ignored. E.g.::
+
+    # Nightly builds
+    respec https://w3c.github.io/csvw/syntax/
+    html https://www.w3.org/TR/2015/REC-tabular-data-model-20151217/
+    https://www.w3.org/TR/tabular-metadata/
+
+The books are named after the short names of the documents. If several sources have the same short name, the book
+claiming the name first gets it, and the others get a name suffixed by their (1-based) position in the list, e.g.,
+``csvw-2.epub``; the names are claimed through the files of a temporary directory, shared by the processes.
+The result of the batch is a summary (see :py:func:`run`), with the outcome, the name of the book, and the generation
+time of each book.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import os
+import os.path
+import time
+import errno
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+
+from . import R2EError
+from .doc2epub import DocWrapper
+from .config import BATCH_PROCESSES
+
+RESPEC = "respec"
+HTML   = "html"
+
+# Waiting for the result of a pool without a timeout cannot be interrupted (by Ctrl-C) in Python 2
+_FOREVER = 365 * 24 * 3600
+
+# Arguments of the DocWrapper instances, set in each process of the pool
+_options = {}
+
+# Directory of the names claimed by the books of the batch, set in each process of the pool
+_claims = None
+
+
+def read_list(stream, is_respec=False):
+	"""
+	Read a list of sources.
+
+	:param stream: an iterable of lines, e.g., an open file
+	:param boolean is_respec: the type of the sources whose line does not set it
+	:return: list of ``(url, is_respec)`` pairs
+	:raises R2EError: if a line cannot be interpreted
+	"""
+	entries = []
+	for number, line in enumerate(stream, 1):
+		line = line.strip()
+		if line == "" or line.startswith("#"):
+			continue
+		fields = line.split()
+		if len(fields) == 1:
+			entries.append((fields[0], is_respec))
+		elif len(fields) == 2 and fields[0].lower() in (RESPEC, HTML):
+			entries.append((fields[1], fields[0].lower() == RESPEC))
+		else:
+			raise R2EError("Line %s of the list of sources cannot be interpreted: '%s'" % (number, line))
+	return entries
+
+
+def _initialize(options, claims):
+	global _options, _claims
+	_options = options
+	_claims  = claims
+
+
+def _claim(name):
+	"""
+	Claim a book name for the batch; the claim is an atomic file creation, i.e., only one process gets a name.
+
+	:param str name: the name of the book
+	:return: whether the name has been claimed
+	:rtype: boolean
+	"""
+	try:
+		os.close(os.open(os.path.join(_claims, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+		return True
+	except OSError as e:
+		if e.errno == errno.EEXIST:
+			return False
+		raise
+
+
+def _build(numbered_entry):
+	"""
+	Generate the book of a source (in a process of the pool).
+
+	:param numbered_entry: the position of the source in the list, and the ``(url, is_respec)`` pair
+	:return: the outcome, see :py:func:`run`
+	:raises R2EError: if the book name is already used by other books of the batch
+	"""
+	position, (url, is_respec) = numbered_entry
+	result = {
+		"url"        : url,
+		"type"       : RESPEC if is_respec else HTML,
+		"success"    : False,
+		"short_name" : None,
+		"book"       : None,
+		"error"      : None
+	}
+	start = time.time()
+	# noinspection PyBroadException
+	try:
+		with DocWrapper(url, is_respec=is_respec, **_options) as wrapper:
+			if wrapper.package or wrapper.folder:
+				short_name = wrapper.document.short_name
+				for name in (short_name, "%s-%s" % (short_name, position)):
+					if _claim(name):
+						wrapper.book_name = name
+						break
+				else:
+					raise R2EError("The books of the batch already use the names '%s' and '%s-%s'" % (short_name, short_name, position))
+				if wrapper.book_name != short_name and _options.get("logger") is not None:
+					_options["logger"].warning("Another book of the batch is named '%s'; the book of '%s' is named '%s'" % (short_name, url, wrapper.book_name))
+			wrapper.process()
+			result["success"]    = True
+			result["short_name"] = wrapper.document.short_name
+			if wrapper.package:
+				result["book"] = wrapper.book_file_name
+	except Exception:
+		result["error"] = traceback.format_exc()
+		if _options.get("logger") is not None:
+			_options["logger"].critical("Exception has been raised for '%s':\n%s" % (url, result["error"]))
+	result["seconds"] = round(time.time() - start, 3)
+	return result
+
+
+def run(entries, processes=BATCH_PROCESSES, **options):
+	"""
+	Generate the books of a list of sources.
+
+	:param entries: list of ``(url, is_respec)`` pairs (see :py:func:`read_list`)
+	:param int processes: number of processes generating the books; 1 means that the books are generated in the current process
+	:param options: further keyword arguments for the :py:class:`.doc2epub.DocWrapper` instances (e.g., ``package``, ``cache_dir``, or ``logger``); if ``cache_dir`` is not set, a temporary cache directory is used for the batch
+	:return: a summary of the batch, as a dictionary: the number of ``processes``, the total time in ``seconds``, the number of books ``succeeded`` and ``failed``, and the outcome of each source (in ``books``, in the order of the list) with the ``url``, the ``type`` (``respec`` or ``html``), ``success``, the ``short_name`` and the ``book`` file name (see above for the books with the same short name), the ``error`` message of a failure, and the generation time in ``seconds``
+	"""
+	temporary_cache = None
+	if options.get("cache_dir") is None:
+		temporary_cache = options["cache_dir"] = tempfile.mkdtemp(prefix="rp2epub-cache-")
+	claims = tempfile.mkdtemp(prefix="rp2epub-names-")
+	numbered_entries = list(enumerate(entries, 1))
+
+	start = time.time()
+	try:
+		if processes <= 1:
+			_initialize(options, claims)
+			results = map(_build, numbered_entries)
+		else:
+			pool = multiprocessing.Pool(processes, _initialize, (options, claims))
+			try:
+				results = pool.map_async(_build, numbered_entries, chunksize=1).get(_FOREVER)
+			finally:
+				pool.terminate()
+				pool.join()
+	finally:
+		if temporary_cache is not None:
+			shutil.rmtree(temporary_cache, ignore_errors=True)
+		shutil.rmtree(claims, ignore_errors=True)
+
+	succeeded = len([result for result in results if result["success"]])
+	return {
+		"processes" : processes,
+		"seconds"   : round(time.time() - start, 3),
+		"succeeded" : succeeded,
+		"failed"    : len(results) - succeeded,
+		"books"     : results
+	}
@@ -0,0 +1,181 @@
+"""
+The compression policy of the book decides, for each file, how it is compressed in the EPUB package. A policy is a list
+of rules, each mapping media types and, possibly, a size limit to a compression method:
+
+* ``stored``: no compression
+* ``fast``: deflate with the fastest compression level of ``zlib``
+* ``default``: deflate with the default compression level of ``zlib``
+* ``max``: deflate with the maximum compression level of ``zlib``
+* ``zopfli``: optimal deflate compression with `zopfli <https://pypi.python.org/pypi/zopfli>`__; it yields
+  (slightly) smaller files than ``max`` but is much slower, i.e., it is meant for archival builds. It requires the (optional)
+  zopfli package to be installed. The content of the file is collected in memory before compression; if it turns out
+  to be larger than :py:data:`.config.ZOPFLI_MAX_SIZE`, the ``max`` method is used instead.
+
+The rules are tried in order, and the first matching rule is used; if no rule matches, the ``default`` method is used.
+Whatever the rule, a file is stored uncompressed if a (fast) compression of its first chunk does not make that chunk
+any smaller, i.e., if its content is already compressed. The check is not done for small files (see
+:py:data:`.config.COMPRESSION_PROBE_MIN_SIZE`): these are compressed as set by the rule.
+
+The predefined policies are listed in :py:data:`.config.COMPRESSION_POLICIES`.
+
+.. py:data:: METHODS
+
+  The names of the compression methods.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import zlib
+
+from . import R2EError
+from .config import COMPRESSION_POLICIES, WRITE_CHUNK_SIZE, ZOPFLI_MAX_SIZE, COMPRESSION_PROBE_MIN_SIZE
+
+try:
+	import zopfli.zlib
+except ImportError:
+	zopfli = None
+
+STORED  = "stored"
+FAST    = "fast"
+DEFAULT = "default"
+MAX     = "max"
+ZOPFLI  = "zopfli"
+
+METHODS = [STORED, FAST, DEFAULT, MAX, ZOPFLI]
+
+_LEVELS = {
+	STORED  : 0,
+	FAST    : 1,
+	DEFAULT : zlib.Z_DEFAULT_COMPRESSION,
+	MAX     : 9
+}
+
+
+# noinspection PyPep8
+class _ZopfliCompressor(object):
+	"""
+	Compressor object with the same interface as the ones returned by ``zlib.compressobj``; the content is collected
+	and compressed by zopfli when the compressor is flushed (or by ``zlib``, with the maximum compression level, if
+	the content is larger than :py:data:`.config.ZOPFLI_MAX_SIZE`).
+	"""
+	def __init__(self):
+		self._pieces = []
+		self._size   = 0
+
+	def compress(self, data):
+		self._pieces.append(data)
+		self._size += len(data)
+		return ""
+
+	# noinspection PyUnusedLocal
+	def flush(self, mode=zlib.Z_FINISH):
+		# zopfli produces a zlib container; the raw deflate stream is between the 2 bytes header and the 4 bytes checksum
+		content = "".join(self._pieces)
+		self._pieces = []
+		if self._size > ZOPFLI_MAX_SIZE:
+			fallback = zlib.compressobj(_LEVELS[MAX], zlib.DEFLATED, -15)
+			return fallback.compress(content) + fallback.flush()
+		return zopfli.zlib.compress(content)[2:-4]
+
+
+def compressor(method):
+	"""
+	Get a compressor object producing a raw deflate stream (as used in zip archives). For the ``stored`` method, the
+	stream consists of uncompressed blocks; this is used for a stored entry whose size cannot be set in its local header
+	(see :py:class:`.zipstream.CountingStream`), the deflate stream being self-delimiting.
+
+	:param str method: the compression method
+	:return: an object with the interface of the objects returned by ``zlib.compressobj``
+	"""
+	if method == ZOPFLI:
+		return _ZopfliCompressor()
+	return zlib.compressobj(_LEVELS[method], zlib.DEFLATED, -15)
+
+
+def splittable(method):
+	"""
+	Whether the compressor of a method can terminate a block of the content with a "sync flush", i.e., whether the
+	content can be compressed in separate blocks (see :py:class:`.zipstream.ParallelDeflater`).
+
+	:param str method: the compression method
+	:rtype: boolean
+	"""
+	return method != ZOPFLI
+
+
+def shrinks(sample):
+	"""
+	Check whether the compression of a file is worth it, using a sample of the content: the first chunk of the
+	content is compressed with the fastest compression level. A sample smaller than
+	:py:data:`.config.COMPRESSION_PROBE_MIN_SIZE` is not checked: the compression of a few bytes says nothing about the
+	content, and the file is then compressed as set by the compression policy.
+
+	:param str sample: the beginning of the content (only the first :py:data:`.config.WRITE_CHUNK_SIZE` bytes are used)
+	:return: whether the compressed sample is smaller than the sample, or the sample is too small to be checked
+	:rtype: boolean
+	"""
+	sample = sample[:WRITE_CHUNK_SIZE]
+	if len(sample) < COMPRESSION_PROBE_MIN_SIZE:
+		return True
+	probe = zlib.compressobj(1, zlib.DEFLATED, -15)
+	return len(probe.compress(sample)) + len(probe.flush()) < len(sample)
+
+
+# noinspection PyPep8
+class CompressionPolicy(object):
+	"""
+	A compression policy, i.e., a list of rules choosing the compression method of each file.
+
+	:param rules: list of ``(media_types, max_size, method)`` tuples. ``media_types`` is a media type, a pattern like ``image/*``,
+	 ``*`` for all media types, or a list of those; ``max_size`` is the maximum size (in bytes) of the files the rule applies to,
+	 or `None` for no limit (a rule with a size limit also applies to files whose size is not known in advance, e.g., to
+	 the serialization of an XHTML document); ``method`` is the name of a compression method (see :py:data:`METHODS`).
+	:raises R2EError: if a method is unknown, or cannot be used (i.e., zopfli is not installed)
+	"""
+	def __init__(self, rules):
+		for media_types, max_size, method in rules:
+			if method not in METHODS:
+				raise R2EError("Unknown compression method '%s'" % method)
+			if method == ZOPFLI and zopfli is None:
+				raise R2EError("The 'zopfli' compression method requires the zopfli package, which is not installed")
+		self._rules = rules
+
+	@staticmethod
+	def _matches(media_types, media_type):
+		if isinstance(media_types, basestring):
+			media_types = [media_types]
+		for pattern in media_types:
+			if pattern == "*" or pattern == media_type:
+				return True
+			if media_type is not None and pattern.endswith("/*") and media_type.startswith(pattern[:-1]):
+				return True
+		return False
+
+	def method(self, media_type, size=None):
+		"""
+		The compression method of a file.
+
+		:param str media_type: media type of the file, `None` if unknown
+		:param int size: size of the file in bytes, `None` if unknown
+		:return: the name of the method
+		"""
+		for media_types, max_size, method in self._rules:
+			if self._matches(media_types, media_type) and (max_size is None or size is None or size <= max_size):
+				return method
+		return DEFAULT
+
+
+def get_policy(name):
+	"""
+	Get a predefined compression policy by its name.
+
+	:param str name: the name of the policy, a key in :py:data:`.config.COMPRESSION_POLICIES`
+	:return: a :py:class:`CompressionPolicy` instance
+	:raises R2EError: if the policy is unknown, or cannot be used
+	"""
+	if name not in COMPRESSION_POLICIES:
+		raise R2EError("Unknown compression policy '%s'" % name)
+	return CompressionPolicy(COMPRESSION_POLICIES[name])
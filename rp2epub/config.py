@@ -46,6 +46,150 @@ Various configuration variables.
    may have to be downloaded to the book. (In general, only essentially relative references are considered for download, global
    references are not. There are some exceptions, e.g., W3C specific stylesheets or images.)
 
+.. py:data:: DOWNLOAD_WORKERS
+
+   Default number of resources that may be downloaded in parallel when building a book.
+
+.. py:data:: DOWNLOAD_PER_HOST
+
+   Default number of resources that may be downloaded in parallel from the same host.
+
+.. py:data:: HTTP_CACHE_SIZE
+
+   Default maximum size (in bytes) of the content stored in the disk based HTTP cache.
+
+.. py:data:: CSS_PARSE_CACHE_ENTRIES
+
+   Maximum number of parsed CSS contents whose results are kept in memory.
+
+.. py:data:: CONVERSION_CACHE_ENTRIES
+
+   Maximum number of ReSpec conversion results kept in the conversion cache (see :py:class:`.converters.ConversionCache`);
+   the least recently used results are removed first.
+
+.. py:data:: CSS_PARSER
+
+   Default parser used to extract the references from CSS contents: ``tinycss`` (full parse) or ``scanner`` (scan of the
+   ``@import`` rules and ``url(...)`` tokens only, see :py:data:`.cssurls.CSS_PARSERS`).
+
+.. py:data:: TREE_ENGINE
+
+   Default engine used to parse the HTML sources and to serialize the XHTML output: ``etree`` (standard library) or
+   ``lxml`` (faster, requires the lxml package); see :py:data:`.engines.ENGINES`.
+
+.. py:data:: ALREADY_COMPRESSED
+
+   Media types whose content is already compressed; the corresponding files are stored in the book without compression.
+
+.. py:data:: COMPRESSION_POLICIES
+
+   The predefined compression policies of the book, keyed by their names; each is a list of rules mapping media types
+   and size limits to compression methods (see the :py:mod:`.compression` module):
+
+   ``speed``
+     Fast compression, e.g., for interactive builds.
+   ``default``
+     The default compression level of ``zlib``.
+   ``size``
+     Maximum compression level of ``zlib``, e.g., for files served for download.
+   ``archival``
+     Optimal compression with zopfli for files up to :py:data:`ZOPFLI_MAX_SIZE`, maximum ``zlib`` compression level
+     otherwise. Requires the zopfli package.
+
+   The files of :py:data:`ALREADY_COMPRESSED` media types are stored without compression in all policies.
+
+.. py:data:: COMPRESSION_POLICY
+
+   Default compression policy, a key in :py:data:`COMPRESSION_POLICIES`.
+
+.. py:data:: ZOPFLI_MAX_SIZE
+
+   Maximum size (in bytes) of the files compressed by zopfli; larger files are compressed by ``zlib`` instead, with the maximum
+   compression level (zopfli is slow, and it needs the full content in memory).
+
+.. py:data:: COMPRESSION_PROBE_MIN_SIZE
+
+   Minimum size (in bytes) of the first chunk of a file for checking whether the compression of the file is worth it; smaller
+   files are compressed as set by the compression policy, whatever their content (see :py:func:`.compression.shrinks`).
+
+.. py:data:: COMPRESS_WORKERS
+
+   Default number of threads compressing the content of the book; a value of 1 means that the content is compressed
+   serially (see :py:class:`.zipstream.ParallelDeflater`).
+
+.. py:data:: WRITE_CHUNK_SIZE
+
+   Size (in bytes) of the chunks in which the content of a file is written into the book when the content is
+   streamed (see :py:class:`.zipstream.ChunkedWriter`).
+
+.. py:data:: BUFFER_MEMORY_LIMIT
+
+   Maximum size (in bytes) of a retrieved content that is kept in memory until it is written into the book; larger contents
+   (e.g., videos) are spooled into a temporary file and copied into the book in chunks (see :py:meth:`.utils.HttpSession.buffer`).
+
+.. py:data:: CONNECTION_POOL_SIZE
+
+   Maximum number of idle, persistent HTTP connections kept per host.
+
+.. py:data:: CONNECTION_IDLE_TIMEOUT
+
+   Number of seconds after which an idle, persistent HTTP connection is closed.
+
+.. py:data:: BATCH_PROCESSES
+
+   Default number of processes generating the books of a batch (see :py:func:`.batch.run`).
+
+.. py:data:: SERVICE_WORKERS
+
+   Default number of books generated at the same time by the HTTP service (see :py:class:`.service.EPUBService`); further
+   requests wait for a free worker.
+
+.. py:data:: SERVICE_HOST
+
+   Default host name (interface) the HTTP service listens on.
+
+.. py:data:: SERVICE_PORT
+
+   Default port the HTTP service listens on.
+
+.. py:data:: SERVICE_WAIT_TIMEOUT
+
+   Default time (in seconds) a request to the HTTP service waits for the generation of the same book, started by a
+   concurrent request, to complete; the request fails if the generation takes longer.
+
+.. py:data:: SERVICE_SPOOL_LIMIT
+
+   Maximum size (in bytes) of a book kept in memory by the HTTP service for the concurrent requests waiting for it, if
+   the book is sent out progressively and it is not stored in an output cache; larger books are spooled into a
+   temporary file (see :py:class:`.service.EPUBService`).
+
+.. py:data:: JOB_WORKERS
+
+   Default number of books generated at the same time by the asynchronous jobs of the HTTP service (see :py:class:`.jobs.JobQueue`).
+
+.. py:data:: JOB_QUEUE_SIZE
+
+   Default maximum number of jobs waiting for, or being generated by, the job workers; further submissions are rejected
+   (with a ``429`` response) until some jobs are completed.
+
+.. py:data:: JOB_RETRY_AFTER
+
+   Time (in seconds) a client is asked to wait, in the ``Retry-After`` header of a ``429`` response, before submitting a job again.
+
+.. py:data:: JOB_RETENTION
+
+   Time (in seconds) the completed jobs, and their books, are kept in the job store.
+
+.. py:data:: OUTPUT_CACHE_SIZE
+
+   Default size cap (in bytes) of the cache of the books generated by the HTTP service (see :py:class:`.outputcache.OutputCache`);
+   the books generated from immutable sources are not counted.
+
+.. py:data:: IMMUTABLE_SOURCES
+
+   Regular expressions matching the URLs of immutable sources, i.e., the dated versions of the W3C Technical Reports; the books
+   generated from these are cached permanently by the HTTP service.
+
 .. py:data:: DATE_FORMAT_STRING
 
    Format string to be used with date specific methods to ensure the required date format.
@@ -118,6 +262,91 @@ TO_TRANSFER = [
 	("http://www.w3.org/StyleSheets/TR/base.css", "StyleSheets/TR/base.css")
 ]
 
+# Default limits for the parallel download of resources; see the Downloader class.
+DOWNLOAD_WORKERS  = 8
+DOWNLOAD_PER_HOST = 4
+
+# Default size cap of the HTTP cache; see the HttpCache class.
+HTTP_CACHE_SIZE = 256 * 1024 * 1024
+
+# Maximum number of in-memory entries of the CSS parse cache; see the CSSParseCache class.
+CSS_PARSE_CACHE_ENTRIES = 256
+
+# Maximum number of entries of the ReSpec conversion cache; see the ConversionCache class.
+CONVERSION_CACHE_ENTRIES = 100
+
+# Default parser extracting the references from CSS contents; see the CSS_PARSERS dictionary in cssurls.
+CSS_PARSER = "tinycss"
+
+# Default tree engine for parsing and serialization; see the ENGINES dictionary in engines.
+TREE_ENGINE = "etree"
+
+# Media types that should not be compressed in the book
+ALREADY_COMPRESSED = [
+	"image/png",
+	"image/jpeg",
+	"image/gif",
+	"application/font-woff",
+	"audio/mpeg",
+	"video/mp4",
+	"video/webm",
+	"video/ogg"
+]
+
+# Size limit for the zopfli compression; see the compression module.
+ZOPFLI_MAX_SIZE = 4 * 1024 * 1024
+
+# Size limit below which the compression of a file is not checked; see the compression module.
+COMPRESSION_PROBE_MIN_SIZE = 1024
+
+# noinspection PyPep8
+# Compression policies: lists of (media types, maximum size, method) rules; see the CompressionPolicy class.
+COMPRESSION_POLICIES = {
+	"speed"    : [(ALREADY_COMPRESSED, None, "stored"), ("*", None, "fast")],
+	"default"  : [(ALREADY_COMPRESSED, None, "stored"), ("*", None, "default")],
+	"size"     : [(ALREADY_COMPRESSED, None, "stored"), ("*", None, "max")],
+	"archival" : [(ALREADY_COMPRESSED, None, "stored"), ("*", ZOPFLI_MAX_SIZE, "zopfli"), ("*", None, "max")]
+}
+
+COMPRESSION_POLICY = "default"
+
+# Default number of threads compressing the book's content; see the ParallelDeflater class.
+COMPRESS_WORKERS = 1
+
+# Size of the chunks written into the book when streaming; see the ChunkedWriter class.
+WRITE_CHUNK_SIZE = 64 * 1024
+
+# Size limit of the retrieved contents kept in memory; see the HttpSession.buffer method.
+BUFFER_MEMORY_LIMIT = 1024 * 1024
+
+# Limits for the persistent HTTP connections; see the ConnectionPool class.
+CONNECTION_POOL_SIZE    = 4
+CONNECTION_IDLE_TIMEOUT = 30
+
+# Default number of processes generating the books of a batch; see the batch.run function.
+BATCH_PROCESSES = 4
+
+# Settings of the long-running HTTP service; see the EPUBService class.
+SERVICE_WORKERS = 4
+SERVICE_HOST    = "localhost"
+SERVICE_PORT    = 8080
+
+# Concurrent requests for the same book wait for the same generation; see the EPUBService class.
+SERVICE_WAIT_TIMEOUT = 300
+
+# Size limit of a progressively sent book kept in memory for the concurrent requests; see the EPUBService class.
+SERVICE_SPOOL_LIMIT = 1024 * 1024
+
+# Asynchronous jobs of the HTTP service; see the JobQueue class.
+JOB_WORKERS     = 2
+JOB_QUEUE_SIZE  = 20
+JOB_RETRY_AFTER = 30
+JOB_RETENTION   = 24 * 3600
+
+# Cache of the books generated by the HTTP service; see the OutputCache class.
+OUTPUT_CACHE_SIZE = 512 * 1024 * 1024
+IMMUTABLE_SOURCES = [r"^https?://www\.w3\.org/TR/\d{4}/"]
+
 # noinspection PyPep8
 PADDING_NEW_STYLE = {
 	2015: "2em 1em 2em 70px;",
@@ -0,0 +1,217 @@
+"""
+Persistent (keep-alive) HTTP connections for :py:class:`.utils.HttpSession`. The standard ``urllib2`` handlers open a new
+TCP (and, for HTTPS, TLS) connection for each request, and close it afterwards. However, the resources of a book
+come from a handful of hosts only (``www.w3.org``, the host of the document, the spec generator), i.e., most of those
+connections could be reused.
+
+The :py:class:`ConnectionPool` class keeps the idle connections, per host; the handlers defined in this module take a
+connection from the pool when a request is made, and put it back into the pool when the response has been read to the end.
+The number of idle connections per host is limited, and connections that have been idle for too long are closed.
+
+The module level :py:data:`pool` is shared by all retrievals of a process, i.e., connections are also reused across books in a
+long running process; :py:data:`opener` is the ``urllib2`` opener using that pool.
+
+.. py:data:: pool
+
+  The :py:class:`ConnectionPool` instance used by :py:data:`opener`.
+
+.. py:data:: opener
+
+  A ``urllib2`` opener (see :py:func:`urllib2.build_opener`) using persistent connections from :py:data:`pool`.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import time
+import socket
+import threading
+import httplib
+import urllib2
+from urllib import addinfourl
+
+from .config import CONNECTION_POOL_SIZE, CONNECTION_IDLE_TIMEOUT
+
+
+# noinspection PyPep8
+class ConnectionPool(object):
+	"""
+	Pool of idle, persistent HTTP connections, keyed by scheme and host.
+
+	:param int max_per_host: maximum number of idle connections kept per host
+	:param int idle_timeout: number of seconds after which an idle connection is closed
+	"""
+	def __init__(self, max_per_host=CONNECTION_POOL_SIZE, idle_timeout=CONNECTION_IDLE_TIMEOUT):
+		self._max_per_host = max_per_host
+		self._idle_timeout = idle_timeout
+		self._idle         = {}
+		self._lock         = threading.Lock()
+
+	def acquire(self, key, factory):
+		"""
+		Get a connection for a host: the most recently used idle connection, or a new one.
+
+		:param key: ``(scheme, host)`` pair
+		:param factory: function without arguments returning a new (not yet connected) connection
+		:return: a tuple of the connection and a flag whether the connection has been reused
+		"""
+		with self._lock:
+			self._evict()
+			idle = self._idle.get(key, [])
+			if len(idle) > 0:
+				return idle.pop()[0], True
+		return factory(), False
+
+	def release(self, key, connection):
+		"""
+		Put a connection, whose last response has been read to the end, back into the pool.
+
+		:param key: ``(scheme, host)`` pair
+		:param connection: the connection
+		:type connection: :py:class:`httplib.HTTPConnection`
+		"""
+		with self._lock:
+			idle = self._idle.setdefault(key, [])
+			if len(idle) < self._max_per_host:
+				idle.append((connection, time.time()))
+				return
+		connection.close()
+
+	def clear(self):
+		"""
+		Close all idle connections.
+		"""
+		with self._lock:
+			for idle in self._idle.values():
+				for connection, used in idle:
+					connection.close()
+			self._idle = {}
+
+	def _evict(self):
+		"""Close the connections that have been idle for too long; must be called with the lock held."""
+		limit = time.time() - self._idle_timeout
+		for key, idle in self._idle.items():
+			while len(idle) > 0 and idle[0][1] < limit:
+				idle.pop(0)[0].close()
+
+
+# noinspection PyPep8
+class _PooledResponse(object):
+	"""
+	Wrapper around an :py:class:`httplib.HTTPResponse`: when the response has been read to the end, the connection is
+	put back into the pool (or closed, if the server does not keep the connection alive).
+
+	:param response: the response
+	:param pool: the connection pool
+	:param key: ``(scheme, host)`` pair
+	:param connection: the connection used for the response
+	"""
+	def __init__(self, response, pool, key, connection):
+		self._response   = response
+		self._pool       = pool
+		self._key        = key
+		self._connection = connection
+		if response.length == 0:
+			# e.g., a 304 response: nothing to read, the connection can be reused right away
+			response.read()
+			self._done()
+
+	def read(self, amt=None):
+		data = self._response.read(amt)
+		if self._response.isclosed():
+			self._done()
+		return data
+
+	# socket._fileobject relies on this name
+	recv = read
+
+	def close(self):
+		if self._connection is not None:
+			# The response has not been read to the end; the connection cannot be reused
+			self._connection.close()
+			self._connection = None
+		self._response.close()
+
+	def _done(self):
+		if self._connection is not None:
+			if self._response.will_close:
+				self._connection.close()
+			else:
+				self._pool.release(self._key, self._connection)
+			self._connection = None
+
+
+# noinspection PyPep8
+class _PooledHandlerMixin(object):
+	"""
+	Common part of the HTTP and HTTPS handlers: execute a request on a pooled connection.
+	"""
+	def _pooled_open(self, scheme, connection_class, req, **kwargs):
+		host = req.get_host()
+		if not host:
+			raise urllib2.URLError('no host given')
+
+		headers = dict(req.unredirected_hdrs)
+		headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+		headers["Connection"] = "keep-alive"
+		headers = dict((name.title(), val) for name, val in headers.items())
+
+		key = (scheme, host)
+		while True:
+			connection, reused = self._pool.acquire(key, lambda: connection_class(host, timeout=req.timeout, **kwargs))
+			try:
+				connection.request(req.get_method(), req.get_selector(), req.data, headers)
+				response = connection.getresponse(buffering=True)
+				break
+			except (socket.error, httplib.HTTPException) as err:
+				connection.close()
+				# An idle connection may have been closed by the server in the meantime; try again with another one
+				if not reused:
+					raise urllib2.URLError(err)
+
+		fp = socket._fileobject(_PooledResponse(response, self._pool, key, connection), close=True)
+		resp = addinfourl(fp, response.msg, req.get_full_url())
+		resp.code = response.status
+		resp.msg  = response.reason
+		return resp
+
+
+# noinspection PyPep8
+class PooledHTTPHandler(_PooledHandlerMixin, urllib2.HTTPHandler):
+	"""
+	``urllib2`` handler for ``http`` URL-s using persistent connections.
+
+	:param pool: the connection pool
+	:type pool: :py:class:`ConnectionPool`
+	"""
+	def __init__(self, pool):
+		urllib2.HTTPHandler.__init__(self)
+		self._pool = pool
+
+	def http_open(self, req):
+		return self._pooled_open("http", httplib.HTTPConnection, req)
+
+
+# noinspection PyPep8
+class PooledHTTPSHandler(_PooledHandlerMixin, urllib2.HTTPSHandler):
+	"""
+	``urllib2`` handler for ``https`` URL-s using persistent connections. (Requests tunneled through a proxy use
+	the standard, non persistent, connections.)
+
+	:param pool: the connection pool
+	:type pool: :py:class:`ConnectionPool`
+	"""
+	def __init__(self, pool):
+		urllib2.HTTPSHandler.__init__(self)
+		self._pool = pool
+
+	def https_open(self, req):
+		if getattr(req, "_tunnel_host", None):
+			return urllib2.HTTPSHandler.https_open(self, req)
+		return self._pooled_open("https", httplib.HTTPSConnection, req, context=self._context)
+
+
+pool   = ConnectionPool()
+opener = urllib2.build_opener(PooledHTTPHandler(pool), PooledHTTPSHandler(pool))
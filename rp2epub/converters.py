@@ -0,0 +1,242 @@
+"""
+A ReSpec source has to be converted into HTML before the EPUB generation. The conversion is done by a converter
+backend:
+
+* :py:class:`RemoteConverter`: a spec generator service, i.e., the W3C service at :py:data:`CONVERTER` by default, or any
+  other instance of the service (e.g., a local stub server, returning canned results, for tests)
+* :py:class:`CommandConverter`: a local command (e.g., a local installation of ReSpec), writing the HTML result on its
+  standard output
+
+The conversion is the slowest step of the generation, and it yields the same result as long as the source does not
+change. The results are therefore cached (see :py:class:`ConversionCache`), keyed by the URL of the source (without
+its query string), the ReSpec configuration overrides in the query string of the URL (see
+:py:attr:`.DocWrapper.url_respec_setting`), the converter, and the validators (``ETag``, ``Last-Modified``) returned by
+a ``HEAD`` request on the source. I.e., an unchanged source is not converted again; a source whose server returns no
+validators is converted each time.
+
+.. py:data:: conversion_cache
+
+  The :py:class:`ConversionCache` instance used by :py:func:`convert`. Its directory may be set by the :py:class:`.DocWrapper` instance.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import os
+import os.path
+import json
+import shlex
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+from . import R2EError
+from .utils import HttpSession, Logger
+from .outputcache import OutputCache
+from .config import CONVERSION_CACHE_ENTRIES
+
+#: URI of the service used to convert a ReSpec source onto an HTML file on the fly. This service is used
+#: by this script to convert ReSpec sources into HTML before EPUB3 generation.
+CONVERTER = "https://labs.w3.org/spec-generator/?type=respec&url="
+
+
+# noinspection PyPep8
+class RemoteConverter(object):
+	"""
+	Conversion through a spec generator service: the URL of the source is appended to the URL of the service.
+
+	:param str service: the URL of the service, up to (and including) the ``url=`` query parameter
+	"""
+	def __init__(self, service=CONVERTER):
+		self._service = service
+
+	@property
+	def name(self):
+		"""Identification of the converter (part of the key of the cached results)"""
+		return self._service
+
+	def convert(self, url):
+		"""
+		Convert a ReSpec source.
+
+		:param str url: the URL of the source
+		:return: the HTML content
+		:rtype: str
+		:raises R2EError: if the service cannot be reached, or it returns an error
+		"""
+		session = HttpSession(self._service + url, raise_exception=True, is_respec=True)
+		return session.data.read()
+
+
+# noinspection PyPep8
+class CommandConverter(object):
+	"""
+	Conversion through a local command, writing the HTML result on its standard output.
+
+	:param str command: the command line; it is split like a shell command line (without any shell expansion). The
+	 ``{url}`` strings in the arguments are replaced by the URL of the source; if there is none, the URL is added as a last argument.
+	"""
+	def __init__(self, command):
+		self._command = command
+		self._args    = shlex.split(command)
+
+	@property
+	def name(self):
+		"""Identification of the converter (part of the key of the cached results)"""
+		return self._command
+
+	def convert(self, url):
+		"""
+		Convert a ReSpec source.
+
+		:param str url: the URL of the source
+		:return: the HTML content
+		:rtype: str
+		:raises R2EError: if the command cannot be run, or it ends with a non-zero status
+		"""
+		if any("{url}" in arg for arg in self._args):
+			args = [arg.replace("{url}", url) for arg in self._args]
+		else:
+			args = self._args + [url]
+		try:
+			process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			content, errors = process.communicate()
+		except OSError as e:
+			raise R2EError("The conversion command '%s' cannot be run: %s" % (self._command, e))
+		if process.returncode != 0:
+			raise R2EError("The conversion command '%s' failed with status %s: %s" % (self._command, process.returncode, errors.strip()))
+		return content
+
+
+# noinspection PyPep8
+class ConversionCache(object):
+	"""
+	Disk based cache of the results of the ReSpec conversions. Each result is stored in a file, named after the hash of
+	its key; at most :py:data:`.config.CONVERSION_CACHE_ENTRIES` results are kept, the least recently used results are
+	removed first. Files are written under a temporary name and renamed when complete, so several processes may share
+	the same directory.
+
+	:param str directory: directory of the cache; `None` means no caching
+	:param int max_entries: maximum number of results kept
+	"""
+	def __init__(self, directory=None, max_entries=CONVERSION_CACHE_ENTRIES):
+		self._max_entries = max_entries
+		self._lock        = threading.Lock()
+		self.directory    = directory
+
+	@property
+	def directory(self):
+		"""Directory of the cache (created if necessary when set); `None` means no caching"""
+		return self._directory
+
+	@directory.setter
+	def directory(self, directory):
+		if directory is not None and not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				# another process may have created it in the meantime
+				if not os.path.isdir(directory):
+					raise
+		self._directory = directory
+
+	@staticmethod
+	def key(url, converter, fingerprint):
+		"""
+		The key of a conversion result.
+
+		:param str url: the URL of the source
+		:param converter: the converter
+		:param str fingerprint: the fingerprint of the source (see :py:meth:`.outputcache.OutputCache.fingerprint`)
+		:rtype: str
+		"""
+		return json.dumps([OutputCache.key(url, True), converter.name, fingerprint])
+
+	def _path(self, key):
+		return os.path.join(self._directory, hashlib.sha1(key).hexdigest() + ".html")
+
+	def lookup(self, key):
+		"""
+		Get a conversion result; the result is marked as recently used.
+
+		:param str key: the key of the result (see :py:meth:`key`)
+		:return: the HTML content, or `None` if it is not in the cache
+		"""
+		if self._directory is None:
+			return None
+		path = self._path(key)
+		try:
+			with open(path, "rb") as f:
+				content = f.read()
+			os.utime(path, None)
+		except (IOError, OSError):
+			return None
+		return content
+
+	def store(self, key, content):
+		"""
+		Store a conversion result, and remove the least recently used results if there are too many.
+
+		:param str key: the key of the result (see :py:meth:`key`)
+		:param str content: the HTML content
+		"""
+		if self._directory is None:
+			return
+		try:
+			fd, temp = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+			with os.fdopen(fd, "wb") as f:
+				f.write(content)
+			os.rename(temp, self._path(key))
+			with self._lock:
+				self._evict()
+		except (IOError, OSError):
+			# The cache is an optimization only
+			pass
+
+	def _evict(self):
+		entries = []
+		for name in os.listdir(self._directory):
+			if name.endswith(".html"):
+				path = os.path.join(self._directory, name)
+				try:
+					entries.append((os.path.getmtime(path), path))
+				except OSError:
+					continue
+		for used, path in sorted(entries)[:max(0, len(entries) - self._max_entries)]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+
+conversion_cache = ConversionCache()
+
+
+def convert(url, converter):
+	"""
+	Convert a ReSpec source, or get the result of an earlier conversion of the same, unchanged source from the
+	:py:data:`conversion_cache`.
+
+	:param str url: the URL of the source
+	:param converter: the converter (e.g., a :py:class:`RemoteConverter` or a :py:class:`CommandConverter` instance)
+	:return: the HTML content
+	:rtype: str
+	:raises R2EError: if the conversion fails
+	"""
+	key = None
+	if conversion_cache.directory is not None:
+		fingerprint = OutputCache.fingerprint(url)
+		if fingerprint is not None:
+			key     = ConversionCache.key(url, converter, fingerprint)
+			content = conversion_cache.lookup(key)
+			if content is not None:
+				Logger.info("The HTML generated from %s is taken from the conversion cache" % url)
+				return content
+
+	content = converter.convert(url)
+	if key is not None:
+		conversion_cache.store(key, content)
+	return content
@@ -12,8 +12,24 @@ CSS statement of the form::
 
 (Which is the trick used to help in the HTTP vs. HTTPS negotiations in some of the W3C CSS files.)
 The URL reference must be changed, in this case, to a local,
-relative URL. These required cases are gathered by the process and the upper layers use it to make a simple string "replace"
-on the fly when the CSS files are copied to the book.
+relative URL. These required cases are gathered, per CSS file, by the process; the upper layers use a :py:class:`CSSRewriter`
+instance to make the replacements in one pass on the fly when a CSS file is copied to the book. The replacements
+collected from a CSS file are applied on that file only.
+
+Parsing a CSS file is relatively expensive, and the same (official W3C) CSS files are used by most of the documents. The
+references extracted from a CSS content are therefore cached, keyed by the hash of the content; see :py:class:`CSSParseCache`.
+
+Two parsers are available to extract the references (see :py:data:`CSS_PARSERS`): a full parse with tinycss, whose
+rule tree is then walked, and a scanner that only picks the ``@import`` rules and the ``url(...)`` tokens out of
+the content, without building a rule tree. The latter is considerably faster on large style sheets.
+
+.. py:data:: parse_cache
+
+  The :py:class:`CSSParseCache` instance used by all :py:class:`CSSReference` instances. Its directory and its parser may be set by the :py:class:`.DocWrapper` instance.
+
+.. py:data:: CSS_PARSERS
+
+  The functions extracting the references from a CSS content, keyed by the names used to select them: ``tinycss`` and ``scanner``.
 
 .. :class::
 
@@ -22,8 +38,18 @@ Module content
 """
 
 from urlparse import urljoin, urlparse
+from collections import OrderedDict
+import re
+import os
+import os.path
+import json
+import hashlib
+import tempfile
+import threading
 import tinycss
 from .utils import HttpSession, Logger
+from .config import CSS_PARSE_CACHE_ENTRIES, CSS_PARSER
+from . import R2EError
 
 
 class _URLPair(object):
@@ -53,6 +79,300 @@ class _URLPair(object):
 		return "(" + self.name + ", " + self.url + ")"
 
 
+def _extract_references(content):
+	"""
+    Parse a CSS content with tinycss, and extract the references to other resources: the ``@import`` rules, and
+    the ``url`` values in the declarations (on the top level or within ``@media`` rules).
+
+    :param str content: the CSS content
+    :return: a tuple of the list of ``(url, is_import)`` pairs, in the order of appearance, and a boolean whether the parser found errors
+    """
+	def handle_one_css_ruleset(one_ruleset):
+		# This is a basic CSS set of declarations. Each declaration has, potentially, a set of values;
+		# the values themselves may be numbers, strings, etc, and also URI-s
+		# Only the URI-s are of interest at this point.
+		if one_ruleset.at_keyword is None:
+			for d in one_ruleset.declarations:
+				for i in [item for item in d.value if item.type == "URI"]:
+					references.append((i.value, False))
+
+	references = []
+	stylesheet = tinycss.make_parser("page3").parse_stylesheet(content)
+
+	# Go through all the individual rules of the style sheet
+	for rule in stylesheet.rules:
+		# Only the @import and @media rules are of interest; most of the others, like @print, are ignored
+		if rule.at_keyword == "@import":
+			references.append((rule.uri, True))
+
+		elif rule.at_keyword == "@media":
+			for ruleset in rule.rules:
+				handle_one_css_ruleset(ruleset)
+
+		elif rule.at_keyword is None:
+			handle_one_css_ruleset(rule)
+
+	return references, stylesheet.errors is not None and len(stylesheet.errors) > 0
+
+
+# Lexical macros of the CSS 2.1 grammar, used by the scanner
+_ESCAPE     = r'\\(?:[0-9a-f]{1,6}(?:\r\n|[ \n\r\t\f])?|[^\n\r\f0-9a-f])'
+_STRING     = r'"(?:[^\n\r\f\\"]|\\(?:\r\n|[\n\r\f])|%s)*"|\'(?:[^\n\r\f\\\']|\\(?:\r\n|[\n\r\f])|%s)*\'' % (_ESCAPE, _ESCAPE)
+_URL        = r'url\([ \t\r\n\f]*(?:%s|(?:[!#$%%&*-\[\]-~]|[^\x00-\x7f]|%s)*)[ \t\r\n\f]*\)' % (_STRING, _ESCAPE)
+_BAD_STRING = r'"(?:[^\n\r\f\\"]|\\.)*|\'(?:[^\n\r\f\\\']|\\.)*'
+
+# The tokens that matter for the references; everything else is skipped by the regular expression engine
+_TOKENS = re.compile(
+	r'(?P<comment>/\*.*?(?:\*/|\Z))|(?P<string>%s)|(?P<bad_string>%s)|(?<![-\w\\])(?P<url>%s)|@(?P<at>[-\w]+)|(?P<open>{)|(?P<close>})|(?P<end>;)'
+	% (_STRING, _BAD_STRING, _URL),
+	re.I | re.S | re.U
+)
+
+# The target of an @import rule, possibly preceded by white spaces and comments
+_IMPORT_TARGET = re.compile(r'(?:[ \t\r\n\f]|/\*.*?\*/)*(?:(?P<string>%s)|(?P<url>%s))' % (_STRING, _URL), re.I | re.S | re.U)
+
+_UNESCAPE = re.compile(r'\\(?:([0-9a-fA-F]{1,6})(?:\r\n|[ \n\r\t\f])?|(\r\n|[\n\r\f])|(.))', re.S)
+
+
+def _unescape(value):
+	"""
+    Replace the CSS escapes in a string or URL value by the characters they stand for; an escaped new line (i.e., a string
+    continuation) is removed.
+
+    :param str value: the value, without the quotes or the ``url(...)`` wrapper
+    :return: the unescaped value
+    """
+	def replace(match):
+		if match.group(1) is not None:
+			try:
+				return unichr(int(match.group(1), 16))
+			except (ValueError, OverflowError):
+				return u'\ufffd'
+		elif match.group(2) is not None:
+			return u''
+		else:
+			return match.group(3)
+	return _UNESCAPE.sub(replace, value) if '\\' in value else value
+
+
+def _token_value(token):
+	"""
+    The value of a string or of a ``url(...)`` token: quotes and the ``url(...)`` wrapper are removed, and the value is unescaped.
+
+    :param str token: the token, as it appears in the CSS content
+    :return: the value
+    """
+	if token[:4].lower() == 'url(':
+		token = token[4:-1].strip(' \t\r\n\f')
+	if len(token) > 1 and token[0] in '"\'':
+		token = token[1:-1]
+	return _unescape(token)
+
+
+def _scan_references(content):
+	"""
+    Extract the references to other resources from a CSS content without building a rule tree: a streaming scan picks
+    out the (valid) ``@import`` rules and the ``url(...)`` tokens, skipping comments and strings. The ``url(...)`` tokens in the
+    prelude of other at-rules (e.g., the namespace URI of ``@namespace``, or a condition of ``@supports``) are not references
+    to resources, and are ignored. Unlike
+    :py:func:`_extract_references`, the scanner also finds the ``url(...)`` tokens within ``@font-face``, ``@supports``,
+    ``@page``, or nested at-rules. Otherwise, the results of the two functions are identical.
+
+    :param str content: the CSS content
+    :return: a tuple of the list of ``(url, is_import)`` pairs, in the order of appearance, and a boolean whether the scanner found errors
+    """
+	if isinstance(content, str):
+		# Same decoding (BOM, @charset, fallback encodings) as for the full parser
+		content = tinycss.decoding.decode(content)[0]
+
+	references     = []
+	errors         = False
+	depth          = 0
+	# @import rules are valid only on the top level, before any ruleset or at-rule with a block
+	import_allowed = True
+	# Whether the scan is within the prelude of an at-rule (other than @import), i.e., before its block or its ';'
+	prelude        = False
+	position       = 0
+	while True:
+		token = _TOKENS.search(content, position)
+		if token is None:
+			break
+		position = token.end()
+		kind = token.lastgroup
+		if kind == 'url':
+			if not prelude:
+				references.append((_token_value(token.group('url')), False))
+		elif kind == 'at':
+			keyword = token.group('at').lower()
+			if keyword != 'import':
+				prelude = True
+			else:
+				target = _IMPORT_TARGET.match(content, position)
+				if depth == 0 and import_allowed and target is not None:
+					references.append((_token_value(target.group(target.lastgroup)), True))
+					position = target.end()
+				else:
+					# An invalid @import rule is ignored, its target included
+					errors  = True
+					prelude = True
+		elif kind == 'end':
+			prelude = False
+		elif kind == 'open':
+			depth += 1
+			import_allowed = False
+			prelude = False
+		elif kind == 'close':
+			prelude = False
+			if depth > 0:
+				depth -= 1
+			else:
+				errors = True
+		elif kind == 'bad_string':
+			errors = True
+
+	return references, errors or depth != 0
+
+
+CSS_PARSERS = {
+	"tinycss" : _extract_references,
+	"scanner" : _scan_references
+}
+
+
+# noinspection PyPep8
+class CSSParseCache(object):
+	"""
+    Cache of the references extracted from CSS contents (see :py:func:`_extract_references` and :py:func:`_scan_references`), keyed by
+    the hash of the content and by the name of the parser.
+    The results are kept in memory (up to a maximum number of entries, the least recently used entries are dropped first) and,
+    optionally, in a directory, i.e., identical CSS content is parsed only once per process or, with the directory set, once per
+    deployment.
+
+    Note that the references are stored as they appear in the CSS content, i.e., they are not yet resolved
+    against the URL of the CSS file; the same content may be used under different URL-s.
+
+    :param str directory: directory for the on-disk tier of the cache; `None` means in-memory caching only
+    :param int max_entries: maximum number of entries kept in memory
+    :param str parser: name of the parser used to extract the references, a key in :py:data:`CSS_PARSERS`
+    """
+	def __init__(self, directory=None, max_entries=CSS_PARSE_CACHE_ENTRIES, parser=CSS_PARSER):
+		self._memory      = OrderedDict()
+		self._max_entries = max_entries
+		self._lock        = threading.Lock()
+		self.directory    = directory
+		self.parser       = parser
+
+	@property
+	def directory(self):
+		"""Directory for the on-disk tier of the cache (created if necessary when set); `None` means in-memory caching only"""
+		return self._directory
+
+	@directory.setter
+	def directory(self, directory):
+		if directory is not None and not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				# another process may have created it in the meantime
+				if not os.path.isdir(directory):
+					raise
+		self._directory = directory
+
+	@property
+	def parser(self):
+		"""Name of the parser used to extract the references, a key in :py:data:`CSS_PARSERS`"""
+		return self._parser
+
+	@parser.setter
+	def parser(self, parser):
+		if parser not in CSS_PARSERS:
+			raise R2EError("Unknown CSS parser '%s'" % parser)
+		self._parser = parser
+
+	def references(self, content):
+		"""
+        Get the references of a CSS content, either from the cache or by parsing the content.
+
+        :param str content: the CSS content
+        :return: a tuple of the list of ``(url, is_import)`` pairs, and a boolean whether the parser found errors
+        """
+		parser = self._parser
+		key    = parser + '-' + hashlib.sha1(content.encode('utf-8') if isinstance(content, unicode) else content).hexdigest()
+
+		with self._lock:
+			if key in self._memory:
+				value = self._memory.pop(key)
+				self._memory[key] = value
+				return value
+
+		value = self._read(key)
+		if value is None:
+			value = CSS_PARSERS[parser](content)
+			self._write(key, value)
+
+		with self._lock:
+			self._memory[key] = value
+			while len(self._memory) > self._max_entries:
+				self._memory.popitem(last=False)
+		return value
+
+	def _read(self, key):
+		if self._directory is None:
+			return None
+		try:
+			with open(os.path.join(self._directory, key + ".json")) as f:
+				stored = json.load(f)
+			return [(url, is_import) for url, is_import in stored["references"]], stored["errors"]
+		except (IOError, OSError, ValueError, KeyError):
+			return None
+
+	def _write(self, key, value):
+		if self._directory is None:
+			return
+		try:
+			fd, temp = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+			with os.fdopen(fd, "w") as f:
+				json.dump({"references": value[0], "errors": value[1]}, f)
+			os.rename(temp, os.path.join(self._directory, key + ".json"))
+		except (IOError, OSError):
+			# The on-disk tier is an optimization only
+			pass
+
+
+parse_cache = CSSParseCache()
+
+
+# noinspection PyPep8
+class CSSRewriter(object):
+	"""
+    Replace a set of strings in a CSS content in one pass. The strings to be replaced are compiled into one regular
+    expression (an alternation, the longest strings first); each match is replaced using a lookup table.
+
+    :param patterns: list of ``(from,to)`` pairs; if the same ``from`` string appears several times, the first pair is used
+    """
+	def __init__(self, patterns):
+		self._table = {}
+		for (c_from, c_to) in patterns:
+			if len(c_from) > 0 and c_from not in self._table:
+				self._table[c_from] = c_to
+		if len(self._table) > 0:
+			alternatives = sorted(self._table.keys(), key=len, reverse=True)
+			self._regex  = re.compile("|".join([re.escape(a) for a in alternatives]))
+		else:
+			self._regex  = None
+
+	def rewrite(self, content):
+		"""
+        Make the replacements on a content.
+
+        :param str content: the CSS content
+        :return: the modified content
+        """
+		if self._regex is None:
+			return content
+		return self._regex.sub(lambda match: self._table[match.group(0)], content)
+
+
 # noinspection PyPep8
 class CSSReference(object):
 	"""
@@ -62,14 +382,19 @@ class CSSReference(object):
     :param str url: URL of the CSS file (if any, otherwise value is ignored). This is an absolute URL; in practice it is based on the book URL or `www.w3.org`
     :param boolean is_file: whether the CSS is to be retrieved via the URL or whether it was embedded in HTML
     :param str content: in case the CSS was embedded, the full content of the CSS as retrieved from the DOM
+    :param downloader: the downloader used to retrieve the CSS file; if `None`, the file is retrieved directly
+    :type downloader: :py:class:`.downloads.Downloader`
     """
 	# noinspection PyPep8
-	def __init__(self, base, url, is_file = True, content = None):
+	def __init__(self, base, url, is_file = True, content = None, downloader = None):
 		self._origin_url      = url
 		self._base            = base
 		self._change_patterns = []
 		if is_file:
-			session = HttpSession(url, check_media_type=True)
+			if downloader is not None:
+				session = downloader.fetch(url, check_media_type=True)
+			else:
+				session = HttpSession(url, check_media_type=True)
 			if session.success:
 				self._content = session.data.read()
 			else:
@@ -93,14 +418,20 @@ class CSSReference(object):
 		"""Set of :py:class:`_URLPair` instances for resources that were found in the CSS content"""
 		return self._import_misc
 
+	@property
+	def url(self):
+		"""The (absolute) URL of the CSS file"""
+		return self._origin_url
+
 	@property
 	def change_patterns(self):
-		"""Array of (from,to) pairs used to replace strings in CSS files when copying into the book"""
+		"""Array of (from,to) pairs used to replace strings in this CSS file when copying into the book"""
 		return self._change_patterns
 
 	def _collect_imports(self):
-		"""Collect the resources to be imported. The CSS content is parsed, and the :py:attr:`import_css`
-        and :py:attr:`import_misc` sets are filled with content. This method is called at initialization time.
+		"""Collect the resources to be imported. The CSS content is parsed (unless the result is already in the
+        :py:data:`parse_cache`), and the :py:attr:`import_css` and :py:attr:`import_misc` sets are filled with content.
+        This method is called at initialization time.
         """
 		def add_item_to_import(url_orig, css=False):
 			# The urls-s are relative to the CSS file's
@@ -135,37 +466,17 @@ class CSSReference(object):
 			if css:
 				self._import_css.add(url)
 
-		def handle_one_css_ruleset(one_ruleset):
-			# This is a basic CSS set of declarations. Each declaration has, potentially, a set of values;
-			# the values themselves may be numbers, strings, etc, and also URI-s
-			# Only the URI-s are of interest at this point.
-			if one_ruleset.at_keyword is None:
-				for d in one_ruleset.declarations:
-					for i in [item for item in d.value if item.type == "URI"]:
-						add_item_to_import(i.value)
-
 		self._import_css  = set()
 		self._import_misc = set()
-		parser = tinycss.make_parser("page3")
 
 		if self._content is not None:
-			stylesheet = parser.parse_stylesheet(self._content)
+			references, errors = parse_cache.references(self._content)
 			# Log if there is an error in the stylesheet
-			if stylesheet.errors is not None and len(stylesheet.errors) > 0:
-				Logger.warning("The tinycss parser found some CSS errors in %s" % self._origin_url)
-
-			# Go through all the individual rules of the style sheet
-			for rule in stylesheet.rules:
-				# Only the @import and @media rules are of interest; most of the others, like @print, are ignored
-				if rule.at_keyword == "@import":
-					add_item_to_import(rule.uri, css=True)
+			if errors:
+				Logger.warning("The %s parser found some CSS errors in %s" % (parse_cache.parser, self._origin_url))
 
-				elif rule.at_keyword == "@media":
-					for ruleset in rule.rules:
-						handle_one_css_ruleset(ruleset)
-
-				elif rule.at_keyword is None:
-					handle_one_css_ruleset(rule)
+			for url_orig, css in references:
+				add_item_to_import(url_orig, css)
 
 	def __repr__(self):
 		return self._origin_url + ': ' + `self.import_css` + "," + `self.import_misc`
@@ -178,29 +489,67 @@ class CSSList(object):
     the final information is requested, a recursion is done on the collected CSS file references to collect all
     outstanding resources.
 
+    The CSS files are only retrieved and parsed when the final information is requested. That is done level by level: all the
+    CSS files added via :py:meth:`add_css` form the first level, the files they import the second level, etc. The files of a
+    level are retrieved and parsed in parallel (via the :py:meth:`.downloads.Downloader.map` method), and the results are
+    merged in a deterministic order.
+
+    The recursion builds an import graph, keyed by the absolute URL-s of the CSS files: each file is retrieved and parsed
+    only once, even if it is imported by several other CSS files, and an import cycle does not lead to an infinite recursion.
+    The graph is available through :py:attr:`import_graph`, the cycles through :py:attr:`import_cycles`.
+
     :param str base: the base URL for the whole book
+    :param downloader: the downloader used to retrieve the CSS files (shared with the rest of the book, i.e., each file is retrieved only once)
+    :type downloader: :py:class:`.downloads.Downloader`
     """
-	def __init__(self, base):
+	def __init__(self, base, downloader=None):
 		self._css_list        = []
 		self._base            = base
-		self._change_patterns = []
+		self._rewriters       = {}
+		self._downloader      = downloader
+		self._import_graph    = OrderedDict()
+		self._import_cycles   = []
+		self._pending         = []
+		self._seen            = set()
+		self._gathered        = False
 
 	@property
-	def change_patterns(self):
-		"""Array of ``(from,to)`` pairs used to replace strings in CSS files when copying into the book"""
-		return self._change_patterns
+	def rewriters(self):
+		"""Mapping from the (absolute) URL of a CSS file to the :py:class:`CSSRewriter` instance to be used on that file when copying it into the book. CSS files that need no change are not listed."""
+		self._gather_all_stylesheets()
+		return self._rewriters
+
+	@property
+	def import_graph(self):
+		"""
+        The import graph of the CSS files: a mapping from the absolute URL of a CSS file to the list of absolute URL-s
+        it imports. The imports of the embedded (``<style>``) CSS content are listed under the base URL of the book. The graph is complete
+        only after :py:meth:`get_download_list` has been invoked.
+        """
+		return self._import_graph
+
+	@property
+	def import_cycles(self):
+		"""
+        List of ``(from,to)`` pairs of URL-s for the ``@import`` statements that close a cycle in the :py:attr:`import_graph`
+        (these imports are ignored).
+        """
+		return self._import_cycles
 
 	def add_css(self, origin_url, is_file=True, content=None):
-		"""Add a new CSS, ie, add a new :py:class:`CSSReference` to the internal array of references
+		"""Add a new CSS; the corresponding :py:class:`CSSReference` is created, i.e., the CSS file is retrieved and parsed, when
+        the final information is requested. A CSS file that has already been added is ignored.
 
         :param str origin_url: URL of the CSS file (if any, otherwise value is ignored)
         :param boolean is_file: whether the CSS is to be retrieved via the URL or whether it was embedded
         :param str content: in case the CSS was embedded, the full content of the CSS
         """
-		css_ref = CSSReference(self._base, urljoin(self._base, origin_url), is_file, content)
-		if not css_ref.empty:
-			self._css_list.append(css_ref)
-			self._change_patterns += css_ref.change_patterns
+		url = urljoin(self._base, origin_url)
+		if is_file:
+			if url in self._seen:
+				return
+			self._seen.add(url)
+		self._pending.append((url, is_file, content))
 
 	def get_download_list(self):
 		"""Return all the list of resources that must be downloaded and added to the book. These include those
@@ -215,28 +564,83 @@ class CSSList(object):
 				final_download_list.add((d.name, d.url))
 		return list(final_download_list)
 
+	def _add_to_graph(self, url, css_ref, is_file):
+		"""
+        Add the imports of a CSS reference to the import graph.
+
+        :param str url: the (absolute) URL of the CSS file, or the base URL for embedded CSS content
+        :param css_ref: the CSS reference
+        :type css_ref: :py:class:`CSSReference`
+        :param boolean is_file: whether the CSS is a file or embedded content
+        """
+		imports = [urljoin(self._base, u) for u in sorted(css_ref.import_css)]
+		if is_file:
+			self._import_graph[url] = imports
+		else:
+			self._import_graph.setdefault(url, [])
+			self._import_graph[url] += [u for u in imports if u not in self._import_graph[url]]
+
 	def _gather_all_stylesheets(self):
-		def one_level(css_references):
-			"""
-            Recursive step to gather all resources to be downloaded: goes through the list of css references and
-            accesses the next level of css references for further inclusion.
+		"""
+        Retrieve and parse, level by level, all CSS files that have been added or that are imported. Each file is retrieved
+        (and parsed) only once.
+        """
+		if self._gathered:
+			return
+		self._gathered = True
+
+		def create_reference(css):
+			url, is_file, content = css
+			return CSSReference(self._base, url, is_file, content, self._downloader)
+
+		level = self._pending
+		while len(level) > 0:
+			if self._downloader is not None:
+				css_refs = self._downloader.map(create_reference, level)
+			else:
+				css_refs = [create_reference(css) for css in level]
 
-            :param css_references: an array of :py:class:`CSSReference` instances.
-            """
 			next_level = []
-			for css in css_references:
-				for url in css.import_css:
-					new_css_ref = CSSReference(self._base, urljoin(self._base, url))
-					if not new_css_ref.empty:
-						next_level.append(new_css_ref)
-						self._change_patterns += new_css_ref.change_patterns
-			if len(next_level) != 0:
-				next_level += one_level(next_level)
-			return next_level
-		self._css_list += one_level(self._css_list)
+			for (url, is_file, content), css_ref in zip(level, css_refs):
+				self._add_to_graph(url, css_ref, is_file)
+				if not css_ref.empty:
+					self._css_list.append(css_ref)
+					if is_file and len(css_ref.change_patterns) > 0:
+						self._rewriters[url] = CSSRewriter(css_ref.change_patterns)
+					for imported in sorted(css_ref.import_css):
+						imported = urljoin(self._base, imported)
+						if imported not in self._seen:
+							self._seen.add(imported)
+							next_level.append((imported, True, None))
+			level = next_level
+		self._pending = []
+
+		self._find_cycles()
+
+	def _find_cycles(self):
+		"""
+        Find the ``@import`` statements that close a cycle in the import graph (via a depth first search), and log them.
+        """
+		visiting = set()
+		finished = set()
+
+		def visit(url):
+			visiting.add(url)
+			for target in self._import_graph.get(url, []):
+				if target in visiting:
+					self._import_cycles.append((url, target))
+					Logger.warning("Cyclic CSS import of '%s' from '%s' is ignored" % (target, url))
+				elif target not in finished:
+					visit(target)
+			visiting.remove(url)
+			finished.add(url)
+
+		for node in self._import_graph:
+			if node not in finished:
+				visit(node)
 
 	def __repr__(self):
 		retval = ""
 		for c in self._css_list:
 			retval += c.__repr__() + '\n'
-		return retval
\ No newline at end of file
+		return retval
@@ -4,12 +4,24 @@
 The entry point to the package is through the  :py:class:`DocWrapper` class below. An instance of that class controls the
 necessary workflow for the EPUB generation, namely:
 
-* gets hold of the content, possibly converts the ReSpec source on the fly to HTML
+* gets hold of the content, possibly converts the ReSpec source on the fly to HTML (see :py:mod:`.converters`)
 * creates a :py:class:`.document.Document` class around the content that holds all the necessary metadata and further references
 * creates the book and, if required, the folder for the content
 * collects all the dependencies from the Web, and copies them to the output
 * creates all the auxiliary files (package file, navigation files, etc) and copies them to the output
 
+The EPUB package is written into a file by default; it can also be written into any writable binary stream (see
+:py:meth:`DocWrapper.process`), or be returned as an in-memory buffer (see :py:meth:`DocWrapper.process_to_buffer`).
+
+The retrieval of the resources needed for every book starts, in the background, when the :py:class:`DocWrapper` instance
+is created. The threads and the retrieved contents are released at the end of :py:meth:`DocWrapper.process`; an instance
+that may not be processed (e.g., if something else fails in between) must be closed instead, typically by using it in a
+``with`` statement::
+
+    with DocWrapper(url) as wrapper:
+        ...
+        wrapper.process()
+
 
 .. :class:: DocWrapper
 
@@ -20,23 +32,34 @@ Module content
 # noinspection PyPep8
 
 # noinspection PyPep8Naming
-import html5lib
-from xml.etree.ElementTree import ElementTree
-from urlparse import urlparse, urlunparse
+from urlparse import urlparse, urlunparse, urljoin
+import re
 import tempfile
+import os.path
+from io import BytesIO
 
 from .templates import BOOK_CSS, BOOK_CSS_EXTRAS
 from .document import Document
 from .package import Package
-from .config import TO_TRANSFER
+from .config import TO_TRANSFER, DOWNLOAD_WORKERS, DOWNLOAD_PER_HOST, CSS_PARSER, TREE_ENGINE, COMPRESS_WORKERS, COMPRESSION_POLICY
 from .config import PADDING_NEW_STYLE, PADDING_OLD_STYLE
 from .utils import HttpSession, Book, Logger
+from .downloads import Downloader
+from .httpcache import HttpCache
+from .engines import get_engine
+from .compression import get_policy
+# CONVERTER is also kept here, where it used to be defined
+from .converters import CONVERTER, RemoteConverter, convert
 import utils
+import cssurls
+import converters
 
+# Pre-scan of the <link> elements of a source (see DocWrapper._stylesheets)
+_LINK      = re.compile(r"<link\b[^>]*>", re.IGNORECASE)
+_ATTRIBUTE = re.compile(r"""([a-zA-Z-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
 
-#: URI of the service used to convert a ReSpec source onto an HTML file on the fly. This service is used
-#: by this script to convert ReSpec sources into HTML before EPUB3 generation.
-CONVERTER = "https://labs.w3.org/spec-generator/?type=respec&url="
+#: Stages of the generation of a book, in order, as reported to the progress callback of :py:class:`DocWrapper`.
+STAGES = ["source", "parse", "resources", "references", "css", "package", "content", "done"]
 
 
 ###################################################################################
@@ -51,17 +74,45 @@ class DocWrapper(object):
     :param boolean folder: whether the directory structure should be created separately or not
     :param boolean temporary: whether the zipped EPUB file should be put into a temporary filesystem location (used when the service is used through the Web)
     :param logger: a python logger (see the standard library module on logging) to be used all around;  `None` means no logging
+    :param int workers: maximum number of resources downloaded in parallel
+    :param int per_host: maximum number of resources downloaded in parallel from the same host
+    :param str cache_dir: directory for a persistent HTTP cache (and, in its ``css`` subdirectory, for the results of CSS parsing); `None` means no persistent caching
+    :param str css_parser: parser used to find the references in the CSS files, a key in :py:data:`.cssurls.CSS_PARSERS`
+    :param str engine: tree engine used to parse the HTML sources and to serialize the XHTML output, a key in :py:data:`.engines.ENGINES`
+    :param int compress_workers: number of threads compressing the content of the EPUB package; 1 means a serial compression
+    :param str compression: compression policy of the EPUB package, a key in :py:data:`.config.COMPRESSION_POLICIES`
+    :param boolean dedup: whether files with identical content should be compressed only once in the EPUB package
+    :param converter: the backend converting a ReSpec source into HTML (see :py:mod:`.converters`); `None` means the spec generator service at :py:data:`.converters.CONVERTER`
+    :param progress: a callable invoked at the start of each stage of the generation (see :py:data:`STAGES`), with the name of the stage, the number of completed stages, and the total number of stages; `None` means no progress report
+    :raises R2EError: if the engine or the compression policy is unknown, or cannot be used (e.g., lxml or zopfli is not installed)
     """
 
 	# noinspection PyPep8
-	def __init__(self, url, is_respec=False, package=True, folder=False, temporary=False, logger=None):
+	def __init__(self, url, is_respec=False, package=True, folder=False, temporary=False, logger=None,
+				 workers=DOWNLOAD_WORKERS, per_host=DOWNLOAD_PER_HOST, cache_dir=None, css_parser=CSS_PARSER,
+				 engine=TREE_ENGINE, compress_workers=COMPRESS_WORKERS, compression=COMPRESSION_POLICY, dedup=False,
+				 converter=None, progress=None):
 		self._html_document = None
 		self._top_uri       = url
 		self._book          = None
 		self._domain        = urlparse(url).netloc
 		self._package       = package
 		self._folder        = folder
+		self._downloader    = Downloader(workers, per_host)
+		self._engine        = get_engine(engine)
+		self._compress_workers = compress_workers
+		self._compression      = get_policy(compression)
+		self._dedup            = dedup
+		self._progress         = progress
 		utils.logger 		= logger
+		if cache_dir is None:
+			utils.http_cache = None
+		elif utils.http_cache is None or utils.http_cache.directory != cache_dir:
+			# A long-running process (e.g., the HTTP service) keeps the same cache for all the books
+			utils.http_cache = HttpCache(cache_dir)
+		cssurls.parse_cache.directory = os.path.join(cache_dir, "css") if cache_dir is not None else None
+		cssurls.parse_cache.parser    = css_parser
+		converters.conversion_cache.directory = os.path.join(cache_dir, "respec") if cache_dir is not None else None
 
 		Logger.info("== Handling the '%s' %s source ==" % (url, "ReSpec" if is_respec else "HTML"))
 
@@ -78,25 +129,40 @@ class DocWrapper(object):
 				to_set = setting.split('=')
 				self._url_respec_setting[to_set[0]] = to_set[1]
 
-		# Get the data, possibly converting from respec on the fly
-		if is_respec:
-			Logger.info("Generating HTML via the spec generator service from %s" % url)
-		session = HttpSession(CONVERTER + url if is_respec else url, raise_exception=True, is_respec=is_respec)
-		if is_respec:
-			Logger.info("ReSpec generation successful, continuing with the result")
+		# The fixed resources are needed for every book: their retrieval starts at once, in the background, i.e., it
+		# overlaps with the retrieval (and conversion) of the source
+		self._downloader.prefetch([uri for uri, local in TO_TRANSFER])
+		try:
+			# Get the data, possibly converting from respec on the fly
+			self._report("source")
+			if is_respec:
+				Logger.info("Generating HTML via the spec generator from %s" % url)
+				content = convert(url, converter if converter is not None else RemoteConverter())
+				Logger.info("ReSpec generation successful, continuing with the result")
+			else:
+				content = HttpSession(url, raise_exception=True).data.read()
+
+			# The style sheets can be retrieved while the document is being parsed
+			self._downloader.prefetch(self._stylesheets(content))
 
-		# Parse the generated document
-		self._html          = html5lib.parse(session.data, namespaceHTMLElements=False)
-		self._html_document = ElementTree(self._html)
+			# Parse the generated document
+			self._report("parse")
+			self._html          = self._engine.parse(BytesIO(content))
+			self._html_document = self._engine.tree(self._html)
 
-		# representation of the whole document, with the various metadata, etc.
-		self._document = Document(self)
+			# representation of the whole document, with the various metadata, etc.
+			self._document = Document(self)
+		except Exception:
+			# The downloader is otherwise closed at the end of the processing
+			self._downloader.close()
+			raise
 
 		# File name to be used for the final epub file
+		self._book_name = self.document.short_name
 		if temporary:
 			self._book_file_name = (tempfile.mkstemp(suffix='_' + self.document.short_name + '.epub'))[1]
 		else:
-			self._book_file_name = self.document.short_name + ".epub"
+			self._book_file_name = None
 
 	@property
 	def package(self):
@@ -113,10 +179,19 @@ class DocWrapper(object):
 		"""Possible ReSpec configuration setting via the query part of the URI of the document"""
 		return self._url_respec_setting
 
+	@property
+	def book_name(self):
+		"""Name of the book, i.e., of the folder with the content and, unless the book is a temporary file, of the EPUB file without the ``.epub`` suffix; the short name of the document by default, it may be changed before the processing (e.g., to avoid a clash with another book)"""
+		return self._book_name
+
+	@book_name.setter
+	def book_name(self, name):
+		self._book_name = name
+
 	@property
 	def book_file_name(self):
-		"""Name of the book; usually `shortname + .epub`, but can be a temporary file if so requested (the term “shortname” is a W3C jargon…)"""
-		return self._book_file_name
+		"""Name of the book; usually `shortname + .epub` (see :py:attr:`book_name`), but can be a temporary file if so requested (the term “shortname” is a W3C jargon…)"""
+		return self._book_file_name if self._book_file_name is not None else self._book_name + ".epub"
 
 	@property
 	def base(self):
@@ -153,10 +228,54 @@ class DocWrapper(object):
 		"""The book being generated; an open :py:class:`zipfile.ZipFile` instance"""
 		return self._book
 
-	def process(self):
+	@property
+	def downloader(self):
+		"""The downloader used to retrieve the resources in parallel; a :py:class:`.downloads.Downloader` instance"""
+		return self._downloader
+
+	@property
+	def engine(self):
+		"""The tree engine used to parse and serialize the documents; see the :py:mod:`.engines` module"""
+		return self._engine
+
+	def _stylesheets(self, content):
+		"""
+		Find the style sheets referred to by the ``<link>`` elements of an HTML source, without parsing it, i.e., with
+		regular expressions. The result is used for a speculative retrieval only: the references are properly collected
+		from the parsed document later (see :py:class:`.document.Document`), and an error in this scan only means a
+		useless or a missed prefetch.
+
+		:param str content: the HTML source
+		:return: list of the (absolute) URL-s of the style sheets, as they are retrieved by :py:class:`.cssurls.CSSList`
+		"""
+		urls = []
+		for link in _LINK.findall(content):
+			attributes = {}
+			for name, double_quoted, single_quoted, unquoted in _ATTRIBUTE.findall(link):
+				attributes[name.lower()] = double_quoted or single_quoted or unquoted
+			if "stylesheet" not in attributes.get("rel", "").lower().split() or not attributes.get("href"):
+				continue
+			href = attributes["href"].replace("&amp;", "&")
+			# The same adjustment is made on the references to the W3C style sheets in the document
+			if urlparse(href).netloc == "www.w3.org" and not href.endswith(".css"):
+				href += ".css"
+			urls.append(urljoin(self.base, href))
+		return urls
+
+	def _report(self, stage):
+		"""
+		Report the start of a stage of the generation to the progress callback, if any.
+
+		:param str stage: the name of the stage (see :py:data:`STAGES`)
+		"""
+		if self._progress is not None:
+			self._progress(stage, STAGES.index(stage), len(STAGES) - 1)
+
+	def process(self, output=None):
 		"""
         Process the book, ie, extract whatever has to be extracted and produce the epub file.
 
+        :param output: a writable binary stream (e.g., an :py:class:`io.BytesIO` instance, or a socket file) the EPUB package is written into, instead of the :py:attr:`book_file_name` file; the stream is not closed. If the stream is not seekable, the package is written progressively, i.e., the entries are sent out while the book is being generated (see :py:class:`.utils.Book`)
         :returns: the instance of the class itself
         """
 		# Create the wrapper around the parsed version. This will also
@@ -164,7 +283,7 @@ class DocWrapper(object):
 		# It is important to get these metadata before the real processing because, for example, the
 		# 'short name' will also be used for the name of the final book
 
-		with Book(self.book_file_name, self.document.short_name, self.package, self.folder) as self._book:
+		with self.downloader, Book(output if output is not None else self.book_file_name, self.book_name, self.package, self.folder, self.engine, self._compress_workers, self._compression, self._dedup) as self._book:
 			if self.document.css_tr_version == 2015:
 				try:
 					padding = PADDING_OLD_STYLE[self.document.doc_type]
@@ -189,23 +308,56 @@ class DocWrapper(object):
 			self.book.writestr('StyleSheets/TR/book.css', (BOOK_CSS % padding) + css_extras)
 
 			# Some resources should be added to the in any case: icons, stylesheets for cover and nav pages,...
-			for uri, local in TO_TRANSFER:
-				self.book.write_HTTP(local, uri)
+			self._report("resources")
+			sessions = self.downloader.fetch_all([uri for uri, local in TO_TRANSFER])
+			for (uri, local), session in zip(TO_TRANSFER, sessions):
+				self.book.write_session(local, session)
 
 			# Add the additional resources that are referred to from the document itself
+			self._report("references")
 			self.document.extract_external_references()
 
 			# Add the various additional media files (typically images), collected from CSS files
-			for (local, uri) in self.document.css_references:
-				session = utils.HttpSession(uri)
+			self._report("css")
+			sessions = self.downloader.fetch_all([uri for (local, uri) in self.document.css_references])
+			for (local, uri), session in zip(self.document.css_references, sessions):
 				if session.success:
-					self.book.write_session(local, session, self.document.css_change_patterns)
+					self.book.write_session(local, session, self.document.css_rewriters)
 					self.document.add_additional_resource(local, session.media_type)
 
 			# The various EPUB specific package files to be added to the final output
+			self._report("package")
 			Package(self).process()
 
 			# The main content should be stored in the target book
+			self._report("content")
 			self.book.write_element('Overview.xhtml', self.html_document)
 
+		self._report("done")
+		return self
+
+	def process_to_buffer(self):
+		"""
+        Process the book into memory, ie, without creating a file for the EPUB package.
+
+        :returns: the EPUB package; an :py:class:`io.BytesIO` instance, positioned at the start of the content
+        """
+		buffer = BytesIO()
+		self.process(buffer)
+		buffer.seek(0)
+		return buffer
+
+	def close(self):
+		"""
+        Release the threads and the contents of the retrievals started in the background, if the book is not processed
+        (:py:meth:`process` does it otherwise). The instance may still be processed afterwards.
+        """
+		self._downloader.close()
+
+	# The methods below are necessary to use the class in a "with ... as" python structure
+	def __enter__(self):
 		return self
+
+	# noinspection PyUnusedLocal
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
@@ -27,7 +27,8 @@ from xml.etree.ElementTree import SubElement
 from StringIO import StringIO
 from datetime import date, datetime
 
-from .utils import HttpSession, Utils, Logger
+from .utils import Utils, Logger
+from .domindex import DOMIndex
 from .cssurls import CSSList
 from .config import TO_TRANSFER
 import config
@@ -63,11 +64,14 @@ class Document(object):
 		self._nav_toc	     = []
 		self._css_tr_version = 2015
 		self._subtitle       = None
+
+		# All element lookups use this index instead of walking the full tree again and again
+		self._dom_index      = DOMIndex(self.html)
 		self._get_document_metadata()
 
 		css_list = self._collect_downloads()
 		self._css_references       = css_list.get_download_list()
-		self._css_change_patterns  = css_list.change_patterns
+		self._css_rewriters        = css_list.rewriters
 
 
 	@property
@@ -85,6 +89,11 @@ class Document(object):
 		"""The parsed version of the top level HTML element; an :py:class:`xml.etree.ElementTree.Element` instance  """
 		return self._driver.html
 
+	@property
+	def dom_index(self):
+		"""The index of the elements in :py:attr:`html`; a :py:class:`.domindex.DOMIndex` instance"""
+		return self._dom_index
+
 	@property
 	def additional_resources(self):
 		"""List of additional resources that must be added to the book eventually. A list of tuples, containing the internal
@@ -109,11 +118,11 @@ class Document(object):
 		return self._css_references
 
 	@property
-	def css_change_patterns(self):
-		"""List if `(from, to)` pairs that must be used to replace strings in the CSS files on the fly. Typically
-        used to adjust the values used in `url` statements.
+	def css_rewriters(self):
+		"""Mapping from the URL of CSS files to :py:class:`.cssurls.CSSRewriter` instances that must be used to replace strings in
+        those files on the fly. Typically used to adjust the values used in `url` statements.
         """
-		return self._css_change_patterns
+		return self._css_rewriters
 
 	# noinspection PyPep8
 	def extract_external_references(self):
@@ -132,6 +141,13 @@ class Document(object):
 			else:
 				return f_session.media_type, f_target
 
+		# The process is done in three steps:
+		#  1. the references to be retrieved are collected
+		#  2. the retrievals are done in parallel via the driver's downloader
+		#  3. the content is copied into the book, and the DOM is changed, in the original order of the targets. This
+		#     ensures that the final output does not depend on the order in which the retrievals have been completed.
+		targets = []
+
 		# Retrieve the value of the reference. By making a urljoin, relative URI-s are also turned into absolute one;
 		# this simplifies the issue
 		# Look at generic external references like images, and, possibly copy the content
@@ -160,53 +176,61 @@ class Document(object):
 				# Official WWW URI-s, mainly for style sheets or possibly javascript
 				www_level = True if parsed_ref.netloc == "www.w3.org" else False
 				if local or www_level:
-					session = HttpSession(ref, check_media_type=True)
-					if session.success:
-						# Find/set the right name for the target document
-						path = parsed_ref.path
-						if path[-1] == '/':
-							# This should not really happen, but may: relying on some WWW mechanism that we cannot
-							# rely on in a a book
-							target = 'Assets/extras/data%s.%s' % (self._index, config.ACCEPTED_MEDIA_TYPES[session.media_type])
-							self._index += 1
-						elif www_level:
-							# This is, mainly, for official CSS files as well as W3C logos/icons; reproducing the same path as for W3C
-							target = path if path[0] != '/' else path[1:]
-						elif local:
-							# This is for local references, reproducing the same path as in the origin
-							# Removing a possible, though erroneous, first character, just to be on the safe side
-							target = attr_value if attr_value[0] != '/' else attr_value[1:]
-						else:
-							# In fact, this should not happen...
-							target = attr_value.split('/')[-1]
-
-						# other complication: if the target is an html file, it will have to become xhtml :-(
-						# this means that the target and the media types should receive a local name, to
-						# be stored and used below
-						final_media_type, final_target = final_target_media(session, target)
-
-						# We can now copy the content into the final book.
-						# Note that some of the media types are not to be compressed; this is taken care in the
-						# "Book" instance
-						self.driver.book.write_session(target, session, self.css_change_patterns)
-
-						# Add information about the new entry; this has to be added to the manifest file
-						self._additional_resources.append((final_target, final_media_type))
-
-						# Change the original reference
-						element.set(attr, final_target)
-					else:
-						# That resource is not available
-						# Typical situation where it happens: the document is generated from respec
-						# on the fly but from a place where the diff file is not yet
-						# generated (but referenced from content)
-						# Take out those situations that are under the control of this script
-						if not element.get(attr).startswith("Assets/"):
-							element.tag = "span"
-							element.attrib.pop(attr)
-							if element.get("rel") is not None:
-								element.attrib.pop("rel")
-							Logger.warning("Link to '%s' removed (non-existing local resource or of non acceptable type)" % ref)
+					targets.append((element, attr, attr_value, ref, parsed_ref, local, www_level))
+
+		# Each URL is retrieved only once, even if it is referred to by several elements (or has already been
+		# retrieved as part of the CSS processing); all the referring elements are changed using the same result
+		sessions = self.driver.downloader.fetch_all([t[3] for t in targets], check_media_type=True)
+
+		for (element, attr, attr_value, ref, parsed_ref, local, www_level), session in zip(targets, sessions):
+			if session.success:
+				# Find/set the right name for the target document
+				path = parsed_ref.path
+				if path[-1] == '/':
+					# This should not really happen, but may: relying on some WWW mechanism that we cannot
+					# rely on in a a book
+					target = 'Assets/extras/data%s.%s' % (self._index, config.ACCEPTED_MEDIA_TYPES[session.media_type])
+					self._index += 1
+				elif www_level:
+					# This is, mainly, for official CSS files as well as W3C logos/icons; reproducing the same path as for W3C
+					target = path if path[0] != '/' else path[1:]
+				elif local:
+					# This is for local references, reproducing the same path as in the origin
+					# Removing a possible, though erroneous, first character, just to be on the safe side
+					target = attr_value if attr_value[0] != '/' else attr_value[1:]
+				else:
+					# In fact, this should not happen...
+					target = attr_value.split('/')[-1]
+
+				# other complication: if the target is an html file, it will have to become xhtml :-(
+				# this means that the target and the media types should receive a local name, to
+				# be stored and used below
+				final_media_type, final_target = final_target_media(session, target)
+
+				# We can now copy the content into the final book.
+				# Note that some of the media types are not to be compressed; this is taken care in the
+				# "Book" instance
+				self.driver.book.write_session(target, session, self.css_rewriters)
+
+				# Add information about the new entry; this has to be added to the manifest file
+				self._additional_resources.append((final_target, final_media_type))
+
+				# Change the original reference
+				self.dom_index.set(element, attr, final_target)
+			else:
+				# That resource is not available
+				# Typical situation where it happens: the document is generated from respec
+				# on the fly but from a place where the diff file is not yet
+				# generated (but referenced from content)
+				# Take out those situations that are under the control of this script
+				if not element.get(attr).startswith("Assets/"):
+					element.tag = "span"
+					element.attrib.pop(attr)
+					if element.get("rel") is not None:
+						element.attrib.pop("rel")
+					# The element is now on other lists of the index
+					self.dom_index.invalidate()
+					Logger.warning("Link to '%s' removed (non-existing local resource or of non acceptable type)" % ref)
 
 	###################################################################################################
 	# noinspection PyPep8
@@ -219,26 +243,26 @@ class Document(object):
         :returns: a :py:class:`.cssurls.CSSList` instance, with all the CSS references
         """
 		# To collect the CSS references and data
-		css_list = CSSList(self.driver.base)
+		css_list = CSSList(self.driver.base, self.driver.downloader)
 
 		# Do the necessary massaging on the DOM tree to make the XHTML output o.k.
-		Utils.html_to_xhtml(self.html)
+		Utils.html_to_xhtml(self.html, self.dom_index)
 
 		# Change the value of @about to the dated URI, which is what counts...
 		self.html.set("about", self.dated_uri)
 
 		# handle stylesheet references
-		for lnk in self.html.findall(".//link[@rel='stylesheet']"):
+		for lnk in self.dom_index.find_all("link", "rel", "stylesheet"):
 			ref = lnk.get("href")
 			if urlparse(ref).netloc == "www.w3.org":
 				if not ref.endswith(".css"):
-					lnk.set("href",ref + ".css")
+					self.dom_index.set(lnk, "href", ref + ".css")
 			self._download_targets.append((lnk, 'href'))
 			# The CSS reference should be stored as a possible source of further references
 			css_list.add_css(lnk.get("href"))
 
 		# Handle built-in style sheet statements; this should be added to the CSS handler, too
-		for style in self.html.findall(".//style"):
+		for style in self.dom_index.find_all("style"):
 			# there may be cases, though not probable, that that the type attribute is set to something different
 			# then text/css
 			if style.get("type") is not None and style.get("type") != "text/css":
@@ -246,30 +270,32 @@ class Document(object):
 			content = " ".join([k.strip() for k in style.itertext()]).strip()
 			css_list.add_css(self.driver.base, is_file=False, content=content)
 
-		head = self.html.find(".//head")
+		head = self.dom_index.find("head")
 		book_css = SubElement(head, "link")
 		book_css.set("rel", "stylesheet")
 		book_css.set("href", "StyleSheets/TR/book.css")
+		self.dom_index.add(book_css, head)
 
 		# This is an ugly issue which comes up very very rarely: the base element screws up things
-		for element in self.html.findall(".//base"):
+		for element in self.dom_index.find_all("base"):
 			head.remove(element)
+			self.dom_index.remove(element)
 
 		# Change the HTTP equivalent value
-		Utils.set_html_meta(self.html, head)
+		Utils.set_html_meta(self.html, head, self.dom_index)
 
 		# change the DOM
-		Utils.change_DOM(self.html)
+		Utils.change_DOM(self.html, self.dom_index)
 
 		# Collect the additional download targets
 		for (tag_name, attr) in config.EXTERNAL_REFERENCES:
-			for element in self.html.findall(".//%s" % tag_name):
+			for element in self.dom_index.find_all(tag_name):
 				self._download_targets.append((element, attr))
 
 		# Extra care should be taken with <a> elements: only local, relative URI-s should be considered,
 		# excluding the pure fragment id. Ie, it should refer to another file in the local package.
 		# As a pathological case, the href == "." should also be excluded to avoid self-reference
-		for element in self.html.findall(".//a[@href]"):
+		for element in self.dom_index.find_all("a", "href"):
 			ref  = element.get("href")
 			pref = urlparse(ref)
 			if len(pref.netloc) == 0 and len(pref.scheme) == 0 and len(pref.path) != 0 and ref != ".":
@@ -388,7 +414,7 @@ class Document(object):
 			else:
 				self._date = date.today()
 
-			aref = self.html.find(".//a[@class='u-url']")
+			aref = self.dom_index.find("a", "class", "u-url")
 			if aref is not None:
 				self._dated_uri = aref.get('href')
 			return True
@@ -406,7 +432,7 @@ class Document(object):
         """
 		# Short name of the document
 		# Find the official short name of the document
-		for aref in self.html.findall(".//a[@class='u-url']"):
+		for aref in self.dom_index.find_all("a", "class", "u-url"):
 			self._dated_uri = aref.get('href')
 			dated_name = self._dated_uri[:-1] if self._dated_uri[-1] == '/' else self._dated_uri
 			self._doc_type, self._short_name = Utils.create_shortname(dated_name.split('/')[-1])
@@ -415,10 +441,10 @@ class Document(object):
 		self._date = Utils.retrieve_date(self.dated_uri)
 
 		# Extract the editors
-		self._editors = Utils.extract_editors(self.html)
+		self._editors = Utils.extract_editors(self.html, self.dom_index)
 
 		# Add the right subtitle to the cover page
-		for issued in self.html.findall(".//h2[@property='dcterms:issued']"):
+		for issued in self.dom_index.find_all("h2", "property", "dcterms:issued"):
 			self._subtitle = ""
 			for t in issued.itertext():
 				self._subtitle += t
@@ -432,7 +458,7 @@ class Document(object):
 		"""
 		self._css_tr_version = 2015
 
-		for lnk in self.html.findall(".//link[@rel='stylesheet']"):
+		for lnk in self.dom_index.find_all("link", "rel", "stylesheet"):
 			ref_details = urlparse(lnk.get("href"))
 			# TODO: THIS IS TEMPORARY, SHOULD BE FIXED WHEN THINGS BECOME FINAL!!!!
 			if ref_details.netloc == "www.w3.org" and "2016" in ref_details.path:
@@ -449,8 +475,12 @@ class Document(object):
 			"""
             :return: True or False, depending on whether the metadata could be extracted via the respec config or not
             """
-			head = self.html.find(".//head")
-			respec_config_element = head.find(".//script[@id='initialUserConfig']")
+			head = self.dom_index.find("head")
+			respec_config_element = None
+			for element in self.dom_index.find_all("script", "id", "initialUserConfig"):
+				if head in self.dom_index.ancestors(element):
+					respec_config_element = element
+					break
 			if respec_config_element is not None:
 				try:
 					respec_config = json.loads(" ".join([j for j in respec_config_element.itertext()]))
@@ -471,6 +501,7 @@ class Document(object):
 				try:
 					if self._get_metadata_from_respec(respec_config):
 						head.remove(respec_config_element)
+						self.dom_index.remove(respec_config_element)
 						Logger.info("Using the embedded ReSpec Configuration")
 						return True
 					else:
@@ -488,7 +519,7 @@ class Document(object):
 				return False
 
 		# Get the title of the document
-		for title_element in self.html.findall(".//title"):
+		for title_element in self.dom_index.find_all("title"):
 			self._title = ""
 			for t in title_element.itertext():
 				self._title += t
@@ -498,7 +529,7 @@ class Document(object):
 		self._get_CSS_TR_version()
 
 		# Properties to be added to the manifest
-		props = Utils.get_document_properties(self.html)
+		props = Utils.get_document_properties(self.html, self.dom_index)
 		props.add("remote-resources")
 		if len(props) > 0:
 			self._properties = reduce(lambda x, y: x + ' ' + y, props)
@@ -513,4 +544,4 @@ class Document(object):
 		self._subtitle += ", " + self.date.strftime("%d %B, %Y")
 
 		# Extract the table of content
-		(self._toc, self._nav_toc) = Utils.extract_toc(self.html, self.short_name)
+		(self._toc, self._nav_toc) = Utils.extract_toc(self.html, self.short_name, self.dom_index)
@@ -0,0 +1,241 @@
+"""
+The :py:class:`DOMIndex` class is an index of the elements of a parsed document. Extracting the metadata, collecting
+the external references, and making the necessary changes on the DOM tree require a few dozens of element lookups like
+``.//link[@rel='stylesheet']`` or ``.//script[@src]``; with ``findall`` each of these is a full walk of the tree, which,
+for large specifications, means hundreds of thousands of elements per lookup. The index is built in one walk of the tree
+instead, and the lookups use the index (and then check the current state of the candidate elements).
+
+The index maps tag names, ``id`` values, ``class`` tokens, and attribute names to the elements, in document order; it
+also keeps the parent of each element, which the :py:mod:`xml.etree.ElementTree` interface does not provide.
+
+The DOM tree is also changed while it is being processed. Elements that are added, removed, or moved to another parent
+must be reported to the index (see :py:meth:`DOMIndex.add`, :py:meth:`DOMIndex.remove`, and :py:meth:`DOMIndex.reparent`),
+and attributes must be set through the index (see :py:meth:`DOMIndex.set`). Additions and moves may change the document
+order of the elements, and a new attribute (or a new ``id`` or ``class`` value) puts an element on other lists of the
+index; in these cases, the lookup tables are marked as outdated, and they are rebuilt, in one walk of the tree, by the next
+lookup. I.e., a series of changes costs at most one more walk. Any other change of an element (e.g., of its tag name)
+must be reported by :py:meth:`DOMIndex.invalidate`. The removal of an attribute needs no report, insofar as the
+candidate elements are always checked against the lookup criteria.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import re
+
+# One step of a (restricted) path expression: a tag name, possibly with an attribute presence or attribute value test
+_STEP = re.compile(r"^([^\[/]+)(?:\[@([^=\]]+)(?:='([^']*)')?\])?$")
+
+
+# noinspection PyPep8
+class DOMIndex(object):
+	"""
+	Index of the elements of a DOM tree, built in one walk of the tree. The root element itself is not indexed (just like
+	``findall`` does not return the root element for ``.//`` lookups).
+
+	:param root: the root of the tree
+	:type root: :py:class:`xml.etree.ElementTree.Element` or :py:class:`xml.etree.ElementTree.ElementTree`
+	"""
+	def __init__(self, root):
+		if hasattr(root, "getroot"):
+			root = root.getroot()
+		self._root = root
+		self._build()
+
+	def _build(self):
+		"""Build the lookup tables and the parent map in one walk of the tree"""
+		self._by_tag       = {}
+		self._by_id        = {}
+		self._by_class     = {}
+		self._by_attribute = {}
+		self._parent       = {}
+		self._outdated     = False
+		for element in self._root.iter():
+			for child in element:
+				self._parent[child] = element
+			if element is not self._root:
+				self._index(element)
+
+	@property
+	def root(self):
+		"""The root element of the tree"""
+		return self._root
+
+	def _index(self, element):
+		"""Add one element to the lookup tables"""
+		tag = element.tag
+		if not isinstance(tag, basestring):
+			# Comments and processing instructions
+			return
+		self._by_tag.setdefault(tag, []).append(element)
+		for name, value in element.items():
+			self._by_attribute.setdefault(name, []).append(element)
+			if name == "id":
+				self._by_id.setdefault(value, []).append(element)
+			elif name == "class":
+				for token in set(value.split()):
+					self._by_class.setdefault(token, []).append(element)
+
+	def _candidates(self, tag, attribute, value):
+		"""The shortest list of the index that includes all elements that may fulfill the criteria"""
+		if self._outdated:
+			self._build()
+		if attribute == "id" and value is not None:
+			return self._by_id.get(value, [])
+		elif attribute == "class" and value is not None and len(value.split()) > 0:
+			return self._by_class.get(value.split()[0], [])
+		elif attribute is not None:
+			return self._by_attribute.get(attribute, [])
+		else:
+			return self._by_tag.get(tag, [])
+
+	@staticmethod
+	def _matches(element, tag, attribute, value):
+		"""Check whether an element, in its current state, fulfills the criteria"""
+		if tag is not None and element.tag != tag:
+			return False
+		if attribute is not None:
+			if value is None:
+				return attribute in element.attrib
+			return element.get(attribute) == value
+		return True
+
+	def find_all(self, tag, attribute=None, value=None):
+		"""
+		Find all elements with a tag name and, optionally, with an attribute (of a specific value). The result is the same
+		as for ``root.findall(".//tag[@attribute='value']")``.
+
+		:param str tag: the tag name
+		:param str attribute: name of an attribute that the element must have; `None` means no restriction on the attributes
+		:param str value: value of the attribute; `None` means that the presence of the attribute is enough
+		:return: list of elements, in document order
+		"""
+		return [e for e in self._candidates(tag, attribute, value) if self._matches(e, tag, attribute, value)]
+
+	def find(self, tag, attribute=None, value=None):
+		"""
+		Find the first element with a tag name and, optionally, with an attribute (of a specific value). The result is the
+		same as for ``root.find(".//tag[@attribute='value']")``.
+
+		:param str tag: the tag name
+		:param str attribute: name of an attribute that the element must have; `None` means no restriction on the attributes
+		:param str value: value of the attribute; `None` means that the presence of the attribute is enough
+		:return: the element, or `None`
+		"""
+		for element in self._candidates(tag, attribute, value):
+			if self._matches(element, tag, attribute, value):
+				return element
+		return None
+
+	def select(self, path):
+		"""
+		Find all elements matching a restricted path expression: one or two steps (separated by ``/``), each step
+		being a tag name, possibly followed by ``[@attr]`` or ``[@attr='value']``. The result is the same as for
+		``root.findall(".//" + path)`` (see, e.g., :py:data:`.utils.TOC_PAIRS` for such paths).
+
+		:param str path: the path expression
+		:return: list of elements, in document order
+		"""
+		steps = [_STEP.match(step).groups() for step in path.split('/')]
+		if len(steps) == 1:
+			return self.find_all(*steps[0])
+		parent_tag, parent_attribute, parent_value = steps[0]
+		return [e for e in self.find_all(*steps[1])
+				if self.parent(e) is not None and self.parent(e) is not self._root and
+				self._matches(self.parent(e), parent_tag, parent_attribute, parent_value)]
+
+	def parent(self, element):
+		"""
+		The parent of an element.
+
+		:param element: the element
+		:return: the parent element, or `None` for the root (or for an element not in the tree)
+		"""
+		return self._parent.get(element)
+
+	def ancestors(self, element):
+		"""
+		The ancestors of an element, starting with its parent.
+
+		:param element: the element
+		:return: a generator of elements
+		"""
+		parent = self._parent.get(element)
+		while parent is not None:
+			yield parent
+			parent = self._parent.get(parent)
+
+	def invalidate(self):
+		"""
+		Mark the lookup tables as outdated, e.g., after the change of a tag name; the tables are rebuilt by the next lookup.
+		"""
+		self._outdated = True
+
+	def add(self, element, parent):
+		"""
+		Add an element, that has just been added to the tree, and its descendants to the index. The new elements may be
+		anywhere in the document, i.e., the lookup tables are rebuilt (in document order) by the next lookup.
+
+		:param element: the new element
+		:param parent: the parent of the new element
+		"""
+		self._parent[element] = parent
+		for descendant in element.iter():
+			for child in descendant:
+				self._parent[child] = descendant
+		self.invalidate()
+
+	def reparent(self, element, parent):
+		"""
+		Record that an element has been moved to a new parent. This may change the document order of the element and
+		its descendants, i.e., the lookup tables are rebuilt by the next lookup.
+
+		:param element: the element
+		:param parent: the new parent of the element
+		"""
+		self._parent[element] = parent
+		self.invalidate()
+
+	def set(self, element, name, value):
+		"""
+		Set an attribute of an element of the tree. If the element did not have the attribute, or if the attribute is
+		``id`` or ``class``, the lookup tables are rebuilt by the next lookup.
+
+		:param element: the element
+		:param str name: the name of the attribute
+		:param str value: the value of the attribute
+		"""
+		if name not in element.attrib or name in ("id", "class"):
+			self.invalidate()
+		element.set(name, value)
+
+	def remove(self, element):
+		"""
+		Remove an element, that has just been removed from the tree, and its descendants from the index.
+
+		:param element: the element
+		"""
+		removed = set(element.iter())
+		if self._outdated:
+			# The tables are rebuilt anyway
+			for e in removed:
+				self._parent.pop(e, None)
+			return
+		# Only the lists the removed elements may be on are filtered
+		tags, ids, classes, attributes = set(), set(), set(), set()
+		for e in removed:
+			self._parent.pop(e, None)
+			if isinstance(e.tag, basestring):
+				tags.add(e.tag)
+				for name, value in e.items():
+					attributes.add(name)
+					if name == "id":
+						ids.add(value)
+					elif name == "class":
+						classes.update(value.split())
+		for table, keys in ((self._by_tag, tags), (self._by_id, ids), (self._by_class, classes), (self._by_attribute, attributes)):
+			for key in keys:
+				if key in table:
+					table[key] = [e for e in table[key] if e not in removed]
@@ -0,0 +1,216 @@
+"""
+The :py:class:`Downloader` class manages the retrieval of the resources that have to be added to the book. Instead
+of opening one blocking :py:class:`.utils.HttpSession` after the other, the URL-s are handed over to a bounded pool
+of threads, so that the (many) round trips to the servers overlap. The results are returned in the same order
+as the requests, i.e., the caller can still make the changes on the DOM tree and on the book in a deterministic
+order; the final output is identical to the one generated by a serial retrieval.
+
+The number of parallel retrievals is limited both globally (the size of the pool) and per host, to avoid hammering
+the same server with too many requests at the same time.
+
+A :py:class:`Downloader` instance is used for the creation of one book, and it retrieves each (absolute) URL only once:
+the result of the retrieval is kept (in memory or, for large contents, in a temporary file) and shared by all the elements,
+CSS files, etc., referring to the same resource, until the downloader is closed.
+If the same URL is requested while its retrieval is still in progress, the request waits for that retrieval to finish.
+
+Resources that are (very likely) needed later may be retrieved speculatively (see :py:meth:`Downloader.prefetch`): their
+retrieval starts in the background at once, e.g., while the source of the document is still being parsed, and the
+later requests for the same URL-s get the results of those retrievals.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from .utils import HttpSession
+from .config import DOWNLOAD_WORKERS, DOWNLOAD_PER_HOST
+
+
+# noinspection PyPep8
+class _Retrieval(object):
+	"""
+	A retrieval of a URL, possibly in progress.
+	"""
+	def __init__(self):
+		self._done    = threading.Event()
+		self._session = None
+
+	def set(self, session):
+		"""Set the result of the retrieval, and wake up the threads waiting for it."""
+		self._session = session
+		self._done.set()
+
+	def wait(self):
+		"""
+		Wait for the end of the retrieval.
+
+		:return: a :py:class:`.utils.HttpSession` instance, or None if the retrieval has been interrupted
+		"""
+		self._done.wait()
+		return self._session
+
+
+# noinspection PyPep8
+class Downloader(object):
+	"""
+	Bounded pool of threads retrieving resources via :py:class:`.utils.HttpSession` instances. Each URL is retrieved only once.
+
+	:param int workers: maximum number of parallel retrievals overall; a value of 1 (or less) means a serial retrieval
+	:param int per_host: maximum number of parallel retrievals to the same host
+	"""
+	def __init__(self, workers=DOWNLOAD_WORKERS, per_host=DOWNLOAD_PER_HOST):
+		self._workers    = max(1, workers)
+		self._per_host   = max(1, per_host)
+		self._pool       = None
+		self._hosts      = {}
+		self._hosts_lock = threading.Lock()
+		self._retrievals = {}
+		self._lock       = threading.Lock()
+
+	@property
+	def workers(self):
+		"""Maximum number of parallel retrievals"""
+		return self._workers
+
+	@property
+	def per_host(self):
+		"""Maximum number of parallel retrievals to the same host"""
+		return self._per_host
+
+	def _host_semaphore(self, url):
+		"""
+		Get the semaphore controlling the parallel access to the host of the URL; the semaphore is created on the fly
+		if necessary.
+
+		:param str url: URL to be retrieved
+		:return: a :py:class:`threading.BoundedSemaphore` instance
+		"""
+		host = urlparse(url).netloc
+		with self._hosts_lock:
+			if host not in self._hosts:
+				self._hosts[host] = threading.BoundedSemaphore(self._per_host)
+			return self._hosts[host]
+
+	def fetch(self, url, check_media_type=False):
+		"""
+		Retrieve a single resource in the calling thread, respecting the per host limit. The content of the
+		resource is read in full before returning (see :py:meth:`.utils.HttpSession.buffer`). If the URL has already been
+		retrieved, or is being retrieved by another thread, that result is returned.
+
+		:param str url: the URL to be retrieved
+		:param boolean check_media_type: whether the media type should be checked against the acceptable media types
+		:return: a :py:class:`.utils.HttpSession` instance
+		"""
+		with self._lock:
+			retrieval = self._retrievals.get(url)
+			owner     = retrieval is None
+			if owner:
+				retrieval = self._retrievals[url] = _Retrieval()
+
+		if owner:
+			session = None
+			try:
+				with self._host_semaphore(url):
+					session = HttpSession(url)
+					session.buffer()
+			finally:
+				retrieval.set(session)
+		else:
+			session = retrieval.wait()
+			if session is None:
+				# The original retrieval has been interrupted; the resource is retrieved again, without sharing
+				with self._host_semaphore(url):
+					session = HttpSession(url)
+					session.buffer()
+
+		return session.checked() if check_media_type else session
+
+	def fetch_all(self, urls, check_media_type=False):
+		"""
+		Retrieve a series of resources in parallel. Repeated URL-s are retrieved only once.
+
+		:param urls: list of URL-s to be retrieved
+		:param boolean check_media_type: whether the media type should be checked against the acceptable media types
+		:return: list of :py:class:`.utils.HttpSession` instances, in the same order as the URL-s
+		"""
+		unique, seen = [], set()
+		for url in urls:
+			if url not in seen:
+				seen.add(url)
+				unique.append(url)
+
+		sessions  = self.map(lambda u: self.fetch(u, check_media_type), unique)
+		retrieved = dict(zip(unique, sessions))
+		return [retrieved[url] for url in urls]
+
+	def prefetch(self, urls):
+		"""
+		Start the retrieval of resources in the background, without waiting for the results. A later :py:meth:`fetch` (or
+		:py:meth:`fetch_all`) of the same URL gets the result of that retrieval, possibly waiting for its end; a resource that
+		is not requested later is simply released when the downloader is closed. Nothing is done if the retrieval is serial.
+
+		:param urls: list of URL-s to be retrieved
+		"""
+		if self._workers == 1:
+			return
+		with self._lock:
+			urls = [url for url in set(urls) if url not in self._retrievals]
+		pool = self._get_pool()
+		for url in sorted(urls):
+			pool.apply_async(self.fetch, (url,))
+
+	def _get_pool(self):
+		"""
+		The pool of threads, created on the first use.
+
+		:return: a :py:class:`multiprocessing.pool.ThreadPool` instance
+		"""
+		with self._lock:
+			if self._pool is None:
+				self._pool = ThreadPool(self._workers)
+			return self._pool
+
+	def map(self, function, items):
+		"""
+		Apply a function on each item using the threads of the pool. The function is typically a retrieval followed
+		by some processing of the result, like parsing (see :py:class:`.cssurls.CSSList`). It may use :py:meth:`fetch` but
+		should not, itself, call :py:meth:`map` or :py:meth:`fetch_all`.
+
+		:param function: function with one argument
+		:param items: list of items
+		:return: list of the results, in the same order as the items
+		"""
+		if self._workers == 1 or len(items) < 2:
+			return [function(item) for item in items]
+
+		pool    = self._get_pool()
+		results = [pool.apply_async(function, (item,)) for item in items]
+		return [r.get() for r in results]
+
+	def close(self):
+		"""
+		Release the threads of the pool (if any), and the content of the retrieved resources.
+		"""
+		if self._pool is not None:
+			self._pool.close()
+			self._pool.join()
+			self._pool = None
+		with self._lock:
+			retrievals, self._retrievals = self._retrievals, {}
+		for retrieval in retrievals.values():
+			session = retrieval.wait()
+			if session is not None:
+				session.close()
+
+	# The methods below are necessary to use the class in a "with ... as" python structure
+	def __enter__(self):
+		return self
+
+	# noinspection PyUnusedLocal
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
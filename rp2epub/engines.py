@@ -0,0 +1,282 @@
+"""
+The tree engines encapsulate the parsing of the HTML sources into a DOM tree and the serialization of the trees into
+XHTML. Two engines are available:
+
+* ``etree``: the HTML source is parsed by ``html5lib`` into a standard :py:mod:`xml.etree.ElementTree` tree, which is
+  serialized by ``ElementTree`` itself. This is the default; it has no other dependency than ``html5lib``.
+* ``lxml``: the HTML source is parsed into an `lxml <http://lxml.de>`__ tree, which is then serialized by the (C based)
+  serializer of lxml. The tree is built by the (C based) `html5-parser <https://pypi.python.org/pypi/html5-parser>`__
+  package, if installed; otherwise ``html5lib`` builds the lxml tree. This engine requires the (optional) lxml package
+  to be installed; it is considerably faster for large documents if html5-parser is installed, too.
+
+The DOM transformations (see :py:class:`.utils.Utils`) are the same for both engines, insofar as they rely on the
+``ElementTree`` interface that lxml also implements. The (few) operations that differ are provided by the engines
+themselves; :py:func:`engine_of` returns the engine of a tree or element.
+
+In both trees, the HTML elements are not in a namespace, whereas the SVG and MathML elements are in their own
+namespaces (e.g., ``{http://www.w3.org/2000/svg}svg``). The main difference between the two engines is the XHTML
+namespace declaration: lxml does not accept ``xmlns`` as an attribute name; instead, the lxml engine serializes the
+``<html>`` element in the XHTML namespace (declared as the default namespace), the SVG and MathML elements with a
+namespace prefix.
+
+.. py:data:: ENGINES
+
+  The engine classes, keyed by the names used to select them.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+from StringIO import StringIO
+from xml.etree.ElementTree import ElementTree, tostring
+import html5lib
+
+from . import R2EError
+
+try:
+	from lxml import etree as lxml_etree
+except ImportError:
+	lxml_etree = None
+
+try:
+	import html5_parser
+except (ImportError, RuntimeError):
+	# html5-parser raises a RuntimeError if it is not built against the same libxml2 version as lxml
+	html5_parser = None
+
+#: The XHTML namespace, required for the content documents by EPUB
+XHTML_NAMESPACE = "http://www.w3.org/1999/xhtml"
+
+# Prefixes of the namespaces of the foreign (i.e., SVG and MathML) elements in the lxml trees
+_FOREIGN_PREFIXES = {
+	"http://www.w3.org/2000/svg"         : "svg",
+	"http://www.w3.org/1998/Math/MathML" : "m"
+}
+
+
+# noinspection PyPep8
+class ElementTreeEngine(object):
+	"""
+	Engine based on the standard :py:mod:`xml.etree.ElementTree` module.
+	"""
+	name = "etree"
+
+	@staticmethod
+	def parse(data):
+		"""
+		Parse an HTML source.
+
+		:param data: file-like object with the HTML source
+		:return: the root (``<html>``) element of the tree
+		"""
+		return html5lib.parse(data, namespaceHTMLElements=False)
+
+	@staticmethod
+	def tree(root):
+		"""
+		The tree object for a root element (used, e.g., for the serialization).
+
+		:param root: the root element
+		:return: an :py:class:`xml.etree.ElementTree.ElementTree` instance
+		"""
+		return ElementTree(root)
+
+	@staticmethod
+	def set_xhtml_namespace(root):
+		"""
+		Set the XHTML namespace on the root element of an HTML tree.
+
+		:param root: the root element
+		"""
+		root.set("xmlns", XHTML_NAMESPACE)
+
+	@staticmethod
+	def tostring(element):
+		"""
+		Serialize an element, without an XML declaration.
+
+		:param element: the element
+		:return: the UTF-8 encoded XML serialization
+		"""
+		return tostring(element, encoding="utf-8", method="xml")
+
+	@staticmethod
+	def write(tree, stream):
+		"""
+		Serialize a full tree, with an XML declaration, into a stream. The serialization is written in (many, small) pieces.
+
+		:param tree: the tree, as returned by :py:meth:`tree`
+		:param stream: file-like object to write the UTF-8 encoded XML serialization into
+		"""
+		tree.write(stream, encoding="utf-8", xml_declaration=True, method="xml")
+
+	@staticmethod
+	def serialize(tree):
+		"""
+		Serialize a full tree, with an XML declaration.
+
+		:param tree: the tree, as returned by :py:meth:`tree`
+		:return: the UTF-8 encoded XML serialization
+		"""
+		content = StringIO()
+		ElementTreeEngine.write(tree, content)
+		retval = content.getvalue()
+		content.close()
+		return retval
+
+
+# noinspection PyPep8
+class LxmlEngine(object):
+	"""
+	Engine based on lxml.
+
+	:raises R2EError: if the lxml package is not installed
+	"""
+	name = "lxml"
+
+	def __init__(self):
+		if lxml_etree is None:
+			raise R2EError("The 'lxml' engine requires the lxml package, which is not installed")
+
+	@staticmethod
+	def parse(data):
+		"""
+		Parse an HTML source, with html5-parser if available, with html5lib otherwise.
+
+		:param data: file-like object with the HTML source
+		:return: the root (``<html>``) element of the tree
+		"""
+		if html5_parser is not None:
+			# Without namespaces, html5-parser would also put the SVG and MathML elements out of their namespaces
+			return _remove_xhtml_namespace(html5_parser.parse(data.read(), namespace_elements=True, keep_doctype=False))
+		return html5lib.parse(data, treebuilder="lxml", namespaceHTMLElements=False).getroot()
+
+	@staticmethod
+	def tree(root):
+		"""
+		The tree object for a root element (used, e.g., for the serialization).
+
+		:param root: the root element
+		:return: an :py:class:`lxml.etree._ElementTree` instance
+		"""
+		return root.getroottree()
+
+	@staticmethod
+	def set_xhtml_namespace(root):
+		"""
+		Set the XHTML namespace on the root element of an HTML tree. lxml does not accept ``xmlns`` as an attribute
+		name; the namespace is declared by :py:meth:`serialize` instead, i.e., this method does nothing.
+
+		:param root: the root element
+		"""
+		pass
+
+	@staticmethod
+	def tostring(element):
+		"""
+		Serialize an element, without an XML declaration.
+
+		:param element: the element
+		:return: the UTF-8 encoded XML serialization
+		"""
+		return lxml_etree.tostring(element, encoding="utf-8", method="xml")
+
+	@staticmethod
+	def write(tree, stream):
+		"""
+		Serialize a full tree, with an XML declaration, into a stream. The serialization is written in chunks. If the
+		root is an (un-namespaced) ``<html>`` element, it is serialized in the XHTML namespace, declared as the default
+		namespace, i.e., the (un-namespaced) HTML elements within are in the XHTML namespace, too.
+
+		:param tree: the tree, as returned by :py:meth:`tree`
+		:param stream: file-like object to write the UTF-8 encoded XML serialization into
+		"""
+		root = tree.getroot()
+		with lxml_etree.xmlfile(stream, encoding="utf-8") as xf:
+			xf.write_declaration()
+			if root.tag != "html":
+				xf.write(root)
+				return
+			with xf.element("{%s}html" % XHTML_NAMESPACE, dict(root.attrib), nsmap={None: XHTML_NAMESPACE}):
+				if root.text:
+					xf.write(root.text)
+				for child in root:
+					xf.write(child)
+
+	@staticmethod
+	def serialize(tree):
+		"""
+		Serialize a full tree, with an XML declaration. If the root is an (un-namespaced) ``<html>`` element, it is
+		serialized in the XHTML namespace.
+
+		:param tree: the tree, as returned by :py:meth:`tree`
+		:return: the UTF-8 encoded XML serialization
+		"""
+		content = StringIO()
+		LxmlEngine.write(tree, content)
+		retval = content.getvalue()
+		content.close()
+		return retval
+
+
+def _remove_xhtml_namespace(root):
+	"""
+	Take the HTML elements of an lxml tree out of the XHTML namespace, keeping the SVG and MathML elements in their
+	namespaces. The namespaces of the SVG and MathML subtrees are declared with a prefix (see
+	:py:data:`_FOREIGN_PREFIXES`): the HTML elements within (e.g., in ``<foreignObject>``) must not fall into the
+	namespace of their foreign ancestor when serialized, i.e., there must be no default namespace declaration on them.
+
+	:param root: the root of the tree, with all elements in their namespaces
+	:return: the root of the tree
+	"""
+	html_namespace = "{%s}" % XHTML_NAMESPACE
+	foreign_roots  = []
+	for element in root.iter(lxml_etree.Element):
+		if element.tag.startswith(html_namespace):
+			element.tag = element.tag[len(html_namespace):]
+		else:
+			# The top of a foreign subtree (its parent being an HTML element, or in another foreign namespace)
+			parent = element.getparent()
+			if parent is not None and lxml_etree.QName(parent).namespace != lxml_etree.QName(element).namespace:
+				foreign_roots.append(element)
+	for element in foreign_roots:
+		namespace = lxml_etree.QName(element).namespace
+		copy = lxml_etree.Element(element.tag, dict(element.attrib), nsmap={_FOREIGN_PREFIXES.get(namespace, "ns0"): namespace})
+		copy.text, copy.tail = element.text, element.tail
+		copy.extend(list(element))
+		element.getparent().replace(element, copy)
+	lxml_etree.cleanup_namespaces(root)
+	return root
+
+
+ENGINES = {
+	ElementTreeEngine.name : ElementTreeEngine,
+	LxmlEngine.name        : LxmlEngine
+}
+
+
+def get_engine(name):
+	"""
+	Get an engine by its name.
+
+	:param str name: the name of the engine, a key in :py:data:`ENGINES`
+	:return: the engine instance
+	:raises R2EError: if the engine is unknown, or cannot be used
+	"""
+	if name not in ENGINES:
+		raise R2EError("Unknown tree engine '%s'" % name)
+	return ENGINES[name]()
+
+
+def engine_of(element):
+	"""
+	Get the engine of a tree or of an element.
+
+	:param element: an element or a tree
+	:return: the engine instance
+	"""
+	if lxml_etree is not None and isinstance(element, (lxml_etree._Element, lxml_etree._ElementTree)):
+		return LxmlEngine()
+	return ElementTreeEngine()
@@ -0,0 +1,352 @@
+"""
+The :py:class:`HttpCache` class implements a simple, persistent, disk based cache for the HTTP retrievals done by
+:py:class:`.utils.HttpSession`. Most of the resources that are downloaded for a book (the official W3C style sheets,
+logos, etc.) are the same for all books; with the cache in place these are not downloaded again and again.
+
+Each cached resource is stored in two files in the cache directory, named after the hash of the URL: a ``.body`` file
+with the content, and a ``.json`` file with the metadata (media type, validators, expiration time). A cached entry is:
+
+* used without any network access if it is still fresh (per the ``Cache-Control: max-age`` or ``Expires`` header fields
+  of the original response);
+* revalidated through a conditional HTTP ``GET`` (using the ``ETag`` and ``Last-Modified`` values of the original
+  response) if it is stale; if the server answers with a ``304``, the cached content is used.
+
+The total size of the cached content is capped; if the cap is exceeded, the least recently used entries are removed.
+Files are written under a temporary name and renamed when complete, so several processes may share the same cache
+directory.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import os
+import os.path
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+from .config import HTTP_CACHE_SIZE
+
+
+def _parse_http_date(value):
+	"""
+	Parse an HTTP date.
+
+	:param str value: date in one of the HTTP formats, or None
+	:return: seconds since the epoch, or None if the value is missing or cannot be parsed
+	"""
+	if value is None:
+		return None
+	parsed = parsedate_tz(value)
+	return mktime_tz(parsed) if parsed is not None else None
+
+
+def _expiration(headers, now):
+	"""
+	Calculate the expiration time of a response, based on the ``Cache-Control``, ``Expires``, and ``Date`` header fields.
+
+	:param headers: the header fields of the response (a :py:class:`mimetools.Message` instance)
+	:param now: the current time, in seconds since the epoch
+	:return: expiration time in seconds since the epoch, or None if the response must not be stored
+	"""
+	cache_control = [d.strip().lower() for d in (headers.getheader("Cache-Control") or "").split(',')]
+	if "no-store" in cache_control:
+		return None
+	if "no-cache" in cache_control:
+		return now
+
+	for directive in cache_control:
+		if directive.startswith("max-age="):
+			try:
+				age = int(headers.getheader("Age") or 0)
+				return now + int(directive[len("max-age="):]) - age
+			except ValueError:
+				break
+
+	expires = _parse_http_date(headers.getheader("Expires"))
+	if expires is not None:
+		served = _parse_http_date(headers.getheader("Date"))
+		return now + expires - (served if served is not None else now)
+	return now
+
+
+# noinspection PyPep8
+class CacheEntry(object):
+	"""
+	Metadata of a cached resource.
+
+	:param str path: path of the metadata and content files, without the suffix
+	:param dict metadata: metadata stored in the ``.json`` file
+	"""
+	def __init__(self, path, metadata):
+		self._path     = path
+		self._metadata = metadata
+
+	@property
+	def url(self):
+		"""URL of the resource"""
+		return self._metadata["url"]
+
+	@property
+	def media_type(self):
+		"""Media type of the resource"""
+		return self._metadata["media_type"]
+
+	@property
+	def etag(self):
+		"""``ETag`` header field value of the original response (or None)"""
+		return self._metadata.get("etag")
+
+	@property
+	def last_modified(self):
+		"""``Last-Modified`` header field value of the original response (or None)"""
+		return self._metadata.get("last_modified")
+
+	@property
+	def fresh(self):
+		"""True if the entry can be used without revalidation"""
+		return self._metadata["expires"] > time.time()
+
+	@property
+	def metadata(self):
+		"""The metadata dictionary, as stored in the ``.json`` file"""
+		return self._metadata
+
+	def conditional_headers(self):
+		"""
+		The header fields to be used for a conditional request, i.e., for the revalidation of the entry.
+
+		:return: dictionary of header field names and values
+		"""
+		headers = {}
+		if self.etag is not None:
+			headers["If-None-Match"] = self.etag
+		if self.last_modified is not None:
+			headers["If-Modified-Since"] = self.last_modified
+		return headers
+
+	def open(self):
+		"""
+		Open the cached content.
+
+		:return: a file object
+		"""
+		return open(self._path + ".body", "rb")
+
+
+# noinspection PyPep8
+class _CachingReader(object):
+	"""
+	File-like wrapper around an HTTP response: whatever is read from the response is also written into a
+	temporary file of the cache. If the response is read to the end, the content (and the metadata) are stored in the cache;
+	otherwise the temporary file is removed. The end is reached with a read returning less than requested (a read of
+	the whole response, or a bounded read at the end of the content), or with the length announced by the
+	``Content-Length`` header; if the length of the content differs from the announced length (e.g., because the connection
+	has been closed prematurely), the content is not stored.
+
+	:param cache: the cache
+	:type cache: :py:class:`HttpCache`
+	:param response: the response, as returned by ``urllib2.urlopen``
+	:param str path: path of the metadata and content files, without the suffix
+	:param dict metadata: metadata to be stored when the content is complete
+	"""
+	def __init__(self, cache, response, path, metadata):
+		self._cache    = cache
+		self._response = response
+		self._path     = path
+		self._metadata = metadata
+		self._size     = 0
+		length         = response.info().getheader("Content-Length")
+		self._length   = int(length) if length is not None and length.isdigit() else None
+		fd, self._temp = tempfile.mkstemp(dir=cache.directory, suffix=".tmp")
+		self._file     = os.fdopen(fd, "wb")
+
+	def read(self, size=-1):
+		read_all = size is None or size < 0
+		data = self._response.read() if read_all else self._response.read(size)
+		if self._file is not None:
+			if len(data) > 0:
+				self._file.write(data)
+				self._size += len(data)
+				if self._size > self._cache.max_size:
+					self._discard()
+			if self._file is not None and (read_all or len(data) < size or self._size == self._length):
+				if self._length is None or self._size == self._length:
+					self._commit()
+				else:
+					self._discard()
+		return data
+
+	def info(self):
+		return self._response.info()
+
+	def getcode(self):
+		return self._response.getcode()
+
+	def geturl(self):
+		return self._response.geturl()
+
+	def close(self):
+		self._discard()
+		self._response.close()
+
+	def _commit(self):
+		self._file.close()
+		self._file = None
+		self._metadata["size"] = self._size
+		self._cache.commit(self._temp, self._path, self._metadata)
+
+	def _discard(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+			try:
+				os.remove(self._temp)
+			except OSError:
+				pass
+
+
+# noinspection PyPep8
+class HttpCache(object):
+	"""
+	Disk based cache for HTTP retrievals.
+
+	:param str directory: directory for the cache files; created if it does not exist
+	:param int max_size: maximum size of the cached content, in bytes
+	"""
+	def __init__(self, directory, max_size=HTTP_CACHE_SIZE):
+		self._directory = directory
+		self._max_size  = max_size
+		self._lock      = threading.Lock()
+		if not os.path.exists(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				# another process may have created it in the meantime
+				if not os.path.isdir(directory):
+					raise
+
+	@property
+	def directory(self):
+		"""Directory of the cache files"""
+		return self._directory
+
+	@property
+	def max_size(self):
+		"""Maximum size of the cached content, in bytes"""
+		return self._max_size
+
+	def _path(self, url):
+		return os.path.join(self._directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+	def lookup(self, url):
+		"""
+		Look up a URL in the cache. The entry is marked as recently used.
+
+		:param str url: URL of the resource
+		:return: a :py:class:`CacheEntry` instance, or None if the resource is not in the cache
+		"""
+		path = self._path(url)
+		try:
+			with open(path + ".json") as f:
+				metadata = json.load(f)
+			if metadata["url"] != url or not os.path.exists(path + ".body"):
+				return None
+			os.utime(path + ".json", None)
+		except (IOError, OSError, ValueError, KeyError):
+			return None
+		return CacheEntry(path, metadata)
+
+	def refresh(self, entry, headers):
+		"""
+		Update the metadata of an entry after a successful revalidation (i.e., a ``304`` response).
+
+		:param entry: the cache entry
+		:type entry: :py:class:`CacheEntry`
+		:param headers: header fields of the ``304`` response
+		"""
+		metadata = dict(entry.metadata)
+		expires  = _expiration(headers, time.time())
+		metadata["expires"] = expires if expires is not None else 0
+		if headers.getheader("ETag") is not None:
+			metadata["etag"] = headers.getheader("ETag")
+		if headers.getheader("Last-Modified") is not None:
+			metadata["last_modified"] = headers.getheader("Last-Modified")
+		self._write_metadata(self._path(entry.url), metadata)
+
+	def store(self, url, response):
+		"""
+		Store a response in the cache, if possible. Storage happens while the content is read; the caller should use
+		the returned object instead of the original response.
+
+		:param str url: URL of the resource
+		:param response: the response, as returned by ``urllib2.urlopen``
+		:return: a file-like object to be used instead of the response
+		"""
+		headers = response.info()
+		expires = _expiration(headers, time.time())
+		etag, last_modified = headers.getheader("ETag"), headers.getheader("Last-Modified")
+		length = headers.getheader("Content-Length")
+		if expires is None or (etag is None and last_modified is None and expires <= time.time()):
+			# The content cannot be stored, or it would be useless to store it
+			return response
+		if length is not None and length.isdigit() and int(length) > self._max_size:
+			return response
+
+		metadata = {
+			"url"           : url,
+			"media_type"    : headers.gettype(),
+			"etag"          : etag,
+			"last_modified" : last_modified,
+			"expires"       : expires
+		}
+		return _CachingReader(self, response, self._path(url), metadata)
+
+	def commit(self, temp, path, metadata):
+		"""
+		Finalize the storage of a content, and remove the least recently used entries if the cache has become too large.
+
+		:param str temp: the temporary file with the content
+		:param str path: path of the metadata and content files, without the suffix
+		:param dict metadata: metadata of the entry
+		"""
+		with self._lock:
+			os.rename(temp, path + ".body")
+			self._write_metadata(path, metadata)
+			self._evict()
+
+	def _write_metadata(self, path, metadata):
+		fd, temp = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+		with os.fdopen(fd, "w") as f:
+			json.dump(metadata, f)
+		os.rename(temp, path + ".json")
+
+	def _evict(self):
+		"""Remove the least recently used entries until the total size is below the cap"""
+		entries = []
+		total   = 0
+		for name in os.listdir(self._directory):
+			if name.endswith(".body"):
+				path = os.path.join(self._directory, name[:-5])
+				try:
+					size = os.path.getsize(path + ".body")
+					used = os.path.getmtime(path + ".json") if os.path.exists(path + ".json") else 0
+				except OSError:
+					continue
+				entries.append((used, size, path))
+				total += size
+
+		for used, size, path in sorted(entries):
+			if total <= self._max_size:
+				break
+			for suffix in (".json", ".body"):
+				try:
+					os.remove(path + suffix)
+				except OSError:
+					pass
+			total -= size
@@ -0,0 +1,244 @@
+"""
+Asynchronous generation of the books by the HTTP service (see :py:mod:`.service`). The generation of a large document
+may take well over a minute, i.e., more than what proxies usually accept for a response. Instead, a client may submit
+a job, and get its identifier at once; it then polls the status of the job (which also reports the stage of the
+generation, see :py:data:`.doc2epub.STAGES`) and, when the job is done, downloads the book.
+
+The jobs are run by a bounded pool of worker threads (:py:class:`JobQueue`). The number of jobs waiting or running is
+limited; further submissions are rejected until some jobs are completed, i.e., the clients get a back pressure instead
+of an ever growing queue.
+
+The jobs are recorded in an SQLite database, and the books are stored as files, in the directory of a
+:py:class:`JobStore`. The store survives a restart of the service: the jobs that were waiting or running are run (again)
+when the service starts. Completed jobs, and their books, are removed after :py:data:`.config.JOB_RETENTION` seconds.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import os
+import os.path
+import sys
+import time
+import uuid
+import sqlite3
+import threading
+import traceback
+import Queue
+
+from .doc2epub import DocWrapper
+from .config import JOB_WORKERS, JOB_QUEUE_SIZE, JOB_RETENTION
+
+# States of a job
+QUEUED  = "queued"
+RUNNING = "running"
+DONE    = "done"
+FAILED  = "failed"
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS jobs (
+	id         TEXT PRIMARY KEY,
+	url        TEXT NOT NULL,
+	respec     INTEGER NOT NULL,
+	state      TEXT NOT NULL,
+	stage      TEXT,
+	progress   REAL NOT NULL DEFAULT 0,
+	short_name TEXT,
+	error      TEXT,
+	submitted  REAL NOT NULL,
+	started    REAL,
+	finished   REAL
+)"""
+
+
+# noinspection PyPep8
+class JobStore(object):
+	"""
+	Persistent record of the jobs: an SQLite database (``jobs.sqlite``), and the books of the completed jobs, in a directory.
+
+	:param str directory: the directory of the store; it is created if it does not exist
+	"""
+	def __init__(self, directory):
+		self._directory = directory
+		self._database  = os.path.join(directory, "jobs.sqlite")
+		self._lock      = threading.Lock()
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		self._execute(_SCHEMA)
+
+	def _connect(self):
+		# A new connection for each operation: the store is used from several threads
+		connection = sqlite3.connect(self._database, timeout=30)
+		connection.row_factory = sqlite3.Row
+		return connection
+
+	def _execute(self, statement, parameters=()):
+		with self._lock:
+			connection = self._connect()
+			try:
+				with connection:
+					return connection.execute(statement, parameters).fetchall()
+			finally:
+				connection.close()
+
+	def book_path(self, job_id):
+		"""
+		The path of the book of a job.
+
+		:param str job_id: the identifier of the job
+		:rtype: str
+		"""
+		return os.path.join(self._directory, job_id + ".epub")
+
+	def add(self, url, is_respec):
+		"""
+		Record a new job.
+
+		:param str url: the URL of the source
+		:param boolean is_respec: whether the source is in ReSpec
+		:return: the identifier of the job
+		:rtype: str
+		"""
+		job_id = uuid.uuid4().hex
+		self._execute("INSERT INTO jobs (id, url, respec, state, submitted) VALUES (?, ?, ?, ?, ?)",
+					  (job_id, url, int(is_respec), QUEUED, time.time()))
+		return job_id
+
+	def get(self, job_id):
+		"""
+		Get the record of a job.
+
+		:param str job_id: the identifier of the job
+		:return: a dictionary with the columns of the record (``url``, ``respec``, ``state``, ``stage``, ``progress``, ``short_name``, ``error``, ``submitted``, ``started``, ``finished``), or `None` if the job is unknown
+		"""
+		rows = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+		return dict(rows[0]) if rows else None
+
+	def update(self, job_id, **fields):
+		"""
+		Change the record of a job.
+
+		:param str job_id: the identifier of the job
+		:param fields: the new values of the columns
+		"""
+		names = sorted(fields.keys())
+		self._execute("UPDATE jobs SET %s WHERE id = ?" % ", ".join("%s = ?" % name for name in names),
+					  tuple(fields[name] for name in names) + (job_id,))
+
+	def unfinished(self):
+		"""
+		The jobs that are waiting or running (e.g., when the service was stopped); these are all marked as waiting again.
+
+		:return: the identifiers of the jobs, in the order of submission
+		"""
+		self._execute("UPDATE jobs SET state = ?, stage = NULL, progress = 0 WHERE state = ?", (QUEUED, RUNNING))
+		return [row["id"] for row in self._execute("SELECT id FROM jobs WHERE state = ? ORDER BY submitted", (QUEUED,))]
+
+	def expire(self, before):
+		"""
+		Remove the jobs completed before a time, and their books.
+
+		:param float before: time in seconds since the epoch
+		"""
+		rows = self._execute("SELECT id FROM jobs WHERE state IN (?, ?) AND finished < ?", (DONE, FAILED, before))
+		for row in rows:
+			try:
+				os.remove(self.book_path(row["id"]))
+			except OSError:
+				pass
+		self._execute("DELETE FROM jobs WHERE state IN (?, ?) AND finished < ?", (DONE, FAILED, before))
+
+
+# noinspection PyPep8
+class JobQueue(object):
+	"""
+	Bounded pool of worker threads running the jobs of a store. The jobs left unfinished in the store (e.g., by a
+	previous run of the service) are queued at once.
+
+	:param store: the store of the jobs
+	:type store: :py:class:`JobStore`
+	:param int workers: number of books generated at the same time
+	:param int max_size: maximum number of jobs waiting or running
+	:param logger: a python logger (see the standard library module on logging) to be used all around;  `None` means no logging
+	:param options: further keyword arguments for the :py:class:`.doc2epub.DocWrapper` instances generating the books (e.g., ``cache_dir`` or ``engine``)
+	"""
+	def __init__(self, store, workers=JOB_WORKERS, max_size=JOB_QUEUE_SIZE, logger=None, **options):
+		self._store    = store
+		self._max_size = max_size
+		self._logger   = logger
+		self._options  = options
+		self._queue    = Queue.Queue()
+		self._lock     = threading.Lock()
+		self._pending  = 0
+		for job_id in store.unfinished():
+			self._pending += 1
+			self._queue.put(job_id)
+		for _ in range(workers):
+			worker = threading.Thread(target=self._work)
+			worker.daemon = True
+			worker.start()
+
+	@property
+	def store(self):
+		"""The store of the jobs"""
+		return self._store
+
+	def submit(self, url, is_respec):
+		"""
+		Submit a new job.
+
+		:param str url: the URL of the source
+		:param boolean is_respec: whether the source is in ReSpec
+		:return: the identifier of the job
+		:rtype: str
+		:raises Queue.Full: if the maximum number of jobs are already waiting or running
+		"""
+		self._store.expire(time.time() - JOB_RETENTION)
+		with self._lock:
+			if self._pending >= self._max_size:
+				raise Queue.Full()
+			self._pending += 1
+		job_id = self._store.add(url, is_respec)
+		self._queue.put(job_id)
+		return job_id
+
+	def _work(self):
+		while True:
+			job_id = self._queue.get()
+			try:
+				self._run(job_id)
+			finally:
+				with self._lock:
+					self._pending -= 1
+
+	def _run(self, job_id):
+		"""
+		Generate the book of a job; the state, the progress, and the result are recorded in the store.
+
+		:param str job_id: the identifier of the job
+		"""
+		job = self._store.get(job_id)
+		if job is None:
+			return
+		self._store.update(job_id, state=RUNNING, started=time.time())
+
+		def progress(stage, completed, total):
+			self._store.update(job_id, stage=stage, progress=float(completed) / total)
+
+		path = self._store.book_path(job_id)
+		temp = path + ".tmp"
+		# noinspection PyBroadException
+		try:
+			with DocWrapper(job["url"], is_respec=bool(job["respec"]), package=True, folder=False, logger=self._logger, progress=progress, **self._options) as wrapper:
+				with open(temp, "wb") as output:
+					wrapper.process(output)
+			os.rename(temp, path)
+			self._store.update(job_id, state=DONE, short_name=wrapper.document.short_name, finished=time.time())
+		except Exception:
+			message = "".join(traceback.format_exception(*sys.exc_info()))
+			if self._logger is not None:
+				self._logger.critical("Exception has been raised in job %s:\n%s" % (job_id, message))
+			if os.path.exists(temp):
+				os.remove(temp)
+			self._store.update(job_id, state=FAILED, error=message, finished=time.time())
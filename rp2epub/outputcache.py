@@ -0,0 +1,293 @@
+"""
+The :py:class:`OutputCache` class implements a persistent, disk based cache for the EPUB files generated by the HTTP
+service (see :py:mod:`.service`). A generated book is stored under a key made of the source URL (without its query
+string), the ReSpec configuration overrides in the query string of that URL (in a normalized order), and whether the
+source has to be transformed by the spec generator. Each book is also tagged with a fingerprint of the source, made of the
+validators (``ETag``, ``Last-Modified``) the source's server returns for a ``HEAD`` request: the book is reused as long
+as the fingerprint of the source does not change, i.e., the source is not even retrieved.
+
+The dated URLs of the W3C Technical Reports (e.g., ``https://www.w3.org/TR/2015/REC-...``) are immutable snapshots
+(see :py:data:`.config.IMMUTABLE_SOURCES`): the books generated for those are reused without checking the source, and
+they are retained permanently, i.e., they are never removed from the cache.
+
+Each cached book is stored in two files in the cache directory, named after the hash of the key: an ``.epub`` file
+with the book, and a ``.json`` file with the metadata (fingerprint, ``ETag`` of the book computed from its content,
+time of the generation, etc.). The total size of the (non permanent) books is capped; if the cap is exceeded, the
+least recently used books are removed. Files are written under a temporary name and renamed when complete, so several
+processes may share the same cache directory.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import os
+import os.path
+import re
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from urlparse import urlparse, urlunparse
+from email.utils import formatdate
+from urllib2 import Request
+
+from .connections import opener
+from .config import OUTPUT_CACHE_SIZE, IMMUTABLE_SOURCES
+
+_IMMUTABLE = [re.compile(pattern) for pattern in IMMUTABLE_SOURCES]
+
+# Fingerprint of the immutable sources
+PERMANENT = "permanent"
+
+
+def is_immutable(url):
+	"""
+	Check whether a source URL refers to an immutable document (see :py:data:`.config.IMMUTABLE_SOURCES`).
+
+	:param str url: the URL of the source
+	:rtype: boolean
+	"""
+	return any(pattern.match(url) for pattern in _IMMUTABLE)
+
+
+# noinspection PyPep8
+class OutputEntry(object):
+	"""
+	A book in the output cache.
+
+	:param str path: path of the files of the entry, without the suffix
+	:param dict metadata: the metadata of the entry
+	"""
+	def __init__(self, path, metadata):
+		self._path    = path
+		self.metadata = metadata
+
+	@property
+	def etag(self):
+		"""The (strong) entity tag of the book, computed from its content"""
+		return str(self.metadata["etag"])
+
+	@property
+	def modified(self):
+		"""Time of the generation of the book, in seconds since the epoch"""
+		return self.metadata["modified"]
+
+	@property
+	def last_modified(self):
+		"""Time of the generation of the book, in the format required by HTTP headers"""
+		return formatdate(self.modified, usegmt=True)
+
+	@property
+	def short_name(self):
+		"""Short name of the document, i.e., the name of the book without the ``.epub`` suffix"""
+		return self.metadata["short_name"]
+
+	@property
+	def size(self):
+		"""Size of the book in bytes"""
+		return self.metadata["size"]
+
+	@property
+	def permanent(self):
+		"""Whether the book has been generated from an immutable source, i.e., whether it never changes"""
+		return self.metadata["fingerprint"] == PERMANENT
+
+	def open(self):
+		"""
+		Open the book for reading.
+
+		:return: a file object
+		"""
+		return open(self._path + ".epub", "rb")
+
+
+# noinspection PyPep8
+class _OutputWriter(object):
+	"""
+	File-like object storing a book into the cache while it is being written; the content goes into a temporary file,
+	which becomes a cache entry when the writer is committed.
+	"""
+	def __init__(self, cache, path, metadata):
+		self._cache    = cache
+		self._path     = path
+		self._metadata = metadata
+		self._sha1     = hashlib.sha1()
+		self._size     = 0
+		fd, self._temp = tempfile.mkstemp(dir=cache.directory, suffix=".tmp")
+		self._file     = os.fdopen(fd, "wb")
+
+	def write(self, data):
+		self._file.write(data)
+		self._sha1.update(data)
+		self._size += len(data)
+
+	def commit(self):
+		"""
+		Turn the stored book into a cache entry.
+
+		:return: the new entry
+		:rtype: :py:class:`OutputEntry`
+		"""
+		self._file.close()
+		self._metadata["etag"]     = '"%s"' % self._sha1.hexdigest()
+		self._metadata["size"]     = self._size
+		self._metadata["modified"] = time.time()
+		self._cache.commit(self._temp, self._path, self._metadata)
+		return OutputEntry(self._path, self._metadata)
+
+	def discard(self):
+		"""Forget about the book (e.g., because its generation failed)."""
+		self._file.close()
+		try:
+			os.remove(self._temp)
+		except OSError:
+			pass
+
+
+# noinspection PyPep8
+class OutputCache(object):
+	"""
+	Persistent cache of the generated books.
+
+	:param str directory: the directory of the cache; it is created if it does not exist
+	:param int max_size: maximum total size (in bytes) of the books that are not permanent
+	"""
+	def __init__(self, directory, max_size=OUTPUT_CACHE_SIZE):
+		self._directory = directory
+		self._max_size  = max_size
+		self._lock      = threading.Lock()
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	@property
+	def directory(self):
+		"""The directory of the cache"""
+		return self._directory
+
+	@staticmethod
+	def key(url, is_respec):
+		"""
+		The key of the book generated from a source: the URL without its query string, the (sorted) ReSpec configuration
+		overrides in the query string, and whether the source is in ReSpec.
+
+		:param str url: the URL of the source
+		:param boolean is_respec: whether the source is in ReSpec
+		:rtype: str
+		"""
+		url_tuples = urlparse(url)
+		overrides  = sorted(setting for setting in url_tuples.query.split(';') if setting != "")
+		base       = urlunparse((url_tuples.scheme, url_tuples.netloc, url_tuples.path, "", "", ""))
+		return json.dumps([base, overrides, bool(is_respec)])
+
+	@staticmethod
+	def fingerprint(url):
+		"""
+		The fingerprint of a source, made of the validators returned by a ``HEAD`` request.
+
+		:param str url: the URL of the source
+		:return: the fingerprint; :py:data:`PERMANENT` for an immutable source; `None` if the source cannot be reached or if it has no validators, i.e., if it cannot be cached
+		"""
+		if is_immutable(url):
+			return PERMANENT
+		request = Request(url)
+		request.get_method = lambda: "HEAD"
+		# noinspection PyBroadException
+		try:
+			response = opener.open(request)
+			headers  = response.info()
+			response.close()
+		except Exception:
+			return None
+		etag, last_modified = headers.getheader("ETag"), headers.getheader("Last-Modified")
+		if etag is None and last_modified is None:
+			return None
+		return "%s|%s" % (etag, last_modified)
+
+	def _path(self, key):
+		return os.path.join(self._directory, hashlib.sha1(key).hexdigest())
+
+	def lookup(self, url, is_respec, fingerprint):
+		"""
+		Look up the book generated from a source. The entry is marked as recently used.
+
+		:param str url: the URL of the source
+		:param boolean is_respec: whether the source is in ReSpec
+		:param str fingerprint: the current fingerprint of the source (see :py:meth:`fingerprint`)
+		:return: an :py:class:`OutputEntry` instance, or `None` if there is no book for the source with this fingerprint
+		"""
+		key  = self.key(url, is_respec)
+		path = self._path(key)
+		try:
+			with open(path + ".json") as f:
+				metadata = json.load(f)
+			if metadata["key"] != key or metadata["fingerprint"] != fingerprint or not os.path.exists(path + ".epub"):
+				return None
+			os.utime(path + ".json", None)
+		except (IOError, OSError, ValueError, KeyError):
+			return None
+		return OutputEntry(path, metadata)
+
+	def writer(self, url, is_respec, fingerprint, short_name):
+		"""
+		Get a file-like object to store a new book; the book becomes a cache entry when the object is committed.
+
+		:param str url: the URL of the source
+		:param boolean is_respec: whether the source is in ReSpec
+		:param str fingerprint: the fingerprint of the source (see :py:meth:`fingerprint`)
+		:param str short_name: short name of the document
+		:return: a file-like object with ``commit`` and ``discard`` methods
+		"""
+		key = self.key(url, is_respec)
+		metadata = {
+			"key"         : key,
+			"fingerprint" : fingerprint,
+			"short_name"  : short_name
+		}
+		return _OutputWriter(self, self._path(key), metadata)
+
+	def commit(self, temp, path, metadata):
+		"""
+		Finalize the storage of a book, and remove the least recently used books if the cache has become too large.
+
+		:param str temp: the temporary file with the book
+		:param str path: path of the metadata and book files, without the suffix
+		:param dict metadata: metadata of the entry
+		"""
+		with self._lock:
+			os.rename(temp, path + ".epub")
+			fd, temp = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+			with os.fdopen(fd, "w") as f:
+				json.dump(metadata, f)
+			os.rename(temp, path + ".json")
+			self._evict()
+
+	def _evict(self):
+		"""Remove the least recently used, non permanent books until the total size is below the cap"""
+		entries = []
+		total   = 0
+		for name in os.listdir(self._directory):
+			if name.endswith(".json"):
+				path = os.path.join(self._directory, name[:-5])
+				try:
+					with open(path + ".json") as f:
+						if json.load(f)["fingerprint"] == PERMANENT:
+							continue
+					size = os.path.getsize(path + ".epub")
+					used = os.path.getmtime(path + ".json")
+				except (IOError, OSError, ValueError, KeyError):
+					continue
+				entries.append((used, size, path))
+				total += size
+
+		for used, size, path in sorted(entries):
+			if total <= self._max_size:
+				break
+			for suffix in (".json", ".epub"):
+				try:
+					os.remove(path + suffix)
+				except OSError:
+					pass
+			total -= size
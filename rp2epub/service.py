@@ -0,0 +1,613 @@
+"""
+A long-running HTTP service generating EPUB3 files: the :py:class:`EPUBService` class is a WSGI application providing
+the same service, with the same query interface, as the (CGI) ``epub-generator.py`` script:
+
+* ``type``: ``respec`` if the source is in ReSpec, i.e., it has to be transformed through the spec generator first;
+  ``html`` (the default) otherwise
+* ``url`` (or ``uri``): URL of the source; this should be the last parameter, because the URL may have a query
+  string of its own (e.g., to override the ReSpec configuration of the document)
+* ``stream``: if ``true``, the EPUB file is sent out progressively, while it is being generated (see :py:class:`.utils.Book`)
+
+A CGI script pays the Python start-up, the imports (html5lib, tinycss, etc.), and the setup of the logger for each request,
+and nothing survives a request. The service runs in one process instead: the persistent HTTP connections (see
+:py:mod:`.connections`), the HTTP cache, and the cache of the CSS parsing results are kept from one book to the next.
+The number of books generated at the same time is limited by the number of workers; further requests wait for a
+free worker.
+
+Concurrent requests for the same book (i.e., for the same source URL, with the same ReSpec configuration overrides and
+source type) are coalesced: the first request generates the book, the others wait for the end of that generation (up to
+:py:data:`.config.SERVICE_WAIT_TIMEOUT` seconds) and get the same book, or the same error. If the first request has
+asked for a progressive response (``stream=true``), the others get the complete book when it is ready. The waiting
+requests get the book from the output cache if it is stored there; otherwise, the book is shared in memory or, if it is
+sent out progressively, spooled into a temporary file beyond :py:data:`.config.SERVICE_SPOOL_LIMIT` bytes.
+
+The generated books may be kept in an output cache (see :py:mod:`.outputcache`), and reused as long as the source does
+not change. The books have an entity tag (``ETag``), computed from their content, and conditional requests
+(``If-None-Match``, ``If-Modified-Since``) are answered by a ``304`` if the client's copy is still valid. The books
+generated from immutable sources (the dated versions of the W3C Technical Reports) are marked as cacheable for a year.
+
+Large books may also be generated asynchronously, if the service has a job queue (see :py:mod:`.jobs`):
+
+* ``POST /jobs?type=...&url=...`` submits a job (with the same query parameters as above, except ``stream``); the
+  response is a ``202``, with the URL of the job in the ``Location`` header and the status of the job (see below) in a
+  JSON body. If too many jobs are already waiting, the response is a ``429``, with a ``Retry-After`` header.
+* ``GET /jobs/ID`` returns the status of a job as a JSON object: ``state`` (``queued``, ``running``, ``done``, or
+  ``failed``), the current ``stage`` of the generation (see :py:data:`.doc2epub.STAGES`), the ``progress`` (between 0
+  and 1), the ``error`` message of a failed job, the time of submission, start, and end, and, if the job is done, the
+  URL of the ``book``.
+* ``GET /jobs/ID/book`` returns the book of a completed job (or a ``409`` if the job is not done).
+
+The :py:func:`serve` function runs the application in a (multi-threaded) ``wsgiref`` server; the application can also
+be run by any other WSGI server, or as a CGI script (through ``wsgiref.handlers.CGIHandler``, which is what the
+``epub-generator.py`` script does).
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import traceback
+import datetime
+import hashlib
+import urllib
+import json
+import Queue
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from cgi import escape
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, make_server
+from wsgiref.util import application_uri
+
+from .doc2epub import DocWrapper
+from .outputcache import OutputCache, PERMANENT
+from .jobs import DONE
+from .config import SERVICE_WORKERS, SERVICE_HOST, SERVICE_PORT, SERVICE_WAIT_TIMEOUT, SERVICE_SPOOL_LIMIT, JOB_RETRY_AFTER, WRITE_CHUNK_SIZE
+
+# Maximum age of the books generated from immutable sources in the caches of the clients (one year)
+_PERMANENT_MAX_AGE = 365 * 24 * 3600
+
+_CORS_HEADERS = [
+	("Access-Control-Allow-Origin", "*"),
+	("Access-Control-Allow-Methods", "GET,HEAD,POST"),
+	("Access-Control-Allow-Headers", "Range, Content-Type, Origin, X-Requested-With, Accept, Accept-Language, Content-Language"),
+	("Access-Control-Expose-Headers", "Accept-Ranges, Content-Encoding, Content-Type, Content-Length, Content-Range, Content-Language, Cache-Control, Expires, Last-Modified, Pragma, Location, Retry-After")
+]
+
+_ERROR_PAGE = """<html>
+<head>
+<title>Epub Generator Exception</title>
+</head><body>
+<h1>Epub Generator Exception</h1>
+<pre>
+%s
+</pre>
+</body></html>
+"""
+
+
+def now():
+	"""
+	The current date and time in the format required by HTTP headers
+
+	:rtype: str
+	"""
+	return datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+
+def parse_query(query_string):
+	"""
+	Extract the arguments of the service from a query string. Note that the usual Python parsing of a query string
+	cannot be used, because the url argument may be a query string by itself (this is due to the peculiarities of
+	ReSpec, ie, the fact that one can use URLs with query string to override the ReSpec config data).
+
+	:param str query_string: the query string of the request
+	:return: a dictionary with the ``url``, ``respec``, and ``stream`` keys
+	"""
+	args = {
+		'url'   : "",
+		'respec': False,
+		'stream': False
+	}
+	call_args = {}
+	for arg in query_string.split('&'):
+		current = arg.split('=', 1)
+		if len(current) > 1:
+			call_args[current[0]] = current[1]
+
+	if 'type' in call_args:
+		args['respec'] = call_args['type'].lower() == 'respec'
+
+	if 'stream' in call_args:
+		args['stream'] = call_args['stream'].lower() in ('1', 'true', 'yes')
+
+	if 'url' in call_args:
+		args['url'] = urllib.unquote(call_args['url'])
+	elif 'uri' in call_args:
+		args['url'] = urllib.unquote(call_args['uri'])
+	return args
+
+
+# noinspection PyPep8
+class _ResponseStream(object):
+	"""
+	Binary stream writing into the body of a WSGI response, through the ``write`` callable returned by ``start_response``.
+	The stream is not seekable, i.e., the book is written into it progressively.
+
+	:param write: the ``write`` callable of the response
+	:param copies: file-like objects also getting the content (e.g., the output cache); `None` values are ignored
+	"""
+	def __init__(self, write, *copies):
+		self._write  = write
+		self._copies = [copy for copy in copies if copy is not None]
+
+	def write(self, data):
+		self._write(data)
+		for copy in self._copies:
+			copy.write(data)
+
+	@staticmethod
+	def seekable():
+		return False
+
+	@staticmethod
+	def readable():
+		return False
+
+	def flush(self):
+		pass
+
+
+# noinspection PyPep8
+class _SharedBook(object):
+	"""
+	A generated book, not stored in the output cache, shared by the concurrent requests for it. The content is kept in
+	a file-like object; each request reads it through its own iterator (see :py:meth:`chunks`). The entity tag is
+	computed while the content is written, or, for an existing content, by reading it in chunks.
+
+	:param content: a readable and seekable file-like object with the book (e.g., an :py:class:`io.BytesIO` instance);
+	 `None` means that the book is yet to be written into a spooled temporary file (see :py:meth:`write`)
+	"""
+	def __init__(self, content=None):
+		self._lock = threading.Lock()
+		self._sha1 = hashlib.sha1()
+		self.size  = 0
+		if content is None:
+			self._content = tempfile.SpooledTemporaryFile(SERVICE_SPOOL_LIMIT, prefix="rp2epub-")
+		else:
+			self._content = content
+			content.seek(0)
+			for chunk in iter(lambda: content.read(WRITE_CHUNK_SIZE), ""):
+				self._sha1.update(chunk)
+				self.size += len(chunk)
+
+	@property
+	def etag(self):
+		"""The (strong) entity tag of the book, computed from its content"""
+		return '"%s"' % self._sha1.hexdigest()
+
+	def write(self, data):
+		self._content.write(data)
+		self._sha1.update(data)
+		self.size += len(data)
+
+	def chunks(self):
+		"""
+		Iterate over the content of the book in chunks; several iterations may run at the same time.
+		"""
+		position = 0
+		while True:
+			with self._lock:
+				self._content.seek(position)
+				chunk = self._content.read(WRITE_CHUNK_SIZE)
+			if chunk == "":
+				return
+			position += len(chunk)
+			yield chunk
+
+
+# noinspection PyPep8
+class _Build(object):
+	"""
+	The generation of a book, shared by the concurrent requests for the same book. The request starting the generation
+	sets the result (or the error); the other requests wait for the generation to complete. The result is the entry of
+	the output cache (:py:attr:`entry`) or, if the book is not cached, a :py:class:`_SharedBook` (:py:attr:`book`).
+	"""
+	def __init__(self):
+		self._done      = threading.Event()
+		self.short_name = None
+		self.modified   = None
+		self.permanent  = False
+		self.book       = None
+		self.entry      = None
+		self.error      = None
+
+	def finish(self):
+		"""Mark the generation as completed, and wake up the waiting requests."""
+		self._done.set()
+
+	def wait(self, timeout):
+		"""
+		Wait for the generation to complete.
+
+		:param float timeout: the maximum waiting time, in seconds
+		:return: whether the generation has completed
+		:rtype: boolean
+		"""
+		return self._done.wait(timeout)
+
+
+# noinspection PyPep8
+class EPUBService(object):
+	"""
+	WSGI application generating EPUB3 files; see the module description for the query interface.
+
+	:param int workers: maximum number of books generated at the same time
+	:param logger: a python logger (see the standard library module on logging) to be used all around;  `None` means no logging
+	:param output_cache: cache of the generated books; `None` means that each request generates a new book
+	:type output_cache: :py:class:`.outputcache.OutputCache`
+	:param float wait_timeout: maximum time (in seconds) a request waits for the generation of the same book by a concurrent request
+	:param jobs: queue of the asynchronous jobs; `None` means that the job interface is not available
+	:type jobs: :py:class:`.jobs.JobQueue`
+	:param options: further keyword arguments for the :py:class:`.doc2epub.DocWrapper` instances generating the books (e.g., ``cache_dir`` or ``engine``)
+	"""
+	def __init__(self, workers=SERVICE_WORKERS, logger=None, output_cache=None, wait_timeout=SERVICE_WAIT_TIMEOUT, jobs=None, **options):
+		self._workers      = threading.BoundedSemaphore(workers)
+		self._logger       = logger
+		self._output_cache = output_cache
+		self._wait_timeout = wait_timeout
+		self._jobs         = jobs
+		self._options      = options
+		# The generations in progress, keyed by the output cache key of the book
+		self._builds       = {}
+		self._builds_lock  = threading.Lock()
+
+	def _info(self, message):
+		if self._logger is not None:
+			self._logger.info(message)
+
+	@staticmethod
+	def _headers(short_name, modified, permanent, length=None, etag=None):
+		"""
+		The header fields of a successful response.
+
+		:param str short_name: short name of the document
+		:param str modified: the value of the ``Last-Modified`` field
+		:param boolean permanent: whether the book never changes (i.e., it has been generated from an immutable source)
+		:param length: the length of the book, or `None` if unknown (i.e., the book is sent out progressively)
+		:param etag: the entity tag of the book, or `None` if unknown
+		:return: list of (name, value) pairs
+		"""
+		headers = [
+			("Content-Type", "application/epub+zip"),
+			# Header values must be (byte) strings; the short name may be a unicode string
+			("Content-Disposition", ("attachment; filename=%s.epub" % short_name).encode("utf-8"))
+		]
+		if length is not None:
+			headers.append(("Content-Length", str(length)))
+		return headers + _CORS_HEADERS + EPUBService._validators(modified, permanent, etag)
+
+	@staticmethod
+	def _validators(modified, permanent, etag=None):
+		"""
+		The header fields with the validators and the caching instructions of a response.
+
+		:param str modified: the value of the ``Last-Modified`` field
+		:param boolean permanent: whether the book never changes
+		:param etag: the entity tag of the book, or `None` if unknown
+		:return: list of (name, value) pairs
+		"""
+		if permanent:
+			headers = [("Expires", formatdate(time.time() + _PERMANENT_MAX_AGE, usegmt=True)), ("Cache-Control", "public, max-age=%s, immutable" % _PERMANENT_MAX_AGE)]
+		else:
+			headers = [("Expires", now()), ("Cache-Control", "no-cache")]
+		headers.append(("Last-Modified", modified))
+		if etag is not None:
+			headers.append(("ETag", etag))
+		return headers
+
+	@staticmethod
+	def _not_modified(environ, etag, modified):
+		"""
+		Check the conditional request header fields (``If-None-Match``, or ``If-Modified-Since``) against the book.
+
+		:param environ: the WSGI environment of the request
+		:param str etag: the entity tag of the book
+		:param float modified: time of the generation of the book, in seconds since the epoch
+		:return: whether the client's copy of the book is up to date, i.e., whether a ``304`` response is appropriate
+		"""
+		if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+		if if_none_match is not None:
+			tags = [tag.strip() for tag in if_none_match.split(",")]
+			return "*" in tags or etag in tags or ("W/" + etag) in tags
+		if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+		if if_modified_since is not None:
+			since = parsedate_tz(if_modified_since)
+			return since is not None and int(modified) <= mktime_tz(since)
+		return False
+
+	@staticmethod
+	def _error(start_response, status, message, exc_info=None, headers=None):
+		"""
+		Return an error page.
+
+		:param start_response: the WSGI ``start_response`` callable
+		:param str status: HTTP status
+		:param str message: the message (a plain text) displayed on the page
+		:param exc_info: the exception information, if the error is an exception
+		:param headers: further header fields of the response, as a list of (name, value) pairs
+		:return: the body of the response
+		"""
+		body = _ERROR_PAGE % escape(message)
+		start_response(status, [("Content-Type", "text/html; charset=utf-8"), ("Content-Length", str(len(body)))] + (headers or []), exc_info)
+		return [body]
+
+	def _send_entry(self, environ, start_response, entry):
+		"""
+		Return a book from the output cache, or a ``304`` response if the client's copy is up to date.
+
+		:param environ: the WSGI environment of the request
+		:param start_response: the WSGI ``start_response`` callable
+		:param entry: the cached book
+		:type entry: :py:class:`.outputcache.OutputEntry`
+		:return: the body of the response
+		"""
+		if self._not_modified(environ, entry.etag, entry.modified):
+			start_response("304 Not Modified", self._validators(entry.last_modified, entry.permanent, entry.etag))
+			return []
+		start_response("200 OK", self._headers(entry.short_name, entry.last_modified, entry.permanent, entry.size, entry.etag))
+		if environ["REQUEST_METHOD"] == "HEAD":
+			return []
+		book = entry.open()
+		if "wsgi.file_wrapper" in environ:
+			return environ["wsgi.file_wrapper"](book, WRITE_CHUNK_SIZE)
+		return _chunks(book)
+
+	def _job_request(self, environ, start_response):
+		"""
+		Handle a request of the job interface: submission, status, or book of a job.
+
+		:param environ: the WSGI environment of the request
+		:param start_response: the WSGI ``start_response`` callable
+		:return: the body of the response
+		"""
+		if self._jobs is None:
+			return self._error(start_response, "404 Not Found", "The job interface is not available")
+		method = environ["REQUEST_METHOD"]
+		path   = [step for step in environ.get("PATH_INFO", "").split("/") if step != ""]
+
+		if len(path) == 1:
+			if method != "POST":
+				return self._error(start_response, "405 Method Not Allowed", "Jobs are submitted by POST requests", headers=[("Allow", "POST")])
+			args = parse_query(environ.get("QUERY_STRING", ""))
+			if args['url'] == "":
+				return self._error(start_response, "400 Bad Request", "No 'url' (or 'uri') parameter in the query")
+			try:
+				job_id = self._jobs.submit(args['url'], args['respec'])
+			except Queue.Full:
+				return self._error(start_response, "429 Too Many Requests", "Too many jobs are waiting; try again later", headers=[("Retry-After", str(JOB_RETRY_AFTER))])
+			self._info("**** Job %s has been submitted for '%s' ****" % (job_id, args['url']))
+			return self._send_job(environ, start_response, "202 Accepted", self._jobs.store.get(job_id))
+
+		job = self._jobs.store.get(path[1]) if len(path) in (2, 3) else None
+		if job is None or (len(path) == 3 and path[2] != "book"):
+			return self._error(start_response, "404 Not Found", "Unknown job")
+		if method not in ("GET", "HEAD"):
+			return self._error(start_response, "405 Method Not Allowed", "Only GET and HEAD requests are accepted", headers=[("Allow", "GET, HEAD")])
+		if len(path) == 2:
+			return self._send_job(environ, start_response, "200 OK", job)
+
+		if job["state"] != DONE:
+			return self._error(start_response, "409 Conflict", "The job is %s" % str(job["state"]))
+		book_path = self._jobs.store.book_path(job["id"])
+		start_response("200 OK", self._headers(job["short_name"], formatdate(job["finished"], usegmt=True), False, os.path.getsize(book_path)))
+		if method == "HEAD":
+			return []
+		book = open(book_path, "rb")
+		if "wsgi.file_wrapper" in environ:
+			return environ["wsgi.file_wrapper"](book, WRITE_CHUNK_SIZE)
+		return _chunks(book)
+
+	@staticmethod
+	def _send_job(environ, start_response, status, job):
+		"""
+		Return the status of a job, as a JSON object.
+
+		:param environ: the WSGI environment of the request
+		:param start_response: the WSGI ``start_response`` callable
+		:param str status: HTTP status
+		:param dict job: the record of the job (see :py:meth:`.jobs.JobStore.get`)
+		:return: the body of the response
+		"""
+		# Header values must be (byte) strings; the values in the store are unicode strings
+		location = application_uri(environ).rstrip("/") + "/jobs/" + str(job["id"])
+		report   = {
+			"id"        : job["id"],
+			"url"       : job["url"],
+			"type"      : "respec" if job["respec"] else "html",
+			"state"     : job["state"],
+			"stage"     : job["stage"],
+			"progress"  : job["progress"],
+			"error"     : job["error"],
+			"submitted" : formatdate(job["submitted"], usegmt=True),
+			"started"   : formatdate(job["started"], usegmt=True) if job["started"] is not None else None,
+			"finished"  : formatdate(job["finished"], usegmt=True) if job["finished"] is not None else None,
+			"book"      : location + "/book" if job["state"] == DONE else None
+		}
+		body = json.dumps(report, indent=2, sort_keys=True)
+		headers = [
+			("Content-Type", "application/json"),
+			("Content-Length", str(len(body))),
+			("Cache-Control", "no-cache"),
+			("Location", location)
+		]
+		start_response(status, headers + _CORS_HEADERS)
+		return [body] if environ["REQUEST_METHOD"] != "HEAD" else []
+
+	def __call__(self, environ, start_response):
+		method = environ.setdefault("REQUEST_METHOD", "GET")
+		if environ.get("PATH_INFO", "").split("/")[1:2] == ["jobs"]:
+			return self._job_request(environ, start_response)
+		if method not in ("GET", "HEAD"):
+			return self._error(start_response, "405 Method Not Allowed", "Only GET and HEAD requests are accepted")
+		args = parse_query(environ.get("QUERY_STRING", ""))
+		if args['url'] == "":
+			return self._error(start_response, "400 Bad Request", "No 'url' (or 'uri') parameter in the query")
+
+		self._info("**** Handling '%s' via the generator service ****" % args['url'])
+		self._info("File is %s source" % ("a respec" if args['respec'] else "an html"))
+
+		# A book generated earlier from the same source may be reused, if the source has not changed since
+		fingerprint = None
+		if self._output_cache is not None:
+			fingerprint = self._output_cache.fingerprint(args['url'])
+			if fingerprint is not None:
+				entry = self._output_cache.lookup(args['url'], args['respec'], fingerprint)
+				if entry is not None:
+					self._info("**** The '%s' EPUB 3 file has been found in the output cache ****" % (entry.short_name + ".epub"))
+					return self._send_entry(environ, start_response, entry)
+		permanent = fingerprint == PERMANENT
+
+		# A concurrent request may already be generating the same book
+		key = OutputCache.key(args['url'], args['respec'])
+		with self._builds_lock:
+			build = self._builds.get(key)
+			if build is None:
+				build = self._builds[key] = _Build()
+				leader = True
+			else:
+				leader = False
+
+		if not leader:
+			self._info("**** Waiting for the generation of '%s' by a concurrent request ****" % args['url'])
+			if not build.wait(self._wait_timeout):
+				return self._error(start_response, "504 Gateway Timeout", "The generation of the EPUB file has not completed within %s seconds" % self._wait_timeout)
+			if build.error is not None:
+				return self._error(start_response, "500 Internal Server Error", build.error)
+			return self._send_build(environ, start_response, build)
+
+		try:
+			return self._generate(environ, start_response, args, fingerprint, permanent, build)
+		finally:
+			with self._builds_lock:
+				del self._builds[key]
+			build.finish()
+
+	def _generate(self, environ, start_response, args, fingerprint, permanent, build):
+		"""
+		Generate a book, and return it (or the error page); the result is also set in the build, for the concurrent
+		requests waiting for the same book.
+
+		:param environ: the WSGI environment of the request
+		:param start_response: the WSGI ``start_response`` callable
+		:param dict args: the arguments of the request (see :py:func:`parse_query`)
+		:param fingerprint: fingerprint of the source (see :py:meth:`.outputcache.OutputCache.fingerprint`), `None` if the book is not cached
+		:param boolean permanent: whether the source is immutable
+		:param build: the shared generation of the book
+		:type build: :py:class:`_Build`
+		:return: the body of the response
+		"""
+		method = environ["REQUEST_METHOD"]
+		with self._workers:
+			# This will set the 'last modified' header field in the response
+			build.modified  = now()
+			build.permanent = permanent
+			writer = None
+			try:
+				with DocWrapper(args['url'], is_respec=args['respec'], package=True, folder=False, logger=self._logger, **self._options) as wrapper:
+					build.short_name = wrapper.document.short_name
+					if fingerprint is not None:
+						writer = self._output_cache.writer(args['url'], args['respec'], fingerprint, build.short_name)
+					if args['stream'] and method == "GET":
+						# The book is sent out while it is being generated; an error from now on cannot be reported in
+						# the response (the server closes the connection, i.e., the client gets a truncated book). If the
+						# book is not cached, it is also spooled for the concurrent requests waiting for it.
+						write = start_response("200 OK", self._headers(build.short_name, build.modified, permanent))
+						book  = _SharedBook() if writer is None else None
+						wrapper.process(_ResponseStream(write, writer, book))
+						streamed = True
+					else:
+						buffer = wrapper.process_to_buffer()
+						if writer is not None:
+							shutil.copyfileobj(buffer, writer, WRITE_CHUNK_SIZE)
+							book = None
+						else:
+							book = _SharedBook(buffer)
+						streamed = False
+					build.entry = writer.commit() if writer is not None else None
+					build.book  = book
+			except Exception:
+				if writer is not None:
+					writer.discard()
+				exc_info = sys.exc_info()
+				message  = "".join(traceback.format_exception(*exc_info))
+				build.error = message
+				if self._logger is not None:
+					self._logger.critical("Exception has been raised:\n" + message)
+				return self._error(start_response, "500 Internal Server Error", message, exc_info)
+
+		self._info("**** The '%s' EPUB 3 file has been generated and has been returned to caller ****" % (build.short_name + ".epub"))
+		if streamed:
+			return []
+		return self._send_build(environ, start_response, build)
+
+	def _send_build(self, environ, start_response, build):
+		"""
+		Return a generated book, or a ``304`` response if the client's copy is up to date.
+
+		:param environ: the WSGI environment of the request
+		:param start_response: the WSGI ``start_response`` callable
+		:param build: the (completed) generation of the book
+		:type build: :py:class:`_Build`
+		:return: the body of the response
+		"""
+		if build.entry is not None:
+			return self._send_entry(environ, start_response, build.entry)
+		book = build.book
+		if self._not_modified(environ, book.etag, time.time()):
+			start_response("304 Not Modified", self._validators(build.modified, build.permanent, book.etag))
+			return []
+		start_response("200 OK", self._headers(build.short_name, build.modified, build.permanent, book.size, book.etag))
+		return book.chunks() if environ["REQUEST_METHOD"] == "GET" else []
+
+
+def _chunks(book):
+	"""
+	Iterate over the content of a file in chunks, and close the file at the end.
+
+	:param book: a file object
+	"""
+	try:
+		for chunk in iter(lambda: book.read(WRITE_CHUNK_SIZE), ""):
+			yield chunk
+	finally:
+		book.close()
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+	"""WSGI server handling each request in a separate thread"""
+	daemon_threads = True
+
+
+def serve(application, host=SERVICE_HOST, port=SERVICE_PORT):
+	"""
+	Run a WSGI application (typically an :py:class:`EPUBService` instance) in a multi-threaded ``wsgiref`` server, until
+	the process is interrupted.
+
+	:param application: the WSGI application
+	:param str host: the host name (interface) to listen on
+	:param int port: the port to listen on
+	"""
+	server = make_server(host, port, application, server_class=_ThreadingWSGIServer)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
@@ -10,44 +10,47 @@ Module Content
 
   A python logger instance (see the Python logging library for details). May be overwritten by the :py:class:`.DocWrapper` instance). Defaults to ``None``.
 
+.. py:data:: http_cache
+
+  A :py:class:`.httpcache.HttpCache` instance used by all :py:class:`HttpSession` instances. May be overwritten by the :py:class:`.DocWrapper` instance). Defaults to ``None``, i.e., no caching.
+
 .. py:data:: TOC_PAIRS
 
-  Array of tuples to help selecting the (top level) TOC entries; these are strings to be used in an XPath find. Because there
+  Array of tuples to help selecting the (top level) TOC entries; these are strings to be used in a path expression (see :py:meth:`.domindex.DOMIndex.select`). Because there
   has been several versions over the past, including Bikeshed and ReSpec versions, the array contains quite a number of
   variants. The tuple may contain a third string, denoting a specific class name on the target element that can be
   used to narrow the filter.
 
 """
 
-from urllib2 import urlopen
+from urllib2 import Request, HTTPError
 from StringIO import StringIO
 from datetime import date
 import re
 import os
 import os.path
 import shutil
-from xml.etree.ElementTree import SubElement, ElementTree, tostring, fromstring
+import copy
+import tempfile
+import mimetypes
+import hashlib
+from xml.etree.ElementTree import SubElement, fromstring
 import zipfile
-import html5lib
 
 from .templates import meta_inf
+from .connections import opener
+from .domindex import DOMIndex
+from .engines import engine_of, ElementTreeEngine
+from .zipstream import ZipEntryWriter, ChunkedWriter, ParallelDeflater, CountingStream, copy_entry, write_stored, seekable, readable
+from .compression import get_policy, STORED
 from . import R2EError
 import config
 
 # logger (see the Python logging library for details). May be overwritten by the :py:class:`.DocWrapper` instance)
 logger = None
 
-# These media types should be added to the zip file uncompressed
-# noinspection PyPep8
-_NO_COMPRESS = [
-	"image/png",
-	"image/jpeg",
-	"image/gif",
-	"audio/mpeg",
-	"video/mp4",
-	"video/webm",
-	"video/ogg"
-]
+# HTTP cache (see the httpcache module for details). May be overwritten by the :py:class:`.DocWrapper` instance)
+http_cache = None
 
 #
 # Table of content extraction
@@ -108,7 +111,7 @@ class Utils(object):
     """
 	# noinspection PyUnusedLocal,PyPep8
 	@staticmethod
-	def get_document_properties(html):
+	def get_document_properties(html, index=None):
 		"""
         Find the extra manifest properties that must be added to the HTML resource in the opf file.
 
@@ -116,12 +119,17 @@ class Utils(object):
 
         :param html: the object for the whole document
         :type html: :py:class:`xml.etree.ElementTree.ElementTree`
+        :param index: index of the elements of the document; if `None`, an index is built on the fly
+        :type index: :py:class:`.domindex.DOMIndex`
         :return: set collecting all possible property values
         :rtype: set
         """
+		if index is None:
+			index = DOMIndex(html)
+
 		retval = set()
 		# If <script> is used for Javascript, the 'scripted' property should be set
-		for scr in html.findall(".//script"):
+		for scr in index.find_all("script"):
 			if "type" not in scr.keys() or scr.get("type") == "application/javascript" or scr.get("type") == "text/javascript":
 				# The script element is really used for scripting
 				retval.add("scripted")
@@ -129,13 +137,13 @@ class Utils(object):
 				break
 
 		# If an interactive form is used, the 'scripted' property should be set
-		if html.find(".//form") is not None:
+		if index.find("form") is not None:
 			retval.add("scripted")
 
-		if html.find(".//{http://www.w3.org/2000/svg}svg") is not None:
+		if index.find("{http://www.w3.org/2000/svg}svg") is not None:
 			retval.add("svg")
 
-		if html.find(".//{http://www.w3.org/1998/Math/MathML}math") is not None:
+		if index.find("{http://www.w3.org/1998/Math/MathML}math") is not None:
 			retval.add("mathml")
 
 		return retval
@@ -191,7 +199,7 @@ class Utils(object):
 
 	@staticmethod
 	# noinspection PyBroadException
-	def extract_editors(html):
+	def extract_editors(html, index=None):
 		"""Extract the editors' names from a document, following the respec conventions
         (``@class=p-author`` for ``<dd>`` including ``<a>`` or ``<span>`` with ``@class=p-name``)
 
@@ -200,11 +208,16 @@ class Utils(object):
 
         :param html: the object for the whole document
         :type html: :py:class:`xml.etree.ElementTree.ElementTree`
+        :param index: index of the elements of the document; if `None`, an index is built on the fly
+        :type index: :py:class:`.domindex.DOMIndex`
         :return: list of editors
         """
+		if index is None:
+			index = DOMIndex(html)
+
 		retval = []
 
-		for dd in html.findall(".//dd[@class]"):
+		for dd in index.find_all("dd", "class"):
 			if dd.get('class').find('p-author') != -1:
 				for a in dd.findall(".//a[@class]"):
 					if a.get('class').find('p-name') != -1:
@@ -220,7 +233,7 @@ class Utils(object):
 
 	# noinspection PyPep8,PyBroadException
 	@staticmethod
-	def set_html_meta(html, head):
+	def set_html_meta(html, head, index=None):
 		"""
         Change the meta elements so that:
 
@@ -231,16 +244,22 @@ class Utils(object):
         :type html: :py:class:`xml.etree.ElementTree.ElementTree`
         :param head: the object for the <head> element
         :type head: :py:class:`xml.etree.ElementTree.Element`
+        :param index: index of the elements of the document; if `None`, an index is built on the fly
+        :type index: :py:class:`.domindex.DOMIndex`
         """
-		for meta in html.findall(".//meta[@http-equiv='content-type']") + html.findall(".//meta[@http-equiv='Content-Type']"):
+		if index is None:
+			index = DOMIndex(html)
+
+		for meta in index.find_all("meta", "http-equiv", "content-type") + index.find_all("meta", "http-equiv", "Content-Type"):
 			try:
 				head.remove(meta)
+				index.remove(meta)
 			except:
 				pass
-		SubElement(head, "meta", charset="utf-8")
+		index.add(SubElement(head, "meta", charset="utf-8"), head)
 
 	@staticmethod
-	def html_to_xhtml(html):
+	def html_to_xhtml(html, index=None):
 		"""
         Make the minimum changes necessary in the DOM tree so that the XHTML5 output is valid and accepted
         by epub readers. These are:
@@ -253,22 +272,26 @@ class Utils(object):
 
         :param html: the object for the whole document
         :type html: :py:class:`xml.etree.ElementTree.ElementTree`
+        :param index: index of the elements of the document; if `None`, an index is built on the fly
+        :type index: :py:class:`.domindex.DOMIndex`
         :return: the input object
         """
+		if index is None:
+			index = DOMIndex(html)
+
 		# Set the xhtml namespace on the top, this is required by epub readers
-		# noinspection PyUnresolvedReferences
-		html.set("xmlns", "http://www.w3.org/1999/xhtml")
+		engine_of(html).set_xhtml_namespace(html)
 
 		# The script reference element should not be self-closed, but with a separate </script> instead. Just adding
 		# an extra space to a possible link does the trick.
-		for script in html.findall(".//script[@src]"):
+		for script in index.find_all("script", "src"):
 			if script.text is None:
 				script.text = " "
 		return html
 
 	# noinspection PyPep8Naming
 	@staticmethod
-	def change_DOM(html):
+	def change_DOM(html, index=None):
 		"""
          Changes on the DOM to ensure a proper interoperability of the display among EPUB readers. At the moment, the following actions are done:
 
@@ -308,22 +331,29 @@ class Utils(object):
 
          :param html: the object for the whole document
          :type html: :py:class:`xml.etree.ElementTree.ElementTree`
+         :param index: index of the elements of the document; if `None`, an index is built on the fly
+         :type index: :py:class:`.domindex.DOMIndex`
         """
+		if index is None:
+			index = DOMIndex(html)
 
 		# Hack #1
-		body = html.find(".//body")
+		body = index.find("body")
 
-		if len(html.findall(".//div[@main='role']")) == 0:
+		if len(index.find_all("div", "main", "role")) == 0:
 			main = SubElement(body, "div")
 			main.set("role", "main")
+			index.add(main, body)
 
 			# All children of body, except for main, should be re-parented to main and removed from body
 			# Note: this is a workaround around what seems to be a bug in the html5parser. Indeed,
 			# the direct creation of an Element object does not work; the SubElement method must be used
 			# but this means that element should be avoided in the cycle below. Sigh...
 			for child in [x for x in body.findall("*") if not (x.tag == "div" and x.get("role", None) == "main")]:
-				main.append(child)
+				# (lxml moves an element on append, i.e., the removal must come first)
 				body.remove(child)
+				main.append(child)
+				index.reparent(child, main)
 
 		# Hack #2
 		# Change the "highlight" class name
@@ -331,31 +361,31 @@ class Utils(object):
 		def _change_name(x):
 			return x if x != "highlight" else "book_highlight"
 
-		for pre in html.findall(".//pre[@class]"):
+		for pre in index.find_all("pre", "class"):
 			# there may be several class names
 			cl_names = pre.get("class").split()
 			new_cl_names = map(_change_name, cl_names)
-			pre.set("class", " ".join(new_cl_names))
+			index.set(pre, "class", " ".join(new_cl_names))
 
 		# Hack #3
 		# Add the type="text/css" for stylesheet elements
-		for lnk in html.findall(".//link[@rel='stylesheet']"):
+		for lnk in index.find_all("link", "rel", "stylesheet"):
 			if "type" not in lnk.keys():
-				lnk.set("type", "text/css")
+				index.set(lnk, "type", "text/css")
 
 		# Hack #4
 		# Add 'toc-inline' to the body class, to avoid a floating TOC on the left
 		bclass = body.get("class", None)
 		if bclass is None:
-			body.set("class", "toc-inline")
+			index.set(body, "class", "toc-inline")
 		else:
 			classes = bclass.split()
 			if "toc-inline" not in classes:
 				classes.append("toc-inline")
-			body.set("class", " ".join([c for c in classes if c != "toc-sidebar"]))
+			index.set(body, "class", " ".join([c for c in classes if c != "toc-sidebar"]))
 
 		# Hack #5
-		for script in html.findall(".//script[@src]"):
+		for script in index.find_all("script", "src"):
 			if script.get("src").endswith("fixup.js"):
 				# The ElementTree.Element interface makes it difficult to locate the parent
 				# which would be necessary to remove this element (why????)
@@ -364,7 +394,7 @@ class Utils(object):
 				script.text = " "
 
 	@staticmethod
-	def extract_toc(html, short_name):
+	def extract_toc(html, short_name, index=None):
 		"""
         Extract the table of content from the document. ``html`` is the Element object for the full document. ``toc_tuples``
         is an array of ``TOC_Item`` objects where the items should be put, ``short_name`` is the short name for the
@@ -373,8 +403,13 @@ class Utils(object):
         :param html: the object for the whole document
         :type html: :py:class:`xml.etree.ElementTree.ElementTree`
         :param str short_name: short name of the document as a whole (used in possible warning)
+        :param index: index of the elements of the document; if `None`, an index is built on the fly
+        :type index: :py:class:`.domindex.DOMIndex`
         :return: array of :py:class:`.TOC_Item` instances
         """
+		if index is None:
+			index = DOMIndex(html)
+
 		retval = []
 
 		def extract_toc_entry(parent, explicit_num=None):
@@ -420,8 +455,7 @@ class Utils(object):
 			# probably depends on the output format requested (or the version of respec? or both?)
 			# In all cases, the <a> element contains a section number and the chapter title
 			for pairs in TOC_PAIRS:
-				xpath = ".//{}/{}".format(pairs[0], pairs[1])
-				toc = html.findall(xpath)
+				toc = index.select("{}/{}".format(pairs[0], pairs[1]))
 				if len(toc) > 0:
 					for li in toc[0].findall("li"):
 						if pairs[2] is not None and "class" in li.keys() and li.get('class').find(pairs[2]) == -1:
@@ -439,11 +473,10 @@ class Utils(object):
 			top_levels = []
 
 			# See if the new style nav/ul access works
-			xpath = ".//nav[@id='toc']/ul[@class='toc']"
-			toc = html.findall(xpath)
+			toc = index.select("nav[@id='toc']/ul[@class='toc']")
 			if len(toc) > 0:
 				for li in toc[0].findall("li"):
-					li_in_string = tostring(li, encoding="utf-8", method="xml")
+					li_in_string = engine_of(li).tostring(li)
 					# making some changes for the nav element and then turn it back to an Element tree
 					cloned_li = fromstring(li_in_string.replace('<ul','<ol').replace('</ul>','</ol>'))
 					for a in cloned_li.findall(".//a"):
@@ -488,6 +521,9 @@ class HttpSession(object):
 	"""
     Wrapper around an HTTP session; the returned media type is compared against accepted media types.
 
+    The retrieval uses persistent connections (see the :py:mod:`.connections` module). If the :py:data:`http_cache` is set, the content is taken from the cache if it is still fresh, and it is revalidated
+    via a conditional request if it is stale.
+
     :param str url: the URL to be retrieved
     :param boolean check_media_type: whether the media type should be checked against the media type of the resource to see if it is acceptable
     :param boolean raise_exception: whether an exception should be raised if the document cannot be retrieved (either because the HTTP return is not 200, or not of an acceptable media type)
@@ -504,12 +540,33 @@ class HttpSession(object):
 		self._success    = False
 		self._media_type = ""
 		self._data       = None
+		self._content    = None
+		self._spool      = None
 		self._url        = url
 
+		cached = http_cache.lookup(url) if http_cache is not None else None
+		if cached is not None and cached.fresh:
+			self._set_from_cache(cached, check_media_type, handle_exception)
+			return
+
 		# noinspection PyBroadException
 		try:
-			self._data = urlopen(url)
+			request = Request(url, headers=cached.conditional_headers() if cached is not None else {})
+			self._data = opener.open(request)
+		except HTTPError as e:
+			e.close()
+			if e.code == 304 and cached is not None:
+				# The cached content is still valid
+				http_cache.refresh(cached, e.info())
+				self._set_from_cache(cached, check_media_type, handle_exception)
+				return
+			unreachable = True
 		except Exception:
+			unreachable = True
+		else:
+			unreachable = False
+
+		if unreachable:
 			if is_respec:
 				handle_exception("There seems to be a problem with the spec generator service ('%s' should be tested separately)" % url)
 			else:
@@ -525,8 +582,75 @@ class HttpSession(object):
 			handle_exception("Received a file of type '%s', which is not defined as acceptable" % self._media_type)
 			return
 
+		if http_cache is not None:
+			self._data = http_cache.store(url, self._data)
+		self._success = True
+
+	def _set_from_cache(self, cached, check_media_type, handle_exception):
+		"""
+        Set the content of the session from a cache entry.
+
+        :param cached: the cache entry
+        :type cached: :py:class:`.httpcache.CacheEntry`
+        :param boolean check_media_type: whether the media type should be checked against the media type of the resource to see if it is acceptable
+        :param handle_exception: function to report an error
+        """
+		self._media_type = cached.media_type
+		if check_media_type and self._media_type not in config.ACCEPTED_MEDIA_TYPES:
+			handle_exception("Received a file of type '%s', which is not defined as acceptable" % self._media_type)
+			return
+		try:
+			self._data = cached.open()
+		except IOError:
+			# The entry may have been evicted in the meantime by another process
+			handle_exception("%s cannot be retrieved from the cache" % self._url)
+			return
 		self._success = True
 
+	def buffer(self):
+		"""
+        Read the full content of a successful retrieval. This ensures that the network transfer happens in the thread
+        doing the retrieval, and not when the content is copied into the book. It also means that the :py:attr:`data` can
+        be read several times.
+
+        The content is kept in memory if it is not larger than :py:data:`.config.BUFFER_MEMORY_LIMIT`; larger contents
+        (e.g., videos) are copied, in chunks, into a temporary file instead, which is removed when the session is
+        closed (see :py:meth:`close`).
+        """
+		if self._success and self._content is None and self._spool is None:
+			content = self._data.read(config.BUFFER_MEMORY_LIMIT + 1)
+			if len(content) <= config.BUFFER_MEMORY_LIMIT:
+				self._content = content
+			else:
+				self._spool = tempfile.NamedTemporaryFile(prefix="rp2epub-")
+				self._spool.write(content)
+				del content
+				shutil.copyfileobj(self._data, self._spool, config.WRITE_CHUNK_SIZE)
+				self._spool.flush()
+			self._data.close()
+
+	def close(self):
+		"""
+        Release the buffered content (see :py:meth:`buffer`), removing the temporary file, if any.
+        """
+		self._content = None
+		if self._spool is not None:
+			self._spool.close()
+			self._spool = None
+
+	def checked(self):
+		"""
+        Check the media type of a successful retrieval against the acceptable media types.
+
+        :return: the session itself if the media type is acceptable, otherwise an unsuccessful copy of the session
+        """
+		if not self._success or self._media_type in config.ACCEPTED_MEDIA_TYPES:
+			return self
+		Logger.error("Received a file of type '%s', which is not defined as acceptable" % self._media_type)
+		rejected = copy.copy(self)
+		rejected._success = False
+		return rejected
+
 	@property
 	def success(self):
 		"""
@@ -537,9 +661,12 @@ class HttpSession(object):
 	@property
 	def data(self):
 		"""
-        The returned resource, as a file-like object
+        The returned resource, as a file-like object. If the content has been buffered (see :py:meth:`buffer`), a new
+        file-like object is returned on each access.
         """
-		return self._data
+		if self._spool is not None:
+			return open(self._spool.name, "rb")
+		return StringIO(self._content) if self._content is not None else self._data
 
 	@property
 	def url(self):
@@ -555,6 +682,15 @@ class HttpSession(object):
         """
 		return self._media_type
 
+	@property
+	def size(self):
+		"""
+        Size of the content in bytes, if it has been buffered (see :py:meth:`buffer`); `None` otherwise
+        """
+		if self._spool is not None:
+			return os.path.getsize(self._spool.name)
+		return len(self._content) if self._content is not None else None
+
 #####################################################################################
 
 
@@ -562,17 +698,38 @@ class HttpSession(object):
 class Book(object):
 	"""Abstraction for a book; it encapsulates a zip file as well as saving the content into a directory.
 
-    :param book_name: file name of the book
+    The book may also be written into a writable binary stream instead of a file, e.g., into an in-memory buffer (:py:class:`io.BytesIO`)
+    or into a socket. If the stream is not seekable (or is not at its start), the package is written progressively: each
+    entry goes into the stream as soon as it is written, with its CRC and sizes in a data descriptor following its content
+    (see :py:class:`.zipstream.CountingStream`). The stream is not closed by the book.
+
+    :param book_name: file name of the book, or a writable binary stream
     :param folder_name: name of the directory
     :param package: whether a real zip file should be created or not
     :param folder: whether the directory structure should be created separately or not
+    :param engine: the tree engine used to parse the HTML files added to the book; the default is the ``etree`` engine
+    :type engine: :py:class:`.engines.ElementTreeEngine` or :py:class:`.engines.LxmlEngine`
+    :param int compress_workers: number of threads compressing the content of the package; a value of 1 (or less) means that the content is compressed in the calling thread (see :py:class:`.zipstream.ParallelDeflater`)
+    :param compression: the compression policy of the package; the default is the :py:data:`.config.COMPRESSION_POLICY` policy
+    :type compression: :py:class:`.compression.CompressionPolicy`
+    :param boolean dedup: whether files with identical content should be compressed only once: the compressed data of the first such file is copied into the entries of the others (see :py:func:`.zipstream.copy_entry`)
     """
-	def __init__(self, book_name, folder_name, package=True, folder=False):
+	def __init__(self, book_name, folder_name, package=True, folder=False, engine=None, compress_workers=1, compression=None, dedup=False):
 		self._package       = package
 		self._folder        = folder
+		self._engine        = engine if engine is not None else ElementTreeEngine()
+		self._compression   = compression if compression is not None else get_policy(config.COMPRESSION_POLICY)
 		self._name          = folder_name
 		self._zip           = None
-		self.already_stored = []
+		self._deflater      = None
+		self._reader        = None
+		self._stream        = not isinstance(book_name, basestring)
+		self.already_stored = set()
+
+		# Content index for the deduplication: maps (compression method, SHA-1 digest) pairs to the first entry with that content
+		self._dedup         = {} if dedup else None
+		self._dedup_files   = 0
+		self._dedup_saved   = 0
 
 		if self.folder:
 			# To be sure the previous folder, if it exists, should be removed
@@ -580,7 +737,15 @@ class Book(object):
 				shutil.rmtree(folder_name, ignore_errors=True)
 			os.mkdir(folder_name)
 		if self.package:
+			if self._stream and not (seekable(book_name) and book_name.tell() == 0):
+				# The zip file cannot go back to the local headers of the entries (or the offsets would be wrong)
+				book_name = CountingStream(book_name)
 			self._zip = zipfile.ZipFile(book_name, 'w', zipfile.ZIP_DEFLATED)
+			if self._stream and self._dedup is not None and not readable(self._zip.fp):
+				Logger.info("The target stream of the book is not readable; the content is not deduplicated")
+				self._dedup = None
+			if compress_workers > 1:
+				self._deflater = ParallelDeflater(self._zip, compress_workers)
 
 		self.writestr('mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
 		self.writestr('META-INF/container.xml', meta_inf)
@@ -605,51 +770,146 @@ class Book(object):
 		"""The package (book) file itself"""
 		return self._zip
 
-	def writestr(self, target, content, compress=zipfile.ZIP_DEFLATED):
+	@property
+	def dedup_saved(self):
+		"""Number of (uncompressed) bytes whose compression has been spared by the deduplication of identical files"""
+		return self._dedup_saved
+
+	def _method(self, target, compress, media_type, size):
+		"""
+        The compression method of a file, set by the compression policy (unless compression is explicitly excluded).
+
+        :param target: path for the target file
+        :param compress: either ``zipfile.ZIP_DEFLATED`` or ``zipfile.ZIP_STORED``, whether the content may be compressed
+        :param media_type: media type of the content; `None` means that it is guessed from the target's suffix
+        :param size: size of the content; `None` if unknown
+        :return: a compression method (see :py:data:`.compression.METHODS`)
+        """
+		if compress == zipfile.ZIP_STORED:
+			return STORED
+		if media_type is None:
+			media_type = mimetypes.guess_type(target)[0]
+		return self._compression.method(media_type, size)
+
+	def _reuse(self, target, method, digest, size):
+		"""
+        Add a file to the package by copying the compressed data of an earlier file with the same content, if any (see
+        :py:func:`.zipstream.copy_entry`). If there is no such file, the target is recorded in the content index, and
+        must then be written into the package by the caller.
+
+        :param target: path for the target file
+        :param method: the compression method of the file
+        :param digest: SHA-1 digest of the content
+        :param size: size of the content
+        :return: whether the file has been added to the package
+        """
+		key = (method, digest)
+		source = self._dedup.get(key)
+		if source is None:
+			self._dedup[key] = target
+			return False
+		if self._deflater is not None:
+			# The source entry must be fully written into the archive before its data is copied
+			self._deflater.drain(wait=True)
+		if self._reader is None:
+			self._reader = self.zip.fp if self._stream else open(self.zip.filename, "rb")
+		copy_entry(self.zip, target, self.zip.getinfo(source), self._reader)
+		self._dedup_files += 1
+		self._dedup_saved += size
+		return True
+
+	def writestr(self, target, content, compress=zipfile.ZIP_DEFLATED, media_type=None):
 		"""
         Write the content of a string.
 
         :param target: path for the target file
         :param content: string/bytes to be written on the file
-        :param compress: either ``zipfile.ZIP_DEFLATED`` or ``zipfile.ZIP_STORED``, whether the content should be compressed, resp. not compressed
+        :param compress: either ``zipfile.ZIP_DEFLATED`` or ``zipfile.ZIP_STORED``, whether the content may be compressed (as set by the compression policy), resp. not compressed
+        :param media_type: media type of the content; `None` means that it is guessed from the target's suffix
          """
 		# Care should be taken not to write the "target" twice; the zipfile would really
 		# duplicate the content in the archive (as opposed to file writing that would simply overwrite the previous
-		# incarnation of the same file). This method takes care of that through the `already_stored` array.
+		# incarnation of the same file). This method takes care of that through the `already_stored` set.
 		if target not in self.already_stored:
-			self.already_stored.append(target)
+			self.already_stored.add(target)
 			if self.folder:
 				with open(self._path(target), "w") as f:
 					f.write(content)
 			if self.package:
-				self.zip.writestr(target, content, compress)
+				method = self._method(target, compress, media_type, len(content))
+				if self._dedup is not None and self._reuse(target, method, hashlib.sha1(content).digest(), len(content)):
+					return
+				if method == STORED:
+					# The local header gets the final CRC and size (the 'mimetype' entry must not have a data descriptor)
+					if self._deflater is not None:
+						self._deflater.drain(wait=True)
+					write_stored(self.zip, target, content)
+					return
+				if self._deflater is not None:
+					entry = self._deflater.open(target, method)
+				else:
+					entry = ZipEntryWriter(self.zip, target, method)
+				with entry:
+					entry.write(content)
+
+	def open_entry(self, target, compress=zipfile.ZIP_DEFLATED, media_type=None, size=None, digest=None):
+		"""
+        Open a file-like object to write the content of a file in chunks, instead of providing the full content as a string
+        (see :py:meth:`writestr`). The content is written into the archive (compressed on the fly) and/or into the folder
+        as it comes in; the object must be closed when all the content has been written, and no other file may be
+        written into the book while the object is open.
+
+        :param target: path for the target file
+        :param compress: either ``zipfile.ZIP_DEFLATED`` or ``zipfile.ZIP_STORED``, whether the content may be compressed (as set by the compression policy), resp. not compressed
+        :param media_type: media type of the content; `None` means that it is guessed from the target's suffix
+        :param size: size of the content, if known in advance
+        :param digest: SHA-1 digest of the content, if known in advance; if deduplication is on, and a file with the same content is already in the package, its compressed data is reused, and the content written into the returned object goes into the folder only
+        :return: a :py:class:`.zipstream.ChunkedWriter` instance, or `None` if the target has already been written into the book
+        """
+		if target in self.already_stored:
+			return None
+		self.already_stored.add(target)
+		outputs = []
+		if self.folder:
+			outputs.append(open(self._path(target), "w"))
+		if self.package:
+			method = self._method(target, compress, media_type, size)
+			if self._dedup is not None and digest is not None and self._reuse(target, method, digest, size):
+				# The package entry is already complete, the content goes only into the folder (if any)
+				pass
+			elif self._deflater is not None:
+				outputs.append(self._deflater.open(target, method))
+			else:
+				outputs.append(ZipEntryWriter(self.zip, target, method))
+		return ChunkedWriter(outputs)
 
 	# noinspection PyUnresolvedReferences
 	def write_element(self, target, element):
 		"""
-        An ElementTree object is added to the book.
+        An ElementTree object is added to the book. The tree is serialized by its own engine (see :py:func:`.engines.engine_of`),
+        and the serialization is streamed into the book (see :py:meth:`open_entry`).
 
         :param str target: path for the target file
         :param element: the XML tree to be stored
-        :type element: :py:class:`xml.etree.ElementTree`
+        :type element: :py:class:`xml.etree.ElementTree` or :py:class:`lxml.etree._ElementTree`
         """
-		content = StringIO()
-		element.write(content, encoding="utf-8", xml_declaration=True, method="xml")
-		self.writestr(target, content.getvalue())
-		content.close()
+		entry = self.open_entry(target)
+		if entry is not None:
+			with entry:
+				engine_of(element).write(element, entry)
 
 	# noinspection PyTypeChecker
-	def write_session(self, target, session, css_change_patterns = None):
+	def write_session(self, target, session, css_rewriters = None):
 		"""
         The returned content of an :py:class:`.HttpSession` is added to the book. If the content is an HTML file, it will be converted into XHTML on the fly.
 
         :param str target: path for the target file
         :param session: a :py:class:`.HttpSession` instance whose data must retrieved to be written into the book
-        :param css_change_patterns: a list of ``(from,to)`` replace patterns to be applied on CSS files before storage
+        :param css_rewriters: a mapping from the URL of CSS files to :py:class:`.cssurls.CSSRewriter` instances, to be applied on those files before storage
         :return boolean: the value of session.success
         """
-		if css_change_patterns is None :
-			css_change_patterns = []
+		if css_rewriters is None :
+			css_rewriters = {}
 
 		# Copy the content into the final book
 		# Special care should be taken with html files. Those are supposed to become XHTML:-(
@@ -661,21 +921,51 @@ class Book(object):
 				# 1. parse the source with the html5 parser
 				# 2. add the xhtml namespace to the top and take care of the stupid script issue (no self-closing scripts!)
 				# 3. write the result as xhtml through the write_element method
-				html = html5lib.parse(session.data, namespaceHTMLElements=False)
+				html = self._engine.parse(session.data)
 				Utils.html_to_xhtml(html)
-				self.write_element(target.replace('.html', '.xhtml', 1), ElementTree(html))
+				self.write_element(target.replace('.html', '.xhtml', 1), self._engine.tree(html))
 			elif session.media_type == 'text/css':
-				# We have to make a series of string replacements, as defined in the `css_change_patterns`
-				# parameter.
-				content = session.data.read()
-				for (c_from, c_to) in css_change_patterns:
-					content = content.replace(c_from, c_to)
-				self.writestr(target, content)
+				# We may have to make a series of string replacements, as defined by the rewriter
+				# set for this CSS file in the `css_rewriters` parameter.
+				content  = session.data.read()
+				rewriter = css_rewriters.get(session.url)
+				if rewriter is not None:
+					content = rewriter.rewrite(content)
+				self.writestr(target, content, media_type=session.media_type)
 			else:
-				# Note that some of the media types are not to be compressed
-				self.writestr(target, session.data.read(), zipfile.ZIP_STORED if session.media_type in _NO_COMPRESS else zipfile.ZIP_DEFLATED)
+				# The content may be large (e.g., a video); it is copied into the book in chunks.
+				# Note that some of the media types are not to be compressed; this is set by the compression policy
+				digest = self._digest(session) if self._dedup is not None else None
+				entry = self.open_entry(target, media_type=session.media_type, size=session.size, digest=digest)
+				if entry is not None:
+					data = session.data
+					try:
+						with entry:
+							shutil.copyfileobj(data, entry, config.WRITE_CHUNK_SIZE)
+					finally:
+						data.close()
 		return session.success
 
+	@staticmethod
+	def _digest(session):
+		"""
+        SHA-1 digest of the content of a session, read in chunks; the content must have been buffered (see
+        :py:meth:`.HttpSession.buffer`), otherwise it could not be read again for the book.
+
+        :param session: a :py:class:`.HttpSession` instance
+        :return: the digest, or `None` if the content has not been buffered
+        """
+		if session.size is None:
+			return None
+		sha1 = hashlib.sha1()
+		data = session.data
+		try:
+			for chunk in iter(lambda: data.read(config.WRITE_CHUNK_SIZE), ""):
+				sha1.update(chunk)
+		finally:
+			data.close()
+		return sha1.digest()
+
 	# noinspection PyPep8Naming
 	def write_HTTP(self, target, url):
 		"""
@@ -708,7 +998,13 @@ class Book(object):
         Close the book (i.e., the archive).
         """
 		if self.package:
+			if self._deflater is not None:
+				self._deflater.close()
+			if self._reader is not None and self._reader is not self.zip.fp:
+				self._reader.close()
 			self.zip.close()
+			if self._dedup_files > 0:
+				Logger.info("Deduplication: %s file(s) reused the content of other files, %s bytes were not compressed again" % (self._dedup_files, self._dedup_saved))
 
 	# The methods below are necessary to use the class in a "with ... as" python structure
 	def __enter__(self):
@@ -0,0 +1,557 @@
+"""
+Streaming write of files into the book. The standard :py:class:`zipfile.ZipFile` class (in Python 2.7) can only add
+the content of a string or of a file on disk; for a large, serialized XHTML document, this means that the full
+serialization must be kept in memory (and then compressed in memory again). The classes in this module allow the
+content to be written into the archive chunk by chunk instead, compressed on the fly, so that the memory used does
+not depend on the size of the content.
+
+* :py:class:`ZipEntryWriter` is a file-like object that writes (and compresses) its content into a new entry of a zip archive.
+  The compression method of the entry is one of the methods of the :py:mod:`.compression` module; if the first chunk
+  of the content does not shrink when compressed (see :py:func:`.compression.shrinks`), the entry is stored uncompressed.
+* :py:class:`ChunkedWriter` is a file-like object that collects the (possibly many and small) pieces written into it, and
+  passes them on in larger chunks to one or more file-like objects, e.g., to a :py:class:`ZipEntryWriter` and to a
+  file in the book's folder.
+* :py:func:`seekable` and :py:func:`readable` check the capabilities of the stream the archive is written into.
+* :py:class:`CountingStream` wraps a stream that is not seekable (e.g., a socket or the standard output); an archive
+  written into it is written progressively, i.e., the CRC and sizes of each entry follow its content in a "data
+  descriptor" instead of being set in the local header afterwards. An entry to be stored uncompressed is then written
+  as a deflate stream of uncompressed blocks, because a stored entry with a data descriptor has no way to mark the end
+  of its content for a reader going through the archive sequentially.
+* :py:func:`write_stored` adds an uncompressed entry whose content is known in advance; its local header carries
+  the final CRC and size even if the archive is not seekable (this is required for the ``mimetype`` entry of an EPUB).
+* :py:func:`copy_entry` adds an entry with the same content as an existing one, by copying the compressed data of that
+  entry (i.e., without compressing the same content again).
+* :py:class:`ParallelDeflater` compresses the entries of an archive in a pool of threads (the compression in ``zlib``
+  releases the global interpreter lock), while the entries are still written into the archive in the order they are
+  added. The content of an entry is compressed in blocks of 256KB, each ending with a "sync flush" of the compressor
+  (the technique used by, e.g., ``pigz``); the concatenation of the compressed blocks is a valid deflate stream. This
+  means that even a single, large entry (e.g., the main XHTML document) is compressed in parallel, and its compression
+  also overlaps with its serialization. The price is a (slightly) lower compression ratio, because each block is
+  compressed without the content of the previous blocks.
+
+.. :class::
+
+Module content
+--------------
+"""
+
+import time
+import zlib
+import struct
+import zipfile
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from .config import WRITE_CHUNK_SIZE
+from .compression import STORED, DEFAULT, compressor, splittable, shrinks
+
+# Size of the blocks compressed separately by the ParallelDeflater; smaller blocks mean a lower compression ratio
+_DEFLATE_BLOCK_SIZE = 256 * 1024
+
+# General purpose flag of an entry whose CRC and sizes are written after the content, in a data descriptor
+_DATA_DESCRIPTOR = 0x08
+
+
+# noinspection PyPep8,PyProtectedMember
+class ZipEntryWriter(object):
+	"""
+	File-like object adding a new entry to a zip archive; the content written into the object is compressed (if
+	required) and written into the archive on the fly. The local header of the entry is written when the first chunk of
+	the content arrives; the entry is finalized (i.e., the CRC and the sizes are set in the local header, or written in a
+	data descriptor if the archive is written into a :py:class:`CountingStream`, and the entry is added to the archive's
+	directory) when the object is closed.
+
+	Only one entry may be written at a time (i.e., no other content may be added to the archive while the object is open).
+
+	:param zip_file: the archive, opened for writing
+	:type zip_file: :py:class:`zipfile.ZipFile`
+	:param str name: the name of the entry in the archive
+	:param str method: the compression method, see :py:data:`.compression.METHODS`
+	"""
+	def __init__(self, zip_file, name, method=DEFAULT):
+		self._zip        = zip_file
+		self._fp         = zip_file.fp
+		self._name       = name
+		self._method     = method
+		self._info       = None
+		self._compressor = None
+		self._closed     = False
+
+	@property
+	def info(self):
+		"""The :py:class:`zipfile.ZipInfo` instance of the entry; `None` until the first chunk of the content is written"""
+		return self._info
+
+	def _start(self, sample):
+		"""
+		Set the final compression method and write the local header of the entry (with a zero CRC and zero sizes; it
+		is overwritten by the final values when closing, unless they are written into a data descriptor).
+
+		:param str sample: the first chunk of the content
+		"""
+		method = self._method if self._method != STORED and shrinks(sample) else STORED
+		self._info = _new_info(self._zip, self._name, zipfile.ZIP_STORED if method == STORED else zipfile.ZIP_DEFLATED)
+		if self._info.flag_bits & _DATA_DESCRIPTOR:
+			# Stored content goes into uncompressed deflate blocks (see the CountingStream class)
+			self._info.compress_type = zipfile.ZIP_DEFLATED
+		self._fp.write(self._info.FileHeader(False))
+		if self._info.compress_type == zipfile.ZIP_DEFLATED:
+			self._compressor = compressor(method)
+
+	def write(self, data):
+		"""
+		Add data to the entry.
+
+		:param str data: the (binary) data
+		"""
+		if self._info is None:
+			self._start(data)
+		self._info.file_size += len(data)
+		self._info.CRC = zlib.crc32(data, self._info.CRC) & 0xffffffff
+		if self._compressor is not None:
+			data = self._compressor.compress(data)
+		self._info.compress_size += len(data)
+		self._fp.write(data)
+
+	def close(self):
+		"""
+		Finalize the entry in the archive.
+
+		:raises zipfile.LargeZipFile: if the entry would require the ZIP64 extensions
+		"""
+		if self._closed:
+			return
+		self._closed = True
+		if self._info is None:
+			self._start("")
+		if self._compressor is not None:
+			data = self._compressor.flush()
+			self._info.compress_size += len(data)
+			self._fp.write(data)
+		_finalize(self._zip, self._info)
+
+	# The methods below are necessary to use the class in a "with ... as" python structure
+	def __enter__(self):
+		return self
+
+	# noinspection PyUnusedLocal
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+# noinspection PyProtectedMember
+def _new_info(zip_file, name, compress):
+	"""
+	Create the :py:class:`zipfile.ZipInfo` instance of a new entry, with the same parameters as used by
+	:py:meth:`zipfile.ZipFile.writestr`, and with a zero CRC and zero sizes. The offset of the header is set to the current
+	position in the archive. If the archive is written into a :py:class:`CountingStream`, the entry is flagged to have a
+	data descriptor.
+	"""
+	info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+	info.compress_type = compress
+	info.external_attr = 0600 << 16
+	info.file_size     = 0
+	info.compress_size = 0
+	info.CRC           = 0
+	info.header_offset = zip_file.fp.tell()
+	if isinstance(zip_file.fp, CountingStream):
+		info.flag_bits |= _DATA_DESCRIPTOR
+	zip_file._writecheck(info)
+	zip_file._didModify = True
+	return info
+
+
+def _finalize(zip_file, info):
+	"""
+	Finalize an entry whose content has been written: rewrite the local header with the final CRC and sizes (the
+	header's offset is in the ``header_offset`` attribute of the info), or write them in a data descriptor after the
+	content if the entry is so flagged, and add the entry to the archive's directory.
+
+	:raises zipfile.LargeZipFile: if the entry would require the ZIP64 extensions
+	"""
+	if info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT:
+		raise zipfile.LargeZipFile("Entry %s would require ZIP64 extensions" % info.filename)
+	fp = zip_file.fp
+	if info.flag_bits & _DATA_DESCRIPTOR:
+		fp.write(struct.pack("<4sLLL", "PK\x07\x08", info.CRC, info.compress_size, info.file_size))
+	else:
+		position = fp.tell()
+		fp.seek(info.header_offset, 0)
+		fp.write(info.FileHeader(False))
+		fp.seek(position, 0)
+	zip_file.filelist.append(info)
+	zip_file.NameToInfo[info.filename] = info
+
+
+def write_stored(zip_file, name, content):
+	"""
+	Add an uncompressed entry to a zip archive, with a content known in advance. The local header of the entry carries
+	the final CRC and size, i.e., the entry has no data descriptor even if the archive is written into a
+	:py:class:`CountingStream`.
+
+	:param zip_file: the archive, opened for writing
+	:type zip_file: :py:class:`zipfile.ZipFile`
+	:param str name: the name of the entry
+	:param str content: the content of the entry
+	"""
+	info = _new_info(zip_file, name, zipfile.ZIP_STORED)
+	info.flag_bits    &= ~_DATA_DESCRIPTOR
+	info.CRC           = zlib.crc32(content) & 0xffffffff
+	info.file_size     = len(content)
+	info.compress_size = len(content)
+	zip_file.fp.write(info.FileHeader(False))
+	zip_file.fp.write(content)
+	zip_file.filelist.append(info)
+	zip_file.NameToInfo[info.filename] = info
+
+
+# noinspection PyPep8
+class CountingStream(object):
+	"""
+	Wrapper around a writable binary stream that is not seekable (e.g., a pipe, a socket, or the standard output) or
+	that does not start with the archive. The position returned by :py:meth:`tell` is the number of bytes written
+	through the wrapper, i.e., the offsets in the archive are relative to the start of the archive. An archive written
+	into the wrapper cannot go back to the local headers: the CRC and the sizes of the entries are written in data
+	descriptors, i.e., each entry is sent out as soon as it is written.
+
+	:param stream: the (binary) stream
+	"""
+	def __init__(self, stream):
+		self._stream   = stream
+		self._position = 0
+
+	def write(self, data):
+		self._stream.write(data)
+		self._position += len(data)
+
+	def tell(self):
+		return self._position
+
+	def flush(self):
+		if hasattr(self._stream, "flush"):
+			self._stream.flush()
+
+	@staticmethod
+	def seekable():
+		return False
+
+	@staticmethod
+	def readable():
+		return False
+
+
+def seekable(stream):
+	"""
+	Check whether the position of a (binary) stream can be changed, i.e., whether a zip archive can be written into it
+	directly. Pipes, sockets, or the standard output are usually not seekable.
+
+	:param stream: a file-like object
+	:rtype: boolean
+	"""
+	if hasattr(stream, "seekable"):
+		return stream.seekable()
+	try:
+		stream.seek(stream.tell(), 0)
+		return True
+	except (AttributeError, IOError):
+		return False
+
+
+def readable(stream):
+	"""
+	Check whether a (binary) stream can also be read, i.e., whether the content already written into it can be read back.
+
+	:param stream: a file-like object
+	:rtype: boolean
+	"""
+	if hasattr(stream, "readable"):
+		return stream.readable()
+	if hasattr(stream, "mode"):
+		return "r" in stream.mode or "+" in stream.mode
+	return hasattr(stream, "read")
+
+
+def copy_entry(zip_file, name, source, reader):
+	"""
+	Add a new entry to a zip archive with the same content as an existing entry. The compressed data of the existing
+	entry is copied, in chunks, into the new entry; i.e., the content is not compressed again.
+
+	(The two entries cannot share the same data in the archive: each entry must have its own local header, with its
+	own name, in front of its data.)
+
+	:param zip_file: the archive, opened for writing
+	:type zip_file: :py:class:`zipfile.ZipFile`
+	:param str name: the name of the new entry
+	:param source: the :py:class:`zipfile.ZipInfo` instance of the existing (and finalized) entry
+	:param reader: a file object opened for reading on the archive file; it may also be the (readable) stream the
+	 archive is written into
+	"""
+	info = _new_info(zip_file, name, source.compress_type)
+	info.CRC           = source.CRC
+	info.file_size     = source.file_size
+	info.compress_size = source.compress_size
+	fp = zip_file.fp
+	# The data of the existing entry must be on disk before it is read back
+	fp.flush()
+	fp.write(info.FileHeader(False))
+	position  = source.header_offset + len(source.FileHeader(False))
+	remaining = source.compress_size
+	while remaining > 0:
+		# The reader may share its position with the archive's stream
+		end = fp.tell()
+		reader.seek(position, 0)
+		data = reader.read(min(remaining, WRITE_CHUNK_SIZE))
+		if len(data) == 0:
+			raise IOError("Unexpected end of the archive when copying %s" % source.filename)
+		fp.seek(end, 0)
+		fp.write(data)
+		position  += len(data)
+		remaining -= len(data)
+	zip_file.filelist.append(info)
+	zip_file.NameToInfo[info.filename] = info
+
+
+def _deflate(data, final, method):
+	"""
+	Compress a block of an entry into a part of a raw deflate stream. The result can be concatenated with the compressed
+	version of the next block; the last block of the entry terminates the stream.
+
+	:param str data: the block
+	:param boolean final: whether this is the last block of the entry
+	:param str method: the compression method
+	:return: the compressed block
+	"""
+	block_compressor = compressor(method)
+	return block_compressor.compress(data) + block_compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+# noinspection PyPep8
+class _ParallelEntry(object):
+	"""
+	File-like object for an entry written through a :py:class:`ParallelDeflater`. The content written into the object
+	is handed over to the deflater in blocks; the entry is complete when the object is closed. The final compression
+	method is set when the first chunk of the content arrives (see :py:class:`ZipEntryWriter`).
+
+	:param deflater: the deflater
+	:type deflater: :py:class:`ParallelDeflater`
+	:param info: the :py:class:`zipfile.ZipInfo` instance of the entry
+	:param str method: the compression method
+	"""
+	def __init__(self, deflater, info, method):
+		self._deflater = deflater
+		self._method   = method
+		self.info      = info
+		# The final compression method; `None` until the first chunk of the content is written
+		self.method    = None
+		# The compressed blocks (strings) or the compressions in progress, not yet written into the archive
+		self.blocks    = deque()
+		self.closed    = False
+		self.started   = False
+		# The content of the block being collected
+		self._block    = []
+		self._size     = 0
+		# The last full block is kept back: the block terminating the stream must be compressed differently
+		self._last     = None
+
+	def write(self, data):
+		"""
+		Add data to the entry.
+
+		:param str data: the (binary) data
+		"""
+		if len(data) == 0:
+			return
+		if self.method is None:
+			self._start(data)
+		self.info.file_size += len(data)
+		self.info.CRC = zlib.crc32(data, self.info.CRC) & 0xffffffff
+		if self.info.compress_type == zipfile.ZIP_STORED:
+			self._deflater.add(self, data)
+		else:
+			self._block.append(data)
+			self._size += len(data)
+			if splittable(self.method) and self._size >= _DEFLATE_BLOCK_SIZE:
+				if self._last is not None:
+					self._deflater.add(self, self._last, False)
+				self._last  = "".join(self._block)
+				self._block = []
+				self._size  = 0
+
+	def close(self):
+		"""
+		Terminate the entry; it is written into the archive as soon as the entries added before are written, and its
+		blocks are compressed.
+		"""
+		if self.closed:
+			return
+		if self.method is None:
+			self._start("")
+		if self.info.compress_type == zipfile.ZIP_DEFLATED:
+			if self._last is not None:
+				self._deflater.add(self, self._last, self._size == 0)
+			if self._size > 0 or self._last is None:
+				self._deflater.add(self, "".join(self._block), True)
+			self._last  = None
+			self._block = []
+		self.closed = True
+		self._deflater.drain()
+
+	def _start(self, sample):
+		"""Set the final compression method, using the first chunk of the content"""
+		self.method = self._method if self._method != STORED and shrinks(sample) else STORED
+		# Stored content of an entry with a data descriptor goes into uncompressed deflate blocks (see the CountingStream class)
+		stored = self.method == STORED and not self.info.flag_bits & _DATA_DESCRIPTOR
+		self.info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+
+	# The methods below are necessary to use the class in a "with ... as" python structure
+	def __enter__(self):
+		return self
+
+	# noinspection PyUnusedLocal
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+# noinspection PyPep8
+class ParallelDeflater(object):
+	"""
+	Compression of the entries of a zip archive in a pool of threads. The entries are opened (see :py:meth:`open`) and
+	filled in the calling thread; the blocks of their content are compressed in the pool, and the compressed blocks
+	are written into the archive in the order of the entries and of the blocks, i.e., the resulting archive does not
+	depend on the scheduling of the threads. Several entries may be open at the same time.
+
+	The number of blocks being compressed or waiting to be written is limited; when the limit is reached, the
+	calling thread waits until the first one is written into the archive. The archive must be seekable.
+
+	:param zip_file: the archive, opened for writing
+	:type zip_file: :py:class:`zipfile.ZipFile`
+	:param int workers: number of threads compressing the blocks
+	"""
+	def __init__(self, zip_file, workers):
+		self._zip         = zip_file
+		self._pool        = ThreadPool(workers)
+		self._entries     = deque()
+		self._pending     = 0
+		self._max_pending = 4 * workers
+
+	def open(self, name, method=DEFAULT):
+		"""
+		Open a new entry in the archive.
+
+		:param str name: the name of the entry in the archive
+		:param str method: the compression method, see :py:data:`.compression.METHODS`
+		:return: a file-like object, to be closed when all the content has been written
+		"""
+		entry = _ParallelEntry(self, _new_info(self._zip, name, zipfile.ZIP_DEFLATED), method)
+		self._entries.append(entry)
+		return entry
+
+	def add(self, entry, data, final=None):
+		"""
+		Add a block to an entry. This method is called by the file-like objects returned by :py:meth:`open`.
+
+		:param entry: the entry
+		:param str data: the block
+		:param final: whether this is the last block of the entry, or `None` if the block is stored uncompressed
+		"""
+		if final is None:
+			entry.blocks.append(data)
+		else:
+			entry.blocks.append(self._pool.apply_async(_deflate, (data, final, entry.method)))
+		self._pending += 1
+		self.drain()
+
+	def drain(self, wait=False):
+		"""
+		Write the compressed blocks into the archive, in order, as far as they are available. The method waits for
+		the compression of blocks if there are too many pending ones or if so requested.
+
+		:param boolean wait: whether to wait until the blocks of all closed entries are written
+		"""
+		fp = self._zip.fp
+		while self._entries:
+			entry = self._entries[0]
+			if entry.method is None:
+				# The compression method, hence the header, is not yet known
+				return
+			if not entry.started:
+				entry.info.header_offset = fp.tell()
+				fp.write(entry.info.FileHeader(False))
+				entry.started = True
+			while entry.blocks:
+				block = entry.blocks[0]
+				if not isinstance(block, basestring):
+					if not (wait or self._pending > self._max_pending or block.ready()):
+						return
+					block = block.get()
+				entry.blocks.popleft()
+				self._pending -= 1
+				entry.info.compress_size += len(block)
+				fp.write(block)
+			if not entry.closed:
+				return
+			_finalize(self._zip, entry.info)
+			self._entries.popleft()
+
+	def close(self):
+		"""
+		Write all the remaining entries into the archive and release the threads. All entries must have been closed.
+		"""
+		self.drain(wait=True)
+		self._pool.close()
+		self._pool.join()
+
+
+# noinspection PyPep8
+class ChunkedWriter(object):
+	"""
+	File-like object collecting the pieces written into it, and writing them, in chunks, into one or more
+	file-like objects. Serializers (e.g., :py:meth:`xml.etree.ElementTree.ElementTree.write`) write the content in many
+	small pieces; collecting those avoids compressing (and writing) each small piece separately.
+
+	:param outputs: list of file-like objects; these are closed when this object is closed
+	:param int chunk_size: the (approximate) size of the chunks written into the outputs
+	"""
+	def __init__(self, outputs, chunk_size=WRITE_CHUNK_SIZE):
+		self._outputs    = outputs
+		self._chunk_size = chunk_size
+		self._pieces     = []
+		self._size       = 0
+
+	def write(self, data):
+		"""
+		Add data to the content.
+
+		:param str data: the (binary) data
+		"""
+		self._pieces.append(data)
+		self._size += len(data)
+		if self._size >= self._chunk_size:
+			self.flush()
+
+	def flush(self):
+		"""
+		Write the collected pieces into the outputs.
+		"""
+		if self._pieces:
+			chunk = "".join(self._pieces)
+			self._pieces = []
+			self._size   = 0
+			for output in self._outputs:
+				output.write(chunk)
+
+	def close(self):
+		"""
+		Write the remaining pieces and close the outputs.
+		"""
+		self.flush()
+		for output in self._outputs:
+			output.close()
+
+	# The methods below are necessary to use the class in a "with ... as" python structure
+	def __enter__(self):
+		return self
+
+	# noinspection PyUnusedLocal
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
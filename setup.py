@@ -6,7 +6,7 @@ setup(
 	name='rp2epub',
 	version=rp2epub.__version__,
 	packages=['rp2epub'],
-	scripts=['script/rp2epub'],
+	scripts=['script/rp2epub', 'script/rp2epub-service'],
 	url='https://github.com/iherman/respec2epub',
 	download_url='https://github.com/iherman/tr2epub/archive/master.zip',
 	license='W3C © SOFTWARE NOTICE AND LICENSE <http://www.w3.org/Consortium/Legal/2002/copyright-software-20021231>',
@@ -0,0 +1,82 @@
+"""
+Benchmark of the element lookups done while a document is processed: each lookup as a ``findall`` walk of the full tree,
+versus the same lookups on a :py:class:`rp2epub.domindex.DOMIndex` (built in one walk of the tree, and rebuilt after
+the changes done on the tree in between).
+
+The document is generated: a specification-like structure with a number of sections (default: 2000), set as the first
+argument. Run, from the top directory of the repository, with::
+
+    python test/bench_domindex.py [sections]
+"""
+import os
+import sys
+import time
+from xml.etree.ElementTree import SubElement
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from rp2epub.engines import get_engine
+from rp2epub.domindex import DOMIndex
+
+# The lookups of Document and Utils, in the order they are done; "add" stands for the addition of an element in the head
+LOOKUPS = [
+	("script", "src", None), ("link", "rel", "stylesheet"), ("style", None, None), ("head", None, None), "add",
+	("base", None, None), ("meta", "http-equiv", "content-type"), ("meta", "http-equiv", "Content-Type"), "add",
+	("body", None, None), ("div", "main", "role"), ("pre", "class", None), ("link", "rel", "stylesheet"),
+	("script", "src", None), ("img", None, None), ("object", None, None), ("script", None, None), ("link", None, None),
+	("a", "href", None), ("a", "class", "u-url"), ("a", "class", "u-url"), ("dd", "class", None),
+	("h2", "property", "dcterms:issued"), ("link", "rel", "stylesheet"), ("head", None, None),
+	("script", "id", "initialUserConfig"), ("title", None, None), ("script", None, None), ("form", None, None),
+	("{http://www.w3.org/2000/svg}svg", None, None), ("{http://www.w3.org/1998/Math/MathML}math", None, None),
+]
+
+
+def document(sections):
+	content = ['<!DOCTYPE html><html><head><title>Bench</title><link rel="stylesheet" href="a.css"></head><body><nav id="toc"><ul class="toc">']
+	content += ['<li class="tocline"><a href="#s%d">Section %d</a></li>' % (i, i) for i in range(sections)]
+	content.append('</ul></nav>')
+	for i in range(sections):
+		content.append('<section id="s%d"><h2>Section %d</h2><p class="note">Text <a href="#s%d">link</a> <code>x</code></p>' % (i, i, i))
+		content.append('<p><img src="f%d.png" alt=""> <dfn id="d%d">term</dfn></p><pre class="highlight">var x;</pre></section>' % (i % 12, i))
+	content.append('</body></html>')
+	return "".join(content)
+
+
+def with_findall(root):
+	head = root.find(".//head")
+	for lookup in LOOKUPS:
+		if lookup == "add":
+			SubElement(head, "link")
+		else:
+			tag, attribute, value = lookup
+			if attribute is None:
+				root.findall(".//%s" % tag)
+			elif value is None:
+				root.findall(".//%s[@%s]" % (tag, attribute))
+			else:
+				root.findall(".//%s[@%s='%s']" % (tag, attribute, value))
+
+
+def with_index(root):
+	index = DOMIndex(root)
+	head  = index.find("head")
+	for lookup in LOOKUPS:
+		if lookup == "add":
+			index.add(SubElement(head, "link"), head)
+		else:
+			index.find_all(*lookup)
+
+
+def main(sections):
+	engine = get_engine("etree")
+	root   = engine.parse(document(sections))
+	print "%s elements, %s lookups, %s changes" % (len(list(root.iter())), len(LOOKUPS) - LOOKUPS.count("add"), LOOKUPS.count("add"))
+	for name, function in (("findall", with_findall), ("DOMIndex", with_index)):
+		tree  = engine.parse(document(sections))
+		start = time.time()
+		function(tree)
+		print "%-8s: %.3f s" % (name, time.time() - start)
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,101 @@
+"""
+Local HTTP/1.1 (keep-alive) server for the tests, serving fixed resources from a background thread. The requests are
+recorded, with the port of the client connection, so that the tests can check what went over the network.
+"""
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class Resource(object):
+	"""
+	A resource of the server.
+
+	:param str body: the content
+	:param str media_type: the media type
+	:param dict headers: further header fields of the responses (e.g., ``ETag`` or ``Cache-Control``)
+	"""
+	def __init__(self, body, media_type="text/css", headers=None):
+		self.body       = body
+		self.media_type = media_type
+		self.headers    = headers or {}
+
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def _respond(self, with_body):
+		resource = self.server.resources.get(self.path.split("?")[0])
+		if resource is None:
+			status = 404
+		elif self.headers.getheader("If-None-Match") is not None and self.headers.getheader("If-None-Match") == resource.headers.get("ETag"):
+			status = 304
+		elif self.headers.getheader("If-Modified-Since") is not None and self.headers.getheader("If-Modified-Since") == resource.headers.get("Last-Modified"):
+			status = 304
+		else:
+			status = 200
+		self.server.record(self.command, self.path, status, self.client_address[1])
+
+		body = resource.body if status == 200 else ("" if status == 304 else "Not found")
+		self.send_response(status)
+		if resource is not None:
+			for name, value in resource.headers.items():
+				self.send_header(name, value)
+		if status != 304:
+			self.send_header("Content-Type", resource.media_type if status == 200 else "text/plain")
+			self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		if with_body and status != 304:
+			self.wfile.write(body)
+
+	def do_GET(self):
+		self._respond(True)
+
+	def do_HEAD(self):
+		self._respond(False)
+
+	def log_message(self, *args):
+		pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+		# E.g., a connection closed by the client before the end of a response
+		pass
+
+
+class TestServer(object):
+	"""
+	The server, listening on a free port of the loopback interface until it is closed.
+
+	:param dict resources: the resources, keyed by their paths
+	"""
+	def __init__(self, resources):
+		self._server = _Server(("127.0.0.1", 0), _Handler)
+		self._server.resources = resources
+		self._server.record    = self._record
+		self._lock             = threading.Lock()
+		#: The requests: (method, path, status, client port) tuples, in the order they were received
+		self.requests          = []
+		self._thread = threading.Thread(target=self._server.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _record(self, method, path, status, port):
+		with self._lock:
+			self.requests.append((method, path, status, port))
+
+	def url(self, path):
+		"""The URL of a path on the server"""
+		return "http://127.0.0.1:%s%s" % (self._server.server_address[1], path)
+
+	def statuses(self, path):
+		"""The statuses of the responses sent for a path, in order"""
+		with self._lock:
+			return [status for method, p, status, port in self.requests if p == path]
+
+	def close(self):
+		self._server.shutdown()
+		self._server.server_close()
@@ -0,0 +1,112 @@
+"""
+Tests of the batches: sources with the same short name must not overwrite each other's book, and the resources shared
+by the books are retrieved once for the whole batch.
+"""
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from rp2epub import batch, doc2epub
+
+from httpserver import TestServer, Resource
+
+PAGE = """<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>%(title)s</title>
+<link rel="stylesheet" href="shared/style.css"></head><body><h1>%(title)s</h1>
+<dl><dt>This version:</dt><dd><a class="u-url" href="https://www.w3.org/TR/2016/WD-%(name)s-20160101/">x</a></dd></dl>
+<p><img src="shared/figure.png" alt=""></p></body></html>"""
+
+FRESH = {"Cache-Control": "max-age=3600"}
+
+RESOURCES = {
+	"/spec/one.html"         : Resource(PAGE % {"title": "One", "name": "one"}, "text/html"),
+	"/spec/two.html"         : Resource(PAGE % {"title": "Two", "name": "two"}, "text/html"),
+	"/spec/shared/style.css" : Resource("body { background: url(back.png) }", headers=FRESH),
+	"/spec/shared/figure.png": Resource("PNG" * 100, "image/png", FRESH),
+	"/spec/shared/back.png"  : Resource("GIF" * 100, "image/png", FRESH),
+	"/Icons/logo.png"        : Resource("LOGO" * 100, "image/png", FRESH),
+	"/StyleSheets/base.css"  : Resource("h1 { color: red }", headers=FRESH),
+}
+
+
+class FakeWrapper(object):
+	"""Stand-in for DocWrapper: the short name is the last segment of the URL, nothing is generated"""
+	package = True
+	folder  = False
+
+	def __init__(self, url, is_respec=False, **options):
+		self.document  = self
+		self.short_name = self.book_name = url.rsplit("/", 1)[-1]
+
+	@property
+	def book_file_name(self):
+		return self.book_name + ".epub"
+
+	def process(self):
+		return self
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+
+class BatchNameTest(unittest.TestCase):
+	def setUp(self):
+		self.wrapper = batch.DocWrapper
+		self.claims  = tempfile.mkdtemp()
+		batch.DocWrapper = FakeWrapper
+		batch._initialize({}, self.claims)
+
+	def tearDown(self):
+		batch.DocWrapper = self.wrapper
+		shutil.rmtree(self.claims)
+
+	def test_unique_names(self):
+		entries = [(1, ("http://a/x", False)), (2, ("http://b/y", False)), (3, ("http://c/x", False)), (4, ("http://d/x", False))]
+		books = [batch._build(entry)["book"] for entry in entries]
+		self.assertEqual(books, ["x.epub", "y.epub", "x-3.epub", "x-4.epub"])
+
+	def test_taken_names(self):
+		# A short name may be the suffixed name of another book
+		results = [batch._build(entry) for entry in [(1, ("http://a/x", False)), (2, ("http://b/x-2", False)), (2, ("http://c/x", False))]]
+		self.assertEqual([result["book"] for result in results], ["x.epub", "x-2.epub", None])
+		self.assertFalse(results[2]["success"])
+		self.assertIn("x-2", results[2]["error"])
+
+
+class BatchCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.server      = TestServer(RESOURCES)
+		self.to_transfer = doc2epub.TO_TRANSFER
+		self.cwd         = os.getcwd()
+		self.directory   = tempfile.mkdtemp()
+		# The fixed resources of the books are served locally, too
+		doc2epub.TO_TRANSFER = [(self.server.url("/Icons/logo.png"), "Icons/w3c_main.png"),
+								(self.server.url("/StyleSheets/base.css"), "StyleSheets/TR/base.css")]
+		os.chdir(self.directory)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		doc2epub.TO_TRANSFER = self.to_transfer
+		shutil.rmtree(self.directory)
+		self.server.close()
+
+	def test_shared_resources(self):
+		entries = [(self.server.url("/spec/one.html"), False), (self.server.url("/spec/two.html"), False)]
+		summary = batch.run(entries, processes=1)
+		self.assertEqual(summary["succeeded"], 2)
+		for book in summary["books"]:
+			with zipfile.ZipFile(book["book"]) as package:
+				self.assertIsNone(package.testzip())
+				self.assertIn("shared/style.css", package.namelist())
+				self.assertIn("shared/back.png", package.namelist())
+		# The second book takes the shared resources from the (temporary) cache of the batch
+		for path in ("/spec/shared/style.css", "/spec/shared/figure.png", "/spec/shared/back.png", "/Icons/logo.png", "/StyleSheets/base.css"):
+			self.assertEqual(self.server.statuses(path), [200], path)
+
+
+if __name__ == "__main__":
+	unittest.main()
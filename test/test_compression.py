@@ -0,0 +1,50 @@
+"""
+Tests of the choice of the compression method: the method set by the policy is used, unless the content does not shrink
+when compressed; small files are always compressed as set by the policy.
+"""
+import random
+import zipfile
+import unittest
+from io import BytesIO
+
+from rp2epub.utils import Book
+from rp2epub.compression import shrinks
+from rp2epub.config import COMPRESSION_PROBE_MIN_SIZE
+
+# Content that does not shrink when compressed
+_random = random.Random(0)
+NOISE   = "".join(chr(_random.randrange(256)) for _ in range(4 * COMPRESSION_PROBE_MIN_SIZE))
+
+
+class CompressionTest(unittest.TestCase):
+	def test_shrinks(self):
+		self.assertTrue(shrinks("p { color: red }" * 1000))
+		self.assertFalse(shrinks(NOISE))
+		# Too small to be checked
+		self.assertTrue(shrinks(NOISE[:COMPRESSION_PROBE_MIN_SIZE - 1]))
+		self.assertTrue(shrinks(""))
+
+	def test_methods(self):
+		output = BytesIO()
+		with Book(output, "book") as book:
+			book.writestr("small.css", "body { color: black; background: white; margin: 1em; }")
+			book.writestr("empty.css", "")
+			book.writestr("noise.bin", NOISE, media_type="application/octet-stream")
+			book.writestr("small.bin", NOISE[:100], media_type="application/octet-stream")
+			book.writestr("logo.png", "PNG" * 1000)
+		package = zipfile.ZipFile(output)
+		self.assertIsNone(package.testzip())
+		methods = dict((info.filename, info.compress_type) for info in package.infolist())
+		self.assertEqual(methods, {
+			"mimetype"              : zipfile.ZIP_STORED,
+			"META-INF/container.xml": zipfile.ZIP_DEFLATED,
+			"small.css"             : zipfile.ZIP_DEFLATED,
+			"empty.css"             : zipfile.ZIP_DEFLATED,
+			"noise.bin"             : zipfile.ZIP_STORED,
+			"small.bin"             : zipfile.ZIP_DEFLATED,
+			"logo.png"              : zipfile.ZIP_STORED,
+		})
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,78 @@
+"""
+Tests of the persistent HTTP connections: a connection is reused once a response has been read to the end (or has no
+content), and is not reused after a partial read.
+"""
+import urllib2
+import unittest
+
+from rp2epub.utils import HttpSession
+from rp2epub.connections import ConnectionPool, PooledHTTPHandler
+
+from httpserver import TestServer, Resource
+
+RESOURCES = {
+	"/a.css"  : Resource("a { color: red }"),
+	"/b.css"  : Resource("b { color: blue }"),
+	"/big.png": Resource("PNG" * 100000, "image/png"),
+}
+
+
+class _HeadRequest(urllib2.Request):
+	def get_method(self):
+		return "HEAD"
+
+
+class ConnectionPoolTest(unittest.TestCase):
+	def setUp(self):
+		self.server = TestServer(RESOURCES)
+		self.pool   = ConnectionPool()
+		self.opener = urllib2.build_opener(PooledHTTPHandler(self.pool))
+
+	def tearDown(self):
+		self.pool.clear()
+		self.server.close()
+
+	def get(self, path, size=None):
+		response = self.opener.open(self.server.url(path))
+		try:
+			return response.read() if size is None else response.read(size)
+		finally:
+			response.close()
+
+	def ports(self):
+		"""The client ports of the requests received by the server, i.e., the connections used"""
+		return [port for method, path, status, port in self.server.requests]
+
+	def test_reuse(self):
+		self.assertEqual(self.get("/a.css"), RESOURCES["/a.css"].body)
+		self.assertEqual(self.get("/b.css"), RESOURCES["/b.css"].body)
+		self.assertEqual(len(set(self.ports())), 1)
+
+	def test_partial_read(self):
+		self.assertEqual(self.get("/big.png", 100), RESOURCES["/big.png"].body[:100])
+		# The rest of the response is still on the connection: it is closed, and the next request uses a new one
+		self.assertEqual(self.get("/a.css"), RESOURCES["/a.css"].body)
+		self.assertEqual(self.get("/b.css"), RESOURCES["/b.css"].body)
+		first, second, third = self.ports()
+		self.assertNotEqual(first, second)
+		self.assertEqual(second, third)
+
+	def test_head(self):
+		response = self.opener.open(_HeadRequest(self.server.url("/big.png")))
+		self.assertEqual(response.info().getheader("Content-Length"), str(len(RESOURCES["/big.png"].body)))
+		# The connection is released without reading (or closing) the response
+		self.assertEqual(self.get("/a.css"), RESOURCES["/a.css"].body)
+		self.assertEqual([method for method, path, status, port in self.server.requests], ["HEAD", "GET"])
+		self.assertEqual(len(set(self.ports())), 1)
+
+	def test_session(self):
+		# The sessions use the module level pool
+		for path in ("/a.css", "/b.css", "/a.css"):
+			session = HttpSession(self.server.url(path))
+			self.assertEqual(session.data.read(), RESOURCES[path].body)
+			session.data.close()
+		self.assertEqual(len(set(self.ports())), 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,126 @@
+"""
+Tests of the ReSpec conversions: the local command backend, and the cache of the conversion results, keyed by the
+fingerprint of the source (i.e., an unchanged source is not converted again, and a source without validators is
+converted each time).
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+from rp2epub import R2EError, converters
+from rp2epub.converters import CommandConverter, ConversionCache
+
+from httpserver import TestServer, Resource
+
+# The conversion command: appends a line to a log file, and "converts" the source into a page with its URL
+SCRIPT = """import sys
+with open(sys.argv[1], "a") as log:
+	log.write(sys.argv[2] + "\\n")
+sys.stdout.write("<html><body>%s</body></html>" % sys.argv[2])
+"""
+
+
+class ConverterTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.script    = os.path.join(self.directory, "convert.py")
+		self.log       = os.path.join(self.directory, "log")
+		with open(self.script, "w") as f:
+			f.write(SCRIPT)
+		self.converter = CommandConverter("%s %s %s" % (sys.executable, self.script, self.log))
+		self.server    = TestServer({
+			"/etag.html" : Resource("<html></html>", "text/html", {"ETag": '"v1"'}),
+			"/plain.html": Resource("<html></html>", "text/html"),
+		})
+
+	def tearDown(self):
+		converters.conversion_cache.directory = None
+		self.server.close()
+		shutil.rmtree(self.directory)
+
+	def runs(self):
+		"""The URLs converted by the command, in order"""
+		if not os.path.exists(self.log):
+			return []
+		with open(self.log) as f:
+			return f.read().split()
+
+	def test_command(self):
+		self.assertEqual(self.converter.convert("http://example.org/spec/"), "<html><body>http://example.org/spec/</body></html>")
+		# The URL may also be placed anywhere in the arguments
+		converter = CommandConverter("%s %s %s {url}?x=1" % (sys.executable, self.script, self.log))
+		self.assertEqual(converter.convert("http://example.org/b"), "<html><body>http://example.org/b?x=1</body></html>")
+		self.assertEqual(self.runs(), ["http://example.org/spec/", "http://example.org/b?x=1"])
+
+	def test_command_errors(self):
+		self.assertRaises(R2EError, CommandConverter("%s -c 'import sys; sys.exit(3)'" % sys.executable).convert, "http://example.org/")
+		self.assertRaises(R2EError, CommandConverter(os.path.join(self.directory, "missing")).convert, "http://example.org/")
+
+	def test_cached(self):
+		converters.conversion_cache.directory = os.path.join(self.directory, "cache")
+		url = self.server.url("/etag.html")
+		first  = converters.convert(url, self.converter)
+		second = converters.convert(url, self.converter)
+		self.assertEqual(first, second)
+		self.assertEqual(self.runs(), [url])
+		# Another converter does not share the result
+		other = CommandConverter("%s %s %s {url}" % (sys.executable, self.script, self.log))
+		converters.convert(url, other)
+		self.assertEqual(self.runs(), [url, url])
+
+	def test_no_fingerprint(self):
+		converters.conversion_cache.directory = os.path.join(self.directory, "cache")
+		url = self.server.url("/plain.html")
+		converters.convert(url, self.converter)
+		converters.convert(url, self.converter)
+		self.assertEqual(self.runs(), [url, url])
+
+	def test_no_cache(self):
+		url = self.server.url("/etag.html")
+		converters.convert(url, self.converter)
+		converters.convert(url, self.converter)
+		self.assertEqual(self.runs(), [url, url])
+		# Without a cache directory, the fingerprint of the source is not even requested
+		self.assertEqual(self.server.requests, [])
+
+
+class ConversionCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.cache     = ConversionCache(self.directory, max_entries=2)
+		self.converter = CommandConverter("respec2html")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def key(self, url, fingerprint='"v1"|None'):
+		return ConversionCache.key(url, self.converter, fingerprint)
+
+	def test_lookup(self):
+		self.assertIsNone(self.cache.lookup(self.key("http://example.org/a")))
+		self.cache.store(self.key("http://example.org/a"), "<html>a</html>")
+		self.assertEqual(self.cache.lookup(self.key("http://example.org/a")), "<html>a</html>")
+		# Another fingerprint, i.e., a changed source
+		self.assertIsNone(self.cache.lookup(self.key("http://example.org/a", '"v2"|None')))
+		# No directory, no caching
+		self.assertIsNone(ConversionCache().lookup(self.key("http://example.org/a")))
+
+	def test_eviction(self):
+		for name in ("a", "b"):
+			self.cache.store(self.key("http://example.org/" + name), name)
+			time.sleep(0.05)
+		# a becomes the most recently used result
+		self.assertEqual(self.cache.lookup(self.key("http://example.org/a")), "a")
+		time.sleep(0.05)
+		self.cache.store(self.key("http://example.org/c"), "c")
+		self.assertEqual(self.cache.lookup(self.key("http://example.org/a")), "a")
+		self.assertIsNone(self.cache.lookup(self.key("http://example.org/b")))
+		self.assertEqual(self.cache.lookup(self.key("http://example.org/c")), "c")
+		self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith(".html")]), 2)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Differential tests of the CSS reference scanner against the full (tinycss) parser: for the constructs both of them
+handle, the references found must be identical; the constructs only the scanner handles are checked separately.
+"""
+import unittest
+
+from rp2epub.cssurls import _extract_references, _scan_references
+
+# CSS contents for which both parsers must find the same references
+SAME = {
+	"rulesets"         : u'p { background: url(a.png) } q { list-style: url(b.png) disc; background: url(c.png) }',
+	"imports"          : u'@import "a.css"; @import url(b.css) screen; @import url("c.css"); p { color: red }',
+	"late import"      : u'p { color: red } @import "late.css"; q { background: url(q.png) }',
+	"media"            : u'@media print { p { background: url(m.png) } } q { background: url(n.png) }',
+	"namespace"        : u'@namespace svg url(http://www.w3.org/2000/svg);\np { background: url(a.png) }',
+	"default namespace": u'@namespace url("http://www.w3.org/1999/xhtml");\n@import "x.css";\np { background: url(y.png) }',
+	"charset"          : u'@charset "utf-8"; @import "a.css" screen; @import url(b.css);',
+	"comments"         : u'/* url(no.png) @import "no.css"; */ @import url(yes.css); p { /* url(c.png) */ background: url(d.png) }',
+	"unclosed comment" : u'p { background: url(a.png) } /* url(no.png)',
+	"strings"          : u'p:before { content: "url(no.png)" } q { background: url("e f.png") } r { background: url(\'g.png\') }',
+	"string escapes"   : u'p:before { content: "\\"url(no.png)" } q { background: url("a\\"b.png") }',
+	"url escapes"      : u'p { background: url(h\\(1\\).png) } q { background: url("\\69 .png") } r { background: url(\\6a k.png) }',
+	"whitespace"       : u'p { background: url(  spaced.png  ) } q { background: URL(upper.png) }',
+	"non ascii"        : u'p { background: url(café.png) }',
+}
+
+
+def references(parser, content):
+	return parser(content)[0]
+
+
+class DifferentialTest(unittest.TestCase):
+	def test_same_references(self):
+		for name, content in sorted(SAME.items()):
+			self.assertEqual(references(_scan_references, content), references(_extract_references, content), name)
+
+	def test_namespace_is_not_a_reference(self):
+		for content in (SAME["namespace"], SAME["default namespace"]):
+			urls = [url for url, is_import in references(_scan_references, content)]
+			self.assertNotIn(u"http://www.w3.org/2000/svg", urls)
+			self.assertNotIn(u"http://www.w3.org/1999/xhtml", urls)
+
+	def test_font_face(self):
+		# tinycss ignores the content of @font-face; the scanner finds the fonts on top of the other references
+		content = u'@font-face { font-family: X; src: url(font.woff) format("woff"), url(font.ttf) }\np { background: url(b.png) }'
+		self.assertEqual(references(_extract_references, content), [(u"b.png", False)])
+		self.assertEqual(references(_scan_references, content), [(u"font.woff", False), (u"font.ttf", False), (u"b.png", False)])
+
+	def test_at_rule_blocks(self):
+		# The scanner finds the references within the blocks of @page and @supports, but not in their preludes
+		self.assertEqual(references(_scan_references, u'@page :first { background: url(pg.png) }'), [(u"pg.png", False)])
+		self.assertEqual(references(_scan_references, u'@supports (background: url(s.png)) { p { background: url(t.png) } }'), [(u"t.png", False)])
+
+	def test_invalid_import(self):
+		# An @import within a block is invalid and ignored, with its target
+		refs, errors = _scan_references(u'p { @import url(no.css); background: url(a.png) }')
+		self.assertEqual(refs, [(u"a.png", False)])
+		self.assertTrue(errors)
+
+	def test_bytes(self):
+		# The content of a CSS file is passed undecoded
+		content = '@charset "utf-8"; @import "a.css"; p { background: url(b.png) }'
+		self.assertEqual(references(_scan_references, content), references(_extract_references, content))
+
+
+if __name__ == "__main__":
+	unittest.main()
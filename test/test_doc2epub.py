@@ -0,0 +1,81 @@
+"""
+Tests of the generation of a book from a local server: the entries of the EPUB package are in the baseline order
+(``mimetype``, uncompressed, first, then ``META-INF``, the resources, the package documents, and the main content),
+whether the book is written into a seekable buffer or progressively into a stream that is not seekable.
+"""
+import zipfile
+import unittest
+from io import BytesIO
+
+from rp2epub import doc2epub
+from rp2epub.doc2epub import DocWrapper
+
+from httpserver import TestServer, Resource
+
+PAGE = """<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Order</title>
+<link rel="stylesheet" href="style.css"></head><body><h1>Order</h1>
+<dl><dt>This version:</dt><dd><a class="u-url" href="https://www.w3.org/TR/2016/WD-order-20160101/">x</a></dd></dl>
+<p><img src="figure.png" alt=""></p></body></html>"""
+
+RESOURCES = {
+	"/spec/Overview.html"  : Resource(PAGE, "text/html"),
+	"/spec/style.css"      : Resource("body { background: url(back.png) }"),
+	"/spec/figure.png"     : Resource("PNG" * 100, "image/png"),
+	"/spec/back.png"       : Resource("GIF" * 100, "image/png"),
+	"/Icons/logo.png"      : Resource("LOGO" * 100, "image/png"),
+	"/StyleSheets/base.css": Resource("h1 { color: red }"),
+}
+
+ORDER = ["mimetype", "META-INF/container.xml", "StyleSheets/TR/book.css", "Icons/w3c_main.png", "StyleSheets/TR/base.css",
+		 "style.css", "figure.png", "back.png", "package.opf", "toc.ncx", "nav.xhtml", "cover.xhtml", "Overview.xhtml"]
+
+
+class _Pipe(object):
+	"""A stream that is neither seekable nor readable, e.g., a socket"""
+	def __init__(self):
+		self.buffer = BytesIO()
+
+	def write(self, data):
+		self.buffer.write(data)
+
+	def flush(self):
+		pass
+
+
+class OrderTest(unittest.TestCase):
+	def setUp(self):
+		self.server      = TestServer(RESOURCES)
+		self.to_transfer = doc2epub.TO_TRANSFER
+		# The fixed resources of the book are served locally, too
+		doc2epub.TO_TRANSFER = [(self.server.url("/Icons/logo.png"), "Icons/w3c_main.png"),
+								(self.server.url("/StyleSheets/base.css"), "StyleSheets/TR/base.css")]
+
+	def tearDown(self):
+		doc2epub.TO_TRANSFER = self.to_transfer
+		self.server.close()
+
+	def check(self, content):
+		package = zipfile.ZipFile(BytesIO(content))
+		self.assertIsNone(package.testzip())
+		self.assertEqual(package.namelist(), ORDER)
+		mimetype = package.infolist()[0]
+		self.assertEqual(mimetype.compress_type, zipfile.ZIP_STORED)
+		# The content of the mimetype entry directly follows its local header, at a fixed offset
+		self.assertEqual(content[30:38], "mimetype")
+		self.assertEqual(content[38:58], "application/epub+zip")
+
+	def test_buffer(self):
+		with DocWrapper(self.server.url("/spec/Overview.html")) as wrapper:
+			self.check(wrapper.process_to_buffer().getvalue())
+
+	def test_stream(self):
+		output = _Pipe()
+		stages = []
+		with DocWrapper(self.server.url("/spec/Overview.html"), progress=lambda stage, done, total: stages.append(stage)) as wrapper:
+			wrapper.process(output)
+		self.check(output.buffer.getvalue())
+		self.assertEqual(stages, doc2epub.STAGES)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,110 @@
+"""
+Tests of the element index: the lookups must return the same elements, in the same order, as the equivalent
+``findall`` calls, also after changes on the tree.
+"""
+import unittest
+from xml.etree.ElementTree import fromstring, SubElement
+
+from rp2epub.domindex import DOMIndex
+
+DOCUMENT = """<html><head><title>T</title><link rel="stylesheet" href="a.css"/><base href="http://example.org/"/></head>
+<body class="toc-sidebar"><p id="x" class="note">a <a href="#y">y</a></p><pre class="highlight">b</pre>
+<nav id="toc"><ul class="toc"><li><a href="#x">x</a></li></ul></nav><p id="y"><a href="b.html">b</a></p></body></html>"""
+
+LOOKUPS = [
+	("link", "rel", "stylesheet"),
+	("a", "href", None),
+	("p", "id", "y"),
+	("p", "class", "note"),
+	("pre", "class", None),
+	("p", None, None),
+	("a", None, None),
+]
+
+
+def findall(root, tag, attribute=None, value=None):
+	if attribute is None:
+		return root.findall(".//%s" % tag)
+	elif value is None:
+		return root.findall(".//%s[@%s]" % (tag, attribute))
+	else:
+		return root.findall(".//%s[@%s='%s']" % (tag, attribute, value))
+
+
+class DOMIndexTest(unittest.TestCase):
+	def setUp(self):
+		self.root  = fromstring(DOCUMENT)
+		self.index = DOMIndex(self.root)
+		self.head  = self.root.find("head")
+		self.body  = self.root.find("body")
+
+	def check_lookups(self):
+		for lookup in LOOKUPS:
+			self.assertEqual(self.index.find_all(*lookup), findall(self.root, *lookup), lookup)
+		self.assertEqual(self.index.select("nav[@id='toc']/ul[@class='toc']"), self.root.findall(".//nav[@id='toc']/ul[@class='toc']"))
+
+	def test_lookups(self):
+		self.check_lookups()
+		self.assertIs(self.index.find("p"), self.root.find(".//p"))
+		self.assertIs(self.index.parent(self.root.find(".//pre")), self.body)
+
+	def test_add_keeps_document_order(self):
+		# The new link is in the head, i.e., before the links of the body
+		link = SubElement(self.head, "link", rel="stylesheet", href="book.css")
+		self.index.add(link, self.head)
+		self.body.append(fromstring('<p><link rel="stylesheet" href="late.css"/></p>'))
+		self.index.add(self.body[-1], self.body)
+		self.check_lookups()
+		self.assertEqual([e.get("href") for e in self.index.find_all("link", "rel", "stylesheet")], ["a.css", "book.css", "late.css"])
+
+	def test_reparent_keeps_document_order(self):
+		main = SubElement(self.body, "div", role="main")
+		self.index.add(main, self.body)
+		for child in [x for x in self.body if x is not main]:
+			self.body.remove(child)
+			main.append(child)
+			self.index.reparent(child, main)
+		self.check_lookups()
+		self.assertIs(self.index.parent(self.root.find(".//pre")), main)
+
+	def test_new_attributes(self):
+		pre = self.root.find(".//pre")
+		self.index.set(pre, "id", "code")
+		self.index.set(pre, "class", "book_highlight")
+		self.index.set(self.body, "class", "toc-inline")
+		self.index.set(self.root.find(".//p"), "title", "first")
+		self.assertEqual(self.index.find_all("pre", "id", "code"), [pre])
+		self.assertEqual(self.index.find_all("pre", "class", "book_highlight"), [pre])
+		self.assertEqual(self.index.find_all("pre", "class", "highlight"), [])
+		self.assertEqual(self.index.find_all("body", "class", "toc-inline"), [self.body])
+		self.assertEqual(self.index.find_all("p", "title"), [self.root.find(".//p")])
+		self.check_lookups()
+
+	def test_renamed(self):
+		# A link to a missing resource becomes a span (see Document.extract_external_references)
+		a = self.root.find(".//p[@id='y']/a")
+		a.tag = "span"
+		a.attrib.pop("href")
+		self.index.invalidate()
+		self.assertEqual(self.index.find_all("span"), [a])
+		self.assertNotIn(a, self.index.find_all("a"))
+		self.check_lookups()
+
+	def test_remove(self):
+		base = self.root.find(".//base")
+		self.head.remove(base)
+		self.index.remove(base)
+		self.assertEqual(self.index.find_all("base"), [])
+		self.assertIsNone(self.index.parent(base))
+		self.check_lookups()
+
+	def test_remove_after_add(self):
+		link = SubElement(self.head, "link", rel="stylesheet", href="book.css")
+		self.index.add(link, self.head)
+		self.head.remove(link)
+		self.index.remove(link)
+		self.check_lookups()
+
+
+if __name__ == "__main__":
+	unittest.main()
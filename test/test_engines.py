@@ -0,0 +1,84 @@
+"""
+Parity tests of the tree engines: the same sources, parsed and serialized by the ``etree`` and by the ``lxml`` engines,
+must yield the same XML infosets and the same manifest properties.
+"""
+import unittest
+from StringIO import StringIO
+from xml.etree.ElementTree import fromstring
+
+from rp2epub import engines
+from rp2epub.utils import Utils
+
+SOURCES = {
+	"plain": """<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Plain</title></head>
+<body class="h-entry"><!-- comment --><h1>Title</h1><p id="p1">Some <em>text</em> &amp; a <a href="#p1">link</a>.<br>
+<img src="a.png" alt=""></p><pre class="highlight">x &lt; y</pre></body></html>""",
+
+	"svg and mathml": """<!DOCTYPE html><html lang="en"><head><title>Foreign</title>
+<script src="a.js"></script></head><body><form><input name="q"></form>
+<p>An image: <svg width="10" height="10" viewBox="0 0 10 10"><title>Box</title><rect width="10" height="10"/>
+<a xlink:href="#p"><text x="1" y="5">t</text></a><foreignObject width="5" height="5"><p id="in">HTML <b>inside</b></p></foreignObject>
+</svg> and a formula: <math><mi>x</mi><mo>=</mo><mfrac><mn>1</mn><mn>2</mn></mfrac>
+<annotation-xml encoding="text/html"><span>one half</span></annotation-xml></math>.</p></body></html>""",
+
+	"nested foreign": """<!DOCTYPE html><html><head><title>Nested</title></head><body>
+<svg><foreignObject><div><math><mi>y</mi></math><svg><circle r="1"/></svg></div></foreignObject></svg></body></html>""",
+}
+
+
+def infoset(content):
+	"""The elements of a serialization, with their (namespaced) tags, attributes, texts and tails"""
+	return [(e.tag, sorted(e.items()), e.text, e.tail) for e in fromstring(content).iter()]
+
+
+def serialize(engine, source):
+	root = engine.parse(StringIO(source))
+	engine.set_xhtml_namespace(root)
+	return engine.serialize(engine.tree(root))
+
+
+@unittest.skipIf(engines.lxml_etree is None, "lxml is not installed")
+class EngineParityTest(unittest.TestCase):
+	def setUp(self):
+		self.html5_parser = engines.html5_parser
+
+	def tearDown(self):
+		engines.html5_parser = self.html5_parser
+
+	def check_parity(self):
+		etree, lxml = engines.get_engine("etree"), engines.get_engine("lxml")
+		for name, source in sorted(SOURCES.items()):
+			self.assertEqual(infoset(serialize(etree, source)), infoset(serialize(lxml, source)), name)
+			self.assertEqual(Utils.get_document_properties(etree.parse(StringIO(source))),
+							 Utils.get_document_properties(lxml.parse(StringIO(source))), name)
+
+	@unittest.skipIf(engines.html5_parser is None, "html5-parser is not installed")
+	def test_html5_parser(self):
+		self.check_parity()
+
+	def test_html5lib(self):
+		engines.html5_parser = None
+		self.check_parity()
+
+	def test_properties(self):
+		lxml = engines.get_engine("lxml")
+		properties = Utils.get_document_properties(lxml.parse(StringIO(SOURCES["svg and mathml"])))
+		self.assertEqual(properties, {"svg", "mathml", "scripted"})
+
+	def test_html_namespace(self):
+		root = fromstring(serialize(engines.get_engine("lxml"), SOURCES["svg and mathml"]))
+		self.assertEqual(root.tag, "{http://www.w3.org/1999/xhtml}html")
+		self.assertEqual(root.find(".//{http://www.w3.org/2000/svg}foreignObject/{http://www.w3.org/1999/xhtml}p").get("id"), "in")
+
+	def test_tags(self):
+		# The HTML elements are not in a namespace in the trees of both engines
+		for name in ("etree", "lxml"):
+			root = engines.get_engine(name).parse(StringIO(SOURCES["svg and mathml"]))
+			self.assertEqual(root.tag, "html")
+			self.assertEqual(len(root.findall(".//body")), 1)
+			self.assertEqual(len(root.findall(".//{http://www.w3.org/2000/svg}rect")), 1)
+			self.assertEqual(len(root.findall(".//{http://www.w3.org/1998/Math/MathML}mfrac")), 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,94 @@
+"""
+Tests of the persistent HTTP cache: storage of the retrieved resources, fresh hits without network access, revalidation
+of stale entries (via ``ETag`` and ``Last-Modified``), and eviction of the least recently used entries.
+"""
+import time
+import shutil
+import tempfile
+import unittest
+
+from rp2epub import utils
+from rp2epub.utils import HttpSession
+from rp2epub.httpcache import HttpCache
+from rp2epub.downloads import Downloader
+
+from httpserver import TestServer, Resource
+
+RESOURCES = {
+	"/fresh.css"  : Resource("p { color: red }", headers={"Cache-Control": "max-age=3600"}),
+	"/etag.png"   : Resource("PNG" * 100, "image/png", {"ETag": '"v1"', "Cache-Control": "no-cache"}),
+	"/dated.css"  : Resource("q { color: blue }", headers={"Last-Modified": "Mon, 01 Feb 2016 10:00:00 GMT", "Cache-Control": "no-cache"}),
+	"/private.css": Resource("r { color: green }", headers={"Cache-Control": "no-store"}),
+	"/a.css"      : Resource("a" * 100, headers={"Cache-Control": "max-age=3600"}),
+	"/b.css"      : Resource("b" * 100, headers={"Cache-Control": "max-age=3600"}),
+	"/c.css"      : Resource("c" * 100, headers={"Cache-Control": "max-age=3600"}),
+}
+
+
+class HttpCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.server    = TestServer(RESOURCES)
+		self.directory = tempfile.mkdtemp()
+		utils.http_cache = HttpCache(self.directory)
+
+	def tearDown(self):
+		utils.http_cache = None
+		shutil.rmtree(self.directory)
+		self.server.close()
+
+	def get(self, path):
+		session = HttpSession(self.server.url(path))
+		self.assertTrue(session.success)
+		data = session.data
+		try:
+			return data.read()
+		finally:
+			data.close()
+
+	def test_fresh_hit(self):
+		self.assertEqual(self.get("/fresh.css"), RESOURCES["/fresh.css"].body)
+		self.assertIsNotNone(utils.http_cache.lookup(self.server.url("/fresh.css")))
+		self.assertEqual(self.get("/fresh.css"), RESOURCES["/fresh.css"].body)
+		self.assertEqual(self.server.statuses("/fresh.css"), [200])
+
+	def test_etag_revalidation(self):
+		self.assertEqual(self.get("/etag.png"), RESOURCES["/etag.png"].body)
+		self.assertEqual(self.get("/etag.png"), RESOURCES["/etag.png"].body)
+		self.assertEqual(self.server.statuses("/etag.png"), [200, 304])
+
+	def test_last_modified_revalidation(self):
+		self.assertEqual(self.get("/dated.css"), RESOURCES["/dated.css"].body)
+		self.assertEqual(self.get("/dated.css"), RESOURCES["/dated.css"].body)
+		self.assertEqual(self.server.statuses("/dated.css"), [200, 304])
+
+	def test_no_store(self):
+		self.get("/private.css")
+		self.assertIsNone(utils.http_cache.lookup(self.server.url("/private.css")))
+
+	def test_downloader(self):
+		# The downloader buffers the content of a session, i.e., it reads the response with a bounded read
+		for _ in range(2):
+			with Downloader(workers=2) as downloader:
+				session = downloader.fetch(self.server.url("/fresh.css"))
+				self.assertEqual(session.data.read(), RESOURCES["/fresh.css"].body)
+		self.assertIsNotNone(utils.http_cache.lookup(self.server.url("/fresh.css")))
+		self.assertEqual(self.server.statuses("/fresh.css"), [200])
+
+	def test_eviction(self):
+		utils.http_cache = HttpCache(self.directory, max_size=250)
+		self.get("/a.css")
+		time.sleep(0.05)
+		self.get("/b.css")
+		time.sleep(0.05)
+		# a.css becomes the most recently used entry
+		self.get("/a.css")
+		time.sleep(0.05)
+		self.get("/c.css")
+		self.assertIsNotNone(utils.http_cache.lookup(self.server.url("/a.css")))
+		self.assertIsNone(utils.http_cache.lookup(self.server.url("/b.css")))
+		self.assertIsNotNone(utils.http_cache.lookup(self.server.url("/c.css")))
+		self.assertEqual(self.server.statuses("/a.css"), [200])
+
+
+if __name__ == "__main__":
+	unittest.main()
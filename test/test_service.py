@@ -0,0 +1,42 @@
+"""
+Tests of the sharing of a generated book between concurrent requests of the HTTP service.
+"""
+import hashlib
+import unittest
+from io import BytesIO
+
+from rp2epub import service
+
+# Larger than the size of a book kept in memory, and not a multiple of the size of the chunks
+CONTENT = "".join(chr(i) for i in range(256)) * (service.SERVICE_SPOOL_LIMIT / 256 + 1) + "tail"
+
+
+class SharedBookTest(unittest.TestCase):
+	def check(self, book):
+		self.assertEqual(book.size, len(CONTENT))
+		self.assertEqual(book.etag, '"%s"' % hashlib.sha1(CONTENT).hexdigest())
+		# Interleaved iterations get the same, complete content
+		first, second = book.chunks(), book.chunks()
+		got_first, got_second = [next(first)], []
+		for chunk in second:
+			got_second.append(chunk)
+		got_first.extend(first)
+		self.assertEqual("".join(got_first), CONTENT)
+		self.assertEqual("".join(got_second), CONTENT)
+
+	def test_buffer(self):
+		buffer = BytesIO(CONTENT)
+		buffer.seek(100)
+		self.check(service._SharedBook(buffer))
+
+	def test_spool(self):
+		book = service._SharedBook()
+		for start in range(0, len(CONTENT), 10000):
+			book.write(CONTENT[start:start + 10000])
+		self.check(book)
+		# Beyond the limit, the book is in a temporary file, not in memory
+		self.assertTrue(book._content._rolled)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,117 @@
+"""
+Round-trip tests of the streaming write of the book: the archives must be valid, with the same content, whatever the
+way they are written (serial or parallel compression, deduplication of identical files, progressive write into a
+stream that is not seekable).
+"""
+import os
+import shutil
+import random
+import hashlib
+import tempfile
+import zipfile
+import unittest
+from io import BytesIO
+
+from rp2epub.utils import Book
+
+_random = random.Random(0)
+
+# Text larger than the blocks compressed separately by the parallel compression, and content that does not shrink
+TEXT  = "".join("<p id='p%d'>Paragraph %d of the document</p>\n" % (i, _random.randrange(1000)) for i in range(20000))
+NOISE = "".join(chr(_random.randrange(256)) for _ in range(100000))
+
+
+class _Pipe(object):
+	"""A stream that is neither seekable nor readable, e.g., a socket"""
+	def __init__(self):
+		self.buffer = BytesIO()
+
+	def write(self, data):
+		self.buffer.write(data)
+
+	def flush(self):
+		pass
+
+	def getvalue(self):
+		return self.buffer.getvalue()
+
+
+def build(output, **options):
+	"""Write a book with small, large, incompressible and already compressed files, in one piece or in chunks"""
+	with Book(output, "book", **options) as book:
+		book.writestr("small.css", "body { color: black }")
+		book.writestr("large.xhtml", TEXT)
+		book.writestr("noise.bin", NOISE, media_type="application/octet-stream")
+		book.writestr("logo.png", "PNG" * 1000)
+		with book.open_entry("chunked.xhtml") as entry:
+			for start in range(0, len(TEXT), 1000):
+				entry.write(TEXT[start:start + 1000])
+		book.writestr("empty.txt", "")
+		# Duplicates of the files above
+		book.writestr("copy/small.css", "body { color: black }")
+		book.writestr("copy/large.xhtml", TEXT)
+		book.writestr("copy/noise.bin", NOISE, media_type="application/octet-stream")
+		with book.open_entry("copy/chunked.xhtml", size=len(TEXT), digest=hashlib.sha1(TEXT).digest()) as entry:
+			entry.write(TEXT)
+	return output
+
+
+def contents(output):
+	"""The names and contents of the entries of an archive, in order"""
+	package = zipfile.ZipFile(BytesIO(output.getvalue()))
+	if package.testzip() is not None:
+		raise AssertionError("Corrupt entry: %s" % package.testzip())
+	return [(info.filename, package.read(info.filename)) for info in package.infolist()]
+
+
+class RoundTripTest(unittest.TestCase):
+	def test_parallel(self):
+		serial = contents(build(BytesIO()))
+		for workers in (2, 4):
+			self.assertEqual(contents(build(BytesIO(), compress_workers=workers)), serial, workers)
+		self.assertEqual(dict(serial)["large.xhtml"], TEXT)
+		self.assertEqual(dict(serial)["chunked.xhtml"], TEXT)
+
+	def test_dedup(self):
+		expected = contents(build(BytesIO()))
+		self.assertEqual(dict(expected)["copy/large.xhtml"], TEXT)
+		directory = tempfile.mkdtemp()
+		try:
+			for workers in (1, 2):
+				# The duplicates are copied from the archive file, or from the (readable) stream the archive is written into
+				name = os.path.join(directory, "book-%s.epub" % workers)
+				build(name, compress_workers=workers, dedup=True)
+				with open(name, "rb") as f:
+					self.assertEqual(contents(BytesIO(f.read())), expected, workers)
+				self.assertEqual(contents(build(BytesIO(), compress_workers=workers, dedup=True)), expected, workers)
+		finally:
+			shutil.rmtree(directory)
+
+	def test_dedup_saved(self):
+		output = BytesIO()
+		with Book(output, "book", dedup=True) as book:
+			book.writestr("a/large.xhtml", TEXT)
+			book.writestr("b/large.xhtml", TEXT)
+			self.assertEqual(book.dedup_saved, len(TEXT))
+		package = zipfile.ZipFile(BytesIO(output.getvalue()))
+		first, second = package.getinfo("a/large.xhtml"), package.getinfo("b/large.xhtml")
+		self.assertEqual((first.CRC, first.compress_size), (second.CRC, second.compress_size))
+
+	def test_stream(self):
+		expected = contents(build(BytesIO()))
+		for workers in (1, 2):
+			# The deduplication is not possible (the stream is not readable), and is silently skipped
+			output = build(_Pipe(), compress_workers=workers, dedup=True)
+			self.assertEqual(contents(output), expected, workers)
+			package = zipfile.ZipFile(BytesIO(output.getvalue()))
+			self.assertIsNone(package.testzip())
+			# A stored entry must have a complete local header: a data descriptor could not be found by a sequential reader
+			mimetype = package.infolist()[0]
+			self.assertEqual((mimetype.filename, mimetype.compress_type, mimetype.flag_bits & 0x08), ("mimetype", zipfile.ZIP_STORED, 0))
+			for info in package.infolist():
+				self.assertFalse(info.compress_type == zipfile.ZIP_STORED and info.flag_bits & 0x08, info.filename)
+			self.assertTrue(package.getinfo("chunked.xhtml").flag_bits & 0x08)
+
+
+if __name__ == "__main__":
+	unittest.main()